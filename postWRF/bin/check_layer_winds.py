@@ -0,0 +1,63 @@
+""" Check interp.layer_winds against a direct integration of the wind
+profile, for height (increasing with model level) and pressure
+(decreasing with model level) coordinates.
+
+Profiles are random; the direct integration samples the interpolated
+profile finely between the layer bounds. Exits with status 1 if any
+layer-mean or shear differs by more than the tolerance (m/s).
+
+Usage: python check_layer_winds.py [tolerance]
+"""
+import sys
+import numpy as N
+
+from WEM.postWRF.postWRF.interp import layer_winds
+
+tol = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+rs = N.random.RandomState(0)
+nt, nz, ny, nx = 1, 40, 3, 4
+z = N.cumsum(rs.uniform(50.0,600.0,(nt,nz,ny,nx)),axis=1)
+# Hydrostatic-ish pressure, decreasing upwards
+p = 100000.0*N.exp(-z/8000.0)
+u = N.cumsum(rs.normal(0.3,1.0,(nt,nz,ny,nx)),axis=1)
+v = N.cumsum(rs.normal(-0.2,1.0,(nt,nz,ny,nx)),axis=1)
+
+def direct(coord,data,bot,top,log,npts=20001):
+    """
+    Mean and bottom-to-top difference of one column's profile,
+    interpolated (in log(coord) if log) and sampled finely.
+    """
+    c = N.log(coord) if log else coord
+    order = N.argsort(c)
+    c = c[order]
+    data = data[order]
+    samples = N.linspace(min(bot,top),max(bot,top),npts)
+    s = N.log(samples) if log else samples
+    prof = N.interp(s,c,data)
+    mean = N.trapz(prof,samples)/(samples[-1]-samples[0])
+    diff = N.interp(N.log(top) if log else top,c,data) - \
+            N.interp(N.log(bot) if log else bot,c,data)
+    return mean, diff
+
+failed = False
+for name, coord, layers, scale, log in (
+        ('km',z,[(0.5,1.0),(0.5,3.0),(1.0,6.0)],1000.0,False),
+        ('hPa',p,[(850,500),(900,300),(700,400)],100.0,True)):
+    winds = layer_winds(u,v,coord,layers,scale=scale,log=log)
+    worst = 0.0
+    for LW, (bot,top) in zip(winds,layers):
+        for j in range(ny):
+            for i in range(nx):
+                for comp, data in (('u',u),('v',v)):
+                    mean, diff = direct(coord[0,:,j,i],data[0,:,j,i],
+                                        bot*scale,top*scale,log)
+                    err = max(abs(LW[comp+'mean'][0,0,j,i]-mean),
+                                abs(LW[comp+'shear'][0,0,j,i]-diff))
+                    worst = max(worst,err)
+    print("{0}: largest difference from direct integration {1:.4f} m/s.".format(
+            name,worst))
+    if worst > tol:
+        failed = True
+
+sys.exit(1 if failed else 0)
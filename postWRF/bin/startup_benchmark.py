@@ -0,0 +1,52 @@
+""" Time how long importing WEM.postWRF takes, and check that it does not
+import the plotting stack (pyplot, Basemap, plotting modules).
+
+Each import is timed in a fresh interpreter. Exits with status 1 if
+the median import time is above the limit, or if a plotting module
+was imported.
+
+Usage: python startup_benchmark.py [repeats] [limit in seconds]
+"""
+import sys
+import subprocess
+import numpy as N
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+limit = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+
+# Modules that compute-only scripts should not pay for
+PLOTTING = ('matplotlib.pyplot','mpl_toolkits.basemap',
+            'WEM.postWRF.postWRF.figure','WEM.postWRF.postWRF.birdseye',
+            'WEM.postWRF.postWRF.skewt','WEM.postWRF.postWRF.scales')
+
+code = """
+import sys, time
+t0 = time.time()
+import WEM.postWRF.postWRF
+t1 = time.time()
+loaded = [m for m in {0} if sys.modules.get(m) is not None]
+print('{{0}} {{1}}'.format(t1-t0, ','.join(loaded)))
+""".format(repr(PLOTTING))
+
+times = []
+loaded = set()
+for n in range(repeats):
+    out = subprocess.check_output([sys.executable,'-c',code])
+    line = out.strip().split('\n')[-1].split(' ')
+    times.append(float(line[0]))
+    if len(line) > 1 and line[1]:
+        loaded.update(line[1].split(','))
+
+median = N.median(times)
+print("Import of WEM.postWRF: median {0:.3f} s, min {1:.3f} s, max {2:.3f} s "
+        "over {3} runs.".format(median,min(times),max(times),repeats))
+
+failed = False
+if loaded:
+    print("Plotting modules imported at startup: {0}".format(', '.join(sorted(loaded))))
+    failed = True
+if median > limit:
+    print("Median import time is above the limit of {0:.2f} s.".format(limit))
+    failed = True
+
+sys.exit(1 if failed else 0)
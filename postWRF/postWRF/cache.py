@@ -0,0 +1,127 @@
+"""In-memory cache of arrays returned by WRFOut.get.
+
+Derived variables are computed from other variables through nested
+calls to WRFOut.get, so the same raw fields (P, PB, T, QVAPOR...) are
+read many times for one plot. FieldCache keeps recently used arrays in
+least-recently-used order and evicts the oldest once a memory budget
+(in bytes) is exceeded.
+"""
+
+import collections
+import numpy as N
+
+def make_key(*args):
+    """
+    Turn a mix of indices, slices, arrays, dictionaries etc into
+    a hashable key.
+
+    Booleans are tagged so that False (all indices) never matches
+    the integer 0.
+    """
+    return tuple(_keyify(a) for a in args)
+
+def _keyify(x):
+    if isinstance(x,(bool,N.bool_)):
+        return ('bool',bool(x))
+    elif isinstance(x,N.ndarray):
+        return ('array',x.dtype.str,x.shape,tuple(x.ravel().tolist()))
+    elif isinstance(x,slice):
+        return ('slice',x.start,x.stop,x.step)
+    elif isinstance(x,dict):
+        return ('dict',tuple(sorted((k,_keyify(v)) for k,v in x.items())))
+    elif isinstance(x,(list,tuple)):
+        return ('seq',tuple(_keyify(i) for i in x))
+    elif isinstance(x,N.generic):
+        return x.item()
+    else:
+        return x
+
+def readonly(data):
+    """
+    Read-only copy of an array.
+    """
+    data = data.copy()
+    data.setflags(write=False)
+    return data
+
+class FieldCache(object):
+    """
+    Least-recently-used cache of numpy arrays with a byte budget.
+
+    Arrays are copied once on the way in and marked read-only; hits
+    return a read-only view, so callers that need to modify the data
+    must copy it first. Other objects with an nbytes attribute (e.g.
+    interp.VerticalInterpolator) share the same budget and are
+    returned as they are.
+    """
+    def __init__(self,max_bytes):
+        """
+        :param max_bytes:   memory budget in bytes. 0 disables caching.
+        :type max_bytes:    int
+        """
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.store = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self,key):
+        return key in self.store
+
+    def get(self,key):
+        """
+        Return a read-only view of the cached array, or None if absent.
+        """
+        if key not in self.store:
+            self.misses += 1
+            return None
+        self.hits += 1
+        data = self.store.pop(key)
+        # Move to most-recently-used end
+        self.store[key] = data
+        if isinstance(data,N.ndarray):
+            return data.view()
+        return data
+
+    def put(self,key,data):
+        """
+        Store an array, evicting least-recently-used entries
+        until the cache fits in the budget.
+
+        Arrays larger than the whole budget are not stored.
+
+        :returns:   the stored (read-only) array, or None if not stored
+        """
+        nbytes = data.nbytes
+        if nbytes > self.max_bytes:
+            return None
+        if key in self.store:
+            self.nbytes -= self.store.pop(key).nbytes
+        if isinstance(data,N.ndarray):
+            data = readonly(data)
+        self.store[key] = data
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            oldkey, old = self.store.popitem(last=False)
+            self.nbytes -= old.nbytes
+        if key in self.store:
+            return self.store[key]
+        return None
+
+    def clear(self):
+        """
+        Empty the cache. Hit/miss counts are kept.
+        """
+        self.store.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Return a dictionary of hits, misses, number of entries and bytes used.
+        """
+        return {'hits':self.hits,'misses':self.misses,
+                'entries':len(self.store),'nbytes':self.nbytes,
+                'max_bytes':self.max_bytes}
@@ -0,0 +1,344 @@
+"""Cold pool depth, strength and gust front position, in batch.
+
+Every column of a swath of transects (or of the whole domain) is
+handled at once with array operations, and transects are placed from
+a centroid, heading and length rather than drawn with the mouse, so
+many members and times can be run without a display.
+
+Transects run from the rear of the system (inside the cold pool) to
+the environment ahead of it. Along each transect the gust front is
+where the 10 m wind shear and 2 m temperature gradient are largest.
+Behind it, the cold pool is the layer above the lowest model level
+in which density potential temperature is at least 1 K below the
+environment's. Its strength is
+
+    C^2 = -2g (dpt' / dpt_env) H
+
+(Rotunno et al 1988; James et al 2006 MWR), with the perturbation
+taken at the lowest model level and H the depth of the cold pool.
+"""
+
+import traceback
+import multiprocessing
+import numpy as N
+
+import metconstants as mc
+from grid import EARTH_RADIUS
+
+# Density potential temperature perturbation (K) bounding the cold pool
+DPT_THRESH = -1.0
+
+def pick_level(arr,zidx):
+    """
+    Value of arr at level zidx in every column.
+
+    :param arr:     (z,...) array
+    :param zidx:    int array of level indices, shaped like arr[0]
+    """
+    zidx = N.asarray(zidx)
+    flat = arr.reshape(arr.shape[0],-1)
+    return flat[zidx.ravel(),N.arange(flat.shape[1])].reshape(zidx.shape)
+
+def cold_pool_depth(dpt,heights,dpt_env,thresh=DPT_THRESH):
+    """
+    Depth of the cold pool in every column.
+
+    Levels from the second upwards are in the cold pool until the
+    first whose perturbation is above thresh.
+
+    :param dpt:         (z,...) density potential temperature (K)
+    :param heights:     (z,...) heights above ground (m)
+    :param dpt_env:     environmental dpt, (z,) or broadcastable to dpt
+    :param thresh:      perturbation bounding the cold pool (K)
+    :returns:           depth (m, zero where there is no cold pool)
+                        and the level index of the top of the cold pool
+                        (zero where there is none).
+    """
+    dpt_env = N.asarray(dpt_env)
+    if dpt_env.ndim == 1:
+        dpt_env = dpt_env.reshape((-1,)+(1,)*(dpt.ndim-1))
+    with N.errstate(invalid='ignore'):
+        cold = (dpt[1:]-dpt_env[1:]) <= thresh
+    # Number of cold levels before the first warm one
+    zidx = N.cumprod(cold,axis=0).sum(axis=0)
+    dz = N.where(zidx > 0,pick_level(heights,zidx),0.0)
+    return dz, zidx
+
+def cold_pool_C2(dpt,heights,dpt_env,thresh=DPT_THRESH):
+    """
+    C^2 (m2/s2) in every column; see cold_pool_depth for the
+    arguments.
+
+    :returns:   C^2 and depth (m)
+    """
+    dpt_env = N.asarray(dpt_env)
+    if dpt_env.ndim == 1:
+        dpt_env = dpt_env.reshape((-1,)+(1,)*(dpt.ndim-1))
+    dz, zidx = cold_pool_depth(dpt,heights,dpt_env,thresh)
+    C2 = -2*mc.g*((dpt[0]-dpt_env[0])/dpt_env[0])*dz
+    return C2, dz
+
+def cold_pool_C(dpt,heights,dpt_env,thresh=DPT_THRESH):
+    """
+    Cold pool strength C (m/s) in every column; see cold_pool_depth
+    for the arguments.
+
+    :returns:   C (NaN where the lowest level is not colder than
+                the environment) and depth (m)
+    """
+    C2, dz = cold_pool_C2(dpt,heights,dpt_env,thresh)
+    with N.errstate(invalid='ignore'):
+        return N.sqrt(C2), dz
+
+def along_gradient(field,ds):
+    """
+    Centred difference along the last axis, per km. Zero at the ends.
+
+    :param field:   (transect,point) array
+    :param ds:      distance between points (m)
+    """
+    grad = N.zeros(field.shape)
+    grad[...,1:-1] = ((field[...,2:]-field[...,:-2])/(2*ds))*1000.0
+    return grad
+
+def find_gust_front(wind_slices,T2_slices,ds,method=3):
+    """
+    Index of the gust front along each transect.
+
+    :param wind_slices: (transect,point) 10 m wind speed
+    :param T2_slices:   (transect,point) 2 m temperature
+    :param ds:          distance between points (m)
+    :param method:      2 averages the positions of the largest shear
+                        and temperature gradient; 3 takes the one
+                        further along the transect.
+    :type method:       int
+    :returns:           int array, one per transect
+    """
+    shear = N.abs(along_gradient(wind_slices,ds))
+    T2grad = N.abs(along_gradient(T2_slices,ds))
+    # Points outside the domain (NaN) are never picked
+    xsh_idx = N.where(N.isnan(shear),-1,shear).argmax(axis=-1)
+    xtg_idx = N.where(N.isnan(T2grad),-1,T2grad).argmax(axis=-1)
+    if method == 2:
+        return ((xsh_idx+xtg_idx)/2).astype(int)
+    elif method == 3:
+        return N.maximum(xsh_idx,xtg_idx)
+    else:
+        print("Gust front method must be 2 or 3.")
+        raise Exception
+
+def destination(lat,lon,heading,dist):
+    """
+    Point reached by going dist (m) from lat/lon along a great
+    circle with initial heading (degrees clockwise from north).
+    """
+    rad = N.pi/180.0
+    d = dist/EARTH_RADIUS
+    th = heading*rad
+    lat1 = lat*rad
+    lat2 = N.arcsin(N.sin(lat1)*N.cos(d) + N.cos(lat1)*N.sin(d)*N.cos(th))
+    lon2 = lon*rad + N.arctan2(N.sin(th)*N.sin(d)*N.cos(lat1),
+                                N.cos(d)-N.sin(lat1)*N.sin(lat2))
+    return lat2/rad, lon2/rad
+
+def line_transects(i0,j0,i1,j1,nswath=1,spacing=1.0):
+    """
+    Parallel transects either side of the line from (i0,j0) to
+    (i1,j1), in grid-point units.
+
+    Points are one grid length apart along each transect; transects
+    are spacing grid lengths apart, and the middle one (for odd
+    nswath) is the line itself.
+
+    :returns:   i, j -- fractional indices, (nswath,point) arrays
+    """
+    length = N.hypot(i1-i0,j1-j0)
+    if length == 0:
+        print("Transect has no length.")
+        raise Exception
+    ui, uj = (i1-i0)/length, (j1-j0)/length
+    along = N.arange(int(length)+1)
+    across = (N.arange(nswath)-(nswath-1)/2.0)*spacing
+    ii = i0 + ui*along[N.newaxis,:] - uj*across[:,N.newaxis]
+    jj = j0 + uj*along[N.newaxis,:] + ui*across[:,N.newaxis]
+    return ii, jj
+
+def make_transects(grid,lat,lon,heading,length,nswath=1,spacing=1.0):
+    """
+    Swath of transects centred on a point.
+
+    :param grid:        grid.Grid of the domain
+    :param lat,lon:     centroid of the swath (e.g. of a bow echo)
+    :type lat,lon:      float
+    :param heading:     direction from the rear of the system to the
+                        environment ahead (degrees clockwise from north),
+                        usually its direction of motion.
+    :type heading:      float
+    :param length:      length of each transect (km)
+    :type length:       float
+    :param nswath:      number of transects
+    :type nswath:       int
+    :param spacing:     distance between transects (grid points)
+    :type spacing:      float
+    :returns:           i, j -- see line_transects
+    """
+    half = 500.0*length
+    lat0, lon0 = destination(lat,lon,heading+180.0,half)
+    lat1, lon1 = destination(lat,lon,heading,half)
+    (i0,i1), (j0,j1) = grid.latlon_to_ij([lat0,lat1],[lon0,lon1])
+    return line_transects(i0,j0,i1,j1,nswath,spacing)
+
+class ColdPool(object):
+    """
+    Fields needed for cold pool analysis at one time, loaded once.
+    """
+    def __init__(self,W,utc,thresh=DPT_THRESH):
+        """
+        :param W:       WRFOut instance
+        :param utc:     time (any format accepted by WRFOut.get)
+        :param thresh:  perturbation bounding the cold pool (K)
+        """
+        self.W = W
+        self.grid = W.grid
+        self.dx = float(W.dx)
+        self.thresh = thresh
+        data = W.get(['wind10','T2','dpt','Z','HGT'],utc=utc)
+        self.wind10 = data['wind10'][0,0,:,:]
+        self.T2 = data['T2'][0,0,:,:]
+        self.dpt = data['dpt'][0,:,:,:]
+        self.heights = data['Z'][0,:,:,:] - data['HGT'][0,0,:,:]
+        self.ny, self.nx = self.wind10.shape
+
+    def env_profile(self,lat,lon,halfwidth=2):
+        """
+        Environmental dpt: mean over a box of columns around lat/lon.
+        """
+        y, x = self.grid.get_idx(lat,lon)
+        box = self.dpt[:,max(y-halfwidth,0):y+halfwidth+1,
+                        max(x-halfwidth,0):x+halfwidth+1]
+        return box.reshape(box.shape[0],-1).mean(axis=1)
+
+    def domain(self,env):
+        """
+        Cold pool depth and strength in every column of the domain.
+
+        :param env:     (lat,lon) of the environment, or a dpt profile
+        :returns:       C (m/s) and depth (m), (y,x) arrays
+        """
+        if isinstance(env,(tuple,list)):
+            env = self.env_profile(*env)
+        return cold_pool_C(self.dpt,self.heights,N.asarray(env),self.thresh)
+
+    def swath(self,ii,jj,env=False,method=3):
+        """
+        Gust front position, and cold pool depth and strength behind
+        it, along every transect.
+
+        :param ii,jj:   fractional grid indices of the transect points,
+                        (transect,point) arrays (e.g. make_transects)
+        :param env:     (lat,lon) of the environment, or a dpt profile.
+                        If False, each transect's environment is the
+                        mean of its columns ahead of the gust front.
+        :param method:  see find_gust_front
+        :returns:       dictionary of (transect,) arrays gf (point
+                        index), gf_lat, gf_lon, and of (transect,point)
+                        arrays C, depth (NaN ahead of the gust front and
+                        outside the domain), x, y (nearest grid point),
+                        lats and lons.
+        """
+        ii = N.atleast_2d(ii)
+        jj = N.atleast_2d(jj)
+        x = N.round(ii).astype(int)
+        y = N.round(jj).astype(int)
+        inside = (x >= 0) & (x < self.nx) & (y >= 0) & (y < self.ny)
+        x = N.clip(x,0,self.nx-1)
+        y = N.clip(y,0,self.ny-1)
+
+        wind = N.where(inside,self.wind10[y,x],N.nan)
+        T2 = N.where(inside,self.T2[y,x],N.nan)
+        gf = find_gust_front(wind,T2,self.dx,method)
+
+        # Columns along every transect: (z,transect,point)
+        dpt = self.dpt[:,y,x]
+        heights = self.heights[:,y,x]
+        pts = N.arange(x.shape[1])[N.newaxis,:]
+        behind = inside & (pts < gf[:,N.newaxis])
+        if env is False:
+            ahead = inside & (pts > gf[:,N.newaxis])
+            nahead = ahead.sum(axis=1)
+            with N.errstate(invalid='ignore',divide='ignore'):
+                dpt_env = N.where(ahead,dpt,0.0).sum(axis=2)/nahead
+            dpt_env = dpt_env[:,:,N.newaxis]
+        elif isinstance(env,(tuple,list)):
+            dpt_env = self.env_profile(*env)
+        else:
+            dpt_env = N.asarray(env)
+        C, depth = cold_pool_C(dpt,heights,dpt_env,self.thresh)
+
+        ntr = N.arange(x.shape[0])
+        return {'gf':gf,'gf_lat':self.grid.lats[y[ntr,gf],x[ntr,gf]],
+                'gf_lon':self.grid.lons[y[ntr,gf],x[ntr,gf]],
+                'C':N.where(behind,C,N.nan),'depth':N.where(behind,depth,N.nan),
+                'x':x,'y':y,'lats':self.grid.lats[y,x],'lons':self.grid.lons[y,x]}
+
+    def on_grid(self,result,key='C'):
+        """
+        Put a swath result on the model grid, zero elsewhere. Where
+        transects share a grid point, the last one wins.
+        """
+        field = N.zeros((self.ny,self.nx))
+        ok = N.isfinite(result[key])
+        field[result['y'][ok],result['x'][ok]] = result[key][ok]
+        return field
+
+def cold_pool_case(case):
+    """
+    Cold pool analysis of a swath for one file and time.
+    Module-level, so it can be passed to a process pool.
+
+    :param case:    dictionary with keys fpath, utc, lat, lon,
+                    heading, length; optionally nswath (default 1),
+                    spacing (1.0), env (False) and method (3). See
+                    make_transects and ColdPool.swath.
+    :returns:       ColdPool.swath result, plus fpath, utc and ok
+                    (False, with nothing else, if the case failed).
+    """
+    # Imported here, as wrfout uses this module
+    from wrfout import WRFOut
+    out = {'fpath':case['fpath'],'utc':case['utc']}
+    try:
+        CP = ColdPool(WRFOut(case['fpath']),case['utc'])
+        ii, jj = make_transects(CP.grid,case['lat'],case['lon'],case['heading'],
+                                case['length'],case.get('nswath',1),
+                                case.get('spacing',1.0))
+        out.update(CP.swath(ii,jj,env=case.get('env',False),
+                            method=case.get('method',3)))
+    except Exception:
+        print("Failed: {0} at {1}".format(case['fpath'],case['utc']))
+        traceback.print_exc()
+        out['ok'] = False
+        return out
+    out['ok'] = True
+    return out
+
+def cold_pool_batch(cases,ncpus=1):
+    """
+    Run cold_pool_case for many files and times, in parallel
+    if ncpus > 1.
+
+    :param cases:   list of dictionaries; see cold_pool_case
+    :type cases:    list
+    :param ncpus:   number of processes
+    :type ncpus:    int
+    :returns:       list of results, in the order of cases
+    """
+    if (ncpus > 1) and (len(cases) > 1):
+        pool = multiprocessing.Pool(min(ncpus,len(cases)))
+        try:
+            results = pool.map(cold_pool_case,cases,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(cold_pool_case,cases)
+    return results
@@ -0,0 +1,247 @@
+"""Multi-time composites of observed or simulated reflectivity.
+
+Frames are read one at a time (radar mosaics decoded in a process
+pool) and folded into running statistics in place: maximum, time of
+the maximum, mean, and the number of frames above each threshold. Only
+the running arrays and the frames in flight -- at most two per worker
+process -- are held in memory.
+
+Each frame is read once, even if it falls in several time windows.
+"""
+
+import os
+import collections
+import itertools
+import tempfile
+import multiprocessing
+import numpy as N
+
+from obs import Radar
+from wrfout import WRFOut
+from timeaxis import to_epoch
+
+def load_radar_frame(args):
+    """
+    Reflectivity (dBZ) of one radar mosaic, cropped to bounds.
+    Module-level, so it can be passed to a process pool.
+
+    :param args:    (time, radar data directory, bounds or False)
+    :returns:       (dBZ as float32, lats, lons)
+    """
+    utc, datadir, bounds = args
+    R = Radar(utc,datadir,bounds=bounds)
+    dBZ = R.get_dBZ(N.asarray(R.data,dtype=N.float32))
+    return dBZ.astype(N.float32), R.lats, R.lons
+
+def load_model_frame(args):
+    """
+    One time of a simulated reflectivity field.
+    Module-level, so it can be passed to a process pool.
+
+    :param args:    (path to wrfout file, variable, time, level,
+                    lat indices, lon indices)
+    :returns:       (field as float32, lats, lons)
+    """
+    fpath, vrbl, utc, level, lats, lons = args
+    W = WRFOut(fpath,lazy=True)
+    data = W.get(vrbl,utc=utc,level=level,lats=lats,lons=lons)[0,0,:,:]
+    data = N.ma.filled(N.ma.asarray(data,dtype=N.float32),N.nan)
+    glats = W.lats if lats is False else W.lats[lats,lons]
+    glons = W.lons if lons is False else W.lons[lats,lons]
+    return data, glats, glons
+
+class Composite(object):
+    """
+    Running per-pixel statistics of frames with the same shape.
+    NaN in a frame is missing data.
+    """
+    def __init__(self,thresholds=(),window=None):
+        """
+        :param thresholds:  count frames at or above each of these
+        :type thresholds:   list,tuple
+        :param window:      (first, last) epoch seconds of frames
+                            included, or None for all
+        :type window:       tuple
+        """
+        self.thresholds = list(thresholds)
+        self.window = window
+        self.times = []
+        self.max = None
+
+    def allocate(self,shape):
+        self.max = N.full(shape,N.nan,dtype=N.float32)
+        # Epoch seconds of the maximum; -1 where never valid
+        self.tmax = N.full(shape,-1,dtype=N.int64)
+        self.sum = N.zeros(shape,dtype=N.float64)
+        self.nvalid = N.zeros(shape,dtype=N.int32)
+        self.count = dict((thr,N.zeros(shape,dtype=N.int32))
+                            for thr in self.thresholds)
+
+    def contains(self,t):
+        return (self.window is None) or (self.window[0] <= t <= self.window[1])
+
+    def add(self,data,t):
+        """
+        Fold in one frame, valid at epoch time t. The earliest
+        time wins ties for the maximum.
+        """
+        if self.max is None:
+            self.allocate(data.shape)
+        elif data.shape != self.max.shape:
+            print("Frame shape {0} does not match {1}.".format(
+                    data.shape,self.max.shape))
+            raise Exception
+        valid = N.isfinite(data)
+        # NaN compares False, so missing points never replace anything
+        with N.errstate(invalid='ignore'):
+            newmax = valid & ~(data <= self.max)
+        self.max[newmax] = data[newmax]
+        self.tmax[newmax] = t
+        N.add(self.sum,data,out=self.sum,where=valid)
+        self.nvalid += valid
+        with N.errstate(invalid='ignore'):
+            for thr in self.thresholds:
+                self.count[thr] += (data >= thr)
+        self.times.append(t)
+
+    @property
+    def mean(self):
+        with N.errstate(invalid='ignore',divide='ignore'):
+            return N.where(self.nvalid > 0,self.sum/self.nvalid,N.nan)
+
+    def save(self,fpath,lats=None,lons=None):
+        """
+        Write max, time of max, mean, counts and times to an .npz
+        file, through a temporary file and a rename.
+        """
+        arrays = {'max':self.max,'tmax':self.tmax,'mean':self.mean,
+                    'nvalid':self.nvalid,'times':N.array(self.times,dtype=N.int64),
+                    'thresholds':N.array(self.thresholds,dtype=float)}
+        for n,thr in enumerate(self.thresholds):
+            arrays['count_{0}'.format(n)] = self.count[thr]
+        if lats is not None:
+            arrays['lats'] = lats
+            arrays['lons'] = lons
+        dirname = os.path.dirname(os.path.abspath(fpath))
+        fd, tmp = tempfile.mkstemp(dir=dirname,suffix='.npz')
+        with os.fdopen(fd,'wb') as f:
+            N.savez_compressed(f,**arrays)
+        os.rename(tmp,fpath)
+        print("Saved composite to {0}.".format(fpath))
+
+def bounded_imap(pool,func,args,inflight):
+    """
+    Like pool.imap, but with no more than inflight items submitted and
+    not yet taken by the caller, so results can't pile up in memory
+    when the workers are faster than the consumer.
+
+    :param inflight:    maximum number of outstanding items
+    :type inflight:     int
+    """
+    pending = collections.deque()
+    for a in args:
+        if len(pending) >= inflight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func,(a,)))
+    while pending:
+        yield pending.popleft().get()
+
+def build_composites(loader,args,times,windows=None,thresholds=(),ncpus=1):
+    """
+    Read frames with loader (in parallel if ncpus > 1) and fold each
+    into the composite of every window containing it. At most 2*ncpus
+    frames are read ahead of the fold.
+
+    :param loader:      load_radar_frame or load_model_frame
+    :param args:        loader arguments, one per frame
+    :type args:         list
+    :param times:       valid time of each frame (any format accepted
+                        by timeaxis.to_epoch)
+    :type times:        list
+    :param windows:     list of (first, last) times. None for one
+                        composite of all frames.
+    :type windows:      list
+    :param thresholds:  counts of frames at or above these values
+    :returns:           list of Composite (one per window), lats, lons
+    """
+    epochs = [int(to_epoch(t)[0]) for t in times]
+    if windows is None:
+        comps = [Composite(thresholds)]
+    else:
+        comps = [Composite(thresholds,(int(to_epoch(w0)[0]),int(to_epoch(w1)[0])))
+                    for w0,w1 in windows]
+    # Skip frames outside every window
+    keep = [n for n,t in enumerate(epochs) if any(c.contains(t) for c in comps)]
+    args = [args[n] for n in keep]
+    epochs = [epochs[n] for n in keep]
+
+    if (ncpus > 1) and (len(args) > 1):
+        nproc = min(ncpus,len(args))
+        pool = multiprocessing.Pool(nproc)
+        frames = bounded_imap(pool,loader,args,2*nproc)
+    else:
+        pool = None
+        frames = (loader(a) for a in args)
+    lats = lons = None
+    try:
+        # Frames come back in order, so each matches its time
+        for t, (data, flats, flons) in itertools.izip(epochs,frames):
+            if lats is None:
+                lats, lons = flats, flons
+            for c in comps:
+                if c.contains(t):
+                    c.add(data,t)
+            del data
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return comps, lats, lons
+
+def radar_composite(utcs,datadir,bounds=False,windows=None,thresholds=(),
+                        ncpus=1,fpath=False):
+    """
+    Composite of observed reflectivity (dBZ) over many times.
+
+    :param utcs:        times of the radar mosaics
+    :type utcs:         list
+    :param datadir:     directory of radar mosaics (see obs.Radar)
+    :type datadir:      str
+    :param bounds:      (Nlim, Elim, Slim, Wlim) to crop to, or False
+                        for the whole mosaic
+    :param windows:     see build_composites
+    :param thresholds:  dBZ thresholds to count exceedances of
+    :param ncpus:       number of processes decoding mosaics
+    :param fpath:       if given, save the composite(s) here (.npz).
+                        With several windows, '_0', '_1'... is added
+                        before the extension.
+    :returns:           list of Composite, lats, lons
+    """
+    args = [(t,datadir,bounds) for t in utcs]
+    comps, lats, lons = build_composites(load_radar_frame,args,utcs,windows,
+                                            thresholds,ncpus)
+    if fpath:
+        save_composites(comps,fpath,lats,lons)
+    return comps, lats, lons
+
+def model_composite(fpath_nc,utcs,vrbl='cref',level=False,lats=False,lons=False,
+                        windows=None,thresholds=(),ncpus=1,fpath=False):
+    """
+    Composite of simulated reflectivity (or any 2D field) from one
+    wrfout file over many times. Arguments are as for
+    radar_composite; lats and lons are index slices as in WRFOut.get.
+    """
+    args = [(fpath_nc,vrbl,t,level,lats,lons) for t in utcs]
+    comps, glats, glons = build_composites(load_model_frame,args,utcs,windows,
+                                            thresholds,ncpus)
+    if fpath:
+        save_composites(comps,fpath,glats,glons)
+    return comps, glats, glons
+
+def save_composites(comps,fpath,lats,lons):
+    if len(comps) == 1:
+        comps[0].save(fpath,lats,lons)
+        return
+    root, ext = os.path.splitext(fpath)
+    for n,c in enumerate(comps):
+        c.save('{0}_{1}{2}'.format(root,n,ext or '.npz'),lats,lons)
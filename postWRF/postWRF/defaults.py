@@ -1,6 +1,8 @@
 """ Default settings that are used when the user does not specify their own.
 
 """
+import os
+import tempfile
 
 class Defaults:
     def __init__(self):
@@ -11,6 +13,22 @@ class Defaults:
         self.dpi = 400
         self.plot_titles = 0   # Generate a title for each plot
         self.basemap_res = 'i'  # Resolution of basemap coasts etc
+        # Pickled Basemaps and projected x/y grids; False to disable.
+        # Must be a directory only you can write to (e.g. under ~/.cache).
+        self.basemap_cache_dir = False
+        self.cache_bytes = 256*1024**2 # Memory budget for WRFOut.get cache
+        self.open_netcdfs = 2 # Files kept open by each plot2D_batch worker
+        self.scratch_dir = tempfile.gettempdir() # For memory-mapped ensemble arrays
+        # On-disk store of derived fields from WRFOut.get (see store.py):
+        # False to disable, 'sidecar' for a directory next to each
+        # wrfout file, or the path of one shared directory.
+        self.field_store = False
+        self.field_store_bytes = 20*1024**3 # Evict least-recently used above this
+        self.field_store_identity = 'stat' # Or 'md5' to hash file contents
+        # Cropped radar mosaics and radar-to-grid weights; False to disable.
+        # Must be a directory only you can write to, as for basemap_cache_dir.
+        self.radar_cache_dir = False
+        self.radar_cache_bytes = 2*1024**3
 
         # Cross-section stuff
         # Min, max height used on z-axis, and tick increment
@@ -0,0 +1,355 @@
+"""Columnar on-disk store of difference energy (DKE/DTE) results.
+
+compute_diff_energy produces one value per pair of members
+(permutation) and time: a 2D map ('1D' vertical integration) or a
+domain total ('3D'). DiffEnergyStore keeps them in a directory holding
+
+* values.npy -- (perm,time) or (perm,time,y,x) array, read and written
+  as a memory map, NaN where nothing has been written yet;
+* done.npy -- (perm,time) booleans, set once a value is on disk;
+* index.json -- energy, type, units, times, files and the member pair
+  of each permutation.
+
+Values are written as they are computed, so an interrupted run resumes
+where it stopped. Averages over permutations and domain sums read the
+array in blocks of permutations rather than all at once.
+"""
+
+import os
+import json
+import tempfile
+import itertools
+import numpy as N
+
+import WEM.utils as utils
+from timeaxis import to_epoch
+
+STORE_VERSION = 2
+
+# Pressure-weighted column integrals, summed over the domain for '3D'
+UNITS = 'J/m2'
+# Pickles from older versions of compute_diff_energy held unweighted
+# sums of 0.5*(du**2+dv**2) (+ kappa*dT**2) over grid points
+LEGACY_UNITS = 'm2/s2 (unweighted sum)'
+
+# Bytes of values read at once by the aggregations
+BLOCK_BYTES = 64*1024**2
+
+def open_diff_energy(datadir,dataf=False):
+    """
+    Open difference energy data written by compute_diff_energy.
+
+    Older pickle files (a dictionary of permutations) are converted
+    to a store next to them the first time they are opened.
+
+    :param datadir:     directory holding the data
+    :type datadir:      str
+    :param dataf:       name of the store (or pickle file) in datadir.
+                        If False, datadir is the store itself.
+    :type dataf:        str,bool
+    :returns:           DiffEnergyStore
+    """
+    if dataf:
+        root = os.path.join(datadir,os.path.splitext(dataf)[0])
+    else:
+        root = datadir
+    if os.path.exists(os.path.join(root,'index.json')):
+        return DiffEnergyStore(root)
+    if os.path.exists(root+'.pickle'):
+        print("Converting {0}.pickle to a store.".format(root))
+        DATA = utils.load_data(os.path.dirname(root),os.path.basename(root),
+                                format='pickle')
+        return DiffEnergyStore.from_dict(root,DATA)
+    print("No difference energy data found at {0}.".format(root))
+    raise Exception
+
+class DiffEnergyStore(object):
+    """
+    Difference energy for every pair of members and every time.
+    """
+    def __init__(self,root,mode='r'):
+        """
+        Open an existing store.
+
+        :param root:    directory of the store
+        :type root:     str
+        :param mode:    'r' to read, 'r+' to also write values
+        :type mode:     str
+        """
+        self.root = root
+        self.mode = mode
+        with open(os.path.join(root,'index.json'),'r') as f:
+            self.index = json.load(f)
+        self.energy = self.index['energy']
+        self.ptype = self.index['ptype']
+        self.times = self.index['times']
+        self.files = self.index['files']
+        self.perms = [tuple(p) for p in self.index['perms']]
+        if 'units' in self.index:
+            self.units = self.index['units']
+        elif self.energy is None:
+            # Version 1 store converted from a pickle
+            self.units = LEGACY_UNITS
+        else:
+            self.units = UNITS
+        self.values = N.lib.format.open_memmap(os.path.join(root,'values.npy'),
+                                                mode=mode)
+        self.done = N.lib.format.open_memmap(os.path.join(root,'done.npy'),
+                                                mode=mode)
+
+    @classmethod
+    def create(cls,root,energy,ptype,times,files,shape2D=None,
+                upper=None,lower=None,resume=True,units=UNITS):
+        """
+        Create a store for all pairs of files, or reopen it to resume
+        an interrupted run.
+
+        :param root:        directory of the store
+        :type root:         str
+        :param energy:      'DKE' or 'DTE'
+        :param ptype:       '1D' (2D maps) or '3D' (domain totals)
+        :param times:       times of the values
+        :type times:        list
+        :param files:       abs paths to the wrfout files
+        :type files:        list
+        :param shape2D:     (y,x) of the maps, for '1D'
+        :type shape2D:      tuple
+        :param upper,lower: limits of vertical integration (hPa)
+        :param resume:      if a store with the same settings exists,
+                            keep the values already computed.
+        :type resume:       bool
+        :param units:       units of the values
+        :type units:        str
+        """
+        index = {'version':STORE_VERSION,'energy':energy,'ptype':ptype,
+                'units':units,
+                'times':[int(t) for t in to_epoch(times)],
+                'files':list(files),'upper':upper,'lower':lower,
+                'perms':[list(p) for p in
+                            itertools.combinations(range(len(files)),2)]}
+        fpath = os.path.join(root,'index.json')
+        if resume and os.path.exists(fpath):
+            with open(fpath,'r') as f:
+                old = json.load(f)
+            if old == json.loads(json.dumps(index)):
+                S = cls(root,mode='r+')
+                print("Resuming: {0} of {1} values already computed.".format(
+                        int(S.done.sum()),S.done.size))
+                return S
+            print("Settings differ from the store in {0}; starting again.".format(root))
+
+        utils.trycreate(root)
+        nperm = len(index['perms'])
+        nt = len(index['times'])
+        if ptype == '1D':
+            shape = (nperm,nt) + tuple(shape2D)
+            dtype = N.float32
+        else:
+            shape = (nperm,nt)
+            dtype = N.float64
+        values = N.lib.format.open_memmap(os.path.join(root,'values.npy'),
+                                            mode='w+',dtype=dtype,shape=shape)
+        values[:] = N.nan
+        values.flush()
+        done = N.lib.format.open_memmap(os.path.join(root,'done.npy'),
+                                            mode='w+',dtype=N.bool_,shape=(nperm,nt))
+        done.flush()
+        del values, done
+        # The index goes last: a store without one is not finished
+        write_json(fpath,index)
+        return cls(root,mode='r+')
+
+    @classmethod
+    def from_dict(cls,root,DATA):
+        """
+        Create a store from the dictionary of permutations made by
+        older versions of compute_diff_energy.
+        """
+        perms = sorted(DATA.keys(),key=int)
+        files = []
+        pairs = []
+        for perm in perms:
+            f1, f2 = DATA[perm]['file1'], DATA[perm]['file2']
+            for f in (f1,f2):
+                if f not in files:
+                    files.append(f)
+            pairs.append((files.index(f1),files.index(f2)))
+        first = N.asarray(DATA[perms[0]]['values'][0][0])
+        ptype = '1D' if first.ndim == 2 else '3D'
+        # The energy was not recorded in these files
+        S = cls.create(root,None,ptype,DATA[perms[0]]['times'],
+                        files,shape2D=first.shape,resume=False,
+                        units=LEGACY_UNITS)
+        for perm, pair in zip(perms,pairs):
+            n = S.perm_number(*pair)
+            for nt, v in enumerate(DATA[perm]['values']):
+                S.values[n,nt,...] = v[0]
+                S.done[n,nt] = True
+        S.flush()
+        return S
+
+    @property
+    def nperm(self):
+        return len(self.perms)
+
+    @property
+    def ntimes(self):
+        return len(self.times)
+
+    def perm_number(self,i,j):
+        """
+        Index of the pair of files i and j.
+        """
+        return self.perms.index((min(i,j),max(i,j)))
+
+    def time_index(self,utc):
+        """
+        Index of a time (any format accepted by timeaxis.to_epoch).
+        """
+        t = int(to_epoch(utc)[0])
+        if t not in self.times:
+            print("Time {0} is not in the store.".format(t))
+            raise Exception
+        return self.times.index(t)
+
+    def todo(self,t):
+        """
+        Permutations not yet computed for time index t.
+        """
+        return N.where(~self.done[:,t])[0]
+
+    def write(self,n,t,value):
+        """
+        Write one permutation's value at time index t.
+        It is only marked as done once flushed; see flush().
+        """
+        self.values[n,t,...] = value
+
+    def mark_done(self,perms,t):
+        """
+        Flush the values, then mark permutations as done at time t.
+        """
+        self.values.flush()
+        self.done[perms,t] = True
+        self.done.flush()
+
+    def flush(self):
+        self.values.flush()
+        self.done.flush()
+
+    def complete(self):
+        """
+        True if every permutation has been computed at every time.
+        """
+        return bool(self.done.all())
+
+    def blocks(self):
+        """
+        Slices of permutations small enough to read at once.
+        """
+        per_perm = max(self.values[0].nbytes,1)
+        step = max(1,int(BLOCK_BYTES//per_perm))
+        for start in range(0,self.nperm,step):
+            yield slice(start,min(start+step,self.nperm))
+
+    def perm_mean(self,t=None,perms=None):
+        """
+        Mean over permutations, skipping those not yet computed.
+
+        :param t:       time index. None for all times.
+        :type t:        int
+        :param perms:   permutation indices to average. None for all.
+        :type perms:    list,N.ndarray
+        :returns:       array of the mean, shaped like one
+                        permutation's values (at time t).
+        """
+        tsl = slice(None) if t is None else t
+        select = N.ones(self.nperm,dtype=bool)
+        if perms is not None:
+            select[:] = False
+            select[perms] = True
+        total = 0.0
+        count = 0
+        for sl in self.blocks():
+            done = N.array(self.done[sl,tsl])
+            done &= select[sl].reshape((-1,)+(1,)*(done.ndim-1))
+            if not done.any():
+                continue
+            block = N.array(self.values[sl,tsl],dtype=N.float64)
+            keep = done.reshape(done.shape + (1,)*(block.ndim-done.ndim))
+            total = total + N.where(keep,block,0.0).sum(axis=0)
+            count = count + done.sum(axis=0)
+        if N.all(count == 0):
+            print("No values computed yet.")
+            raise Exception
+        count = N.asarray(count,dtype=float)
+        count = count.reshape(count.shape + (1,)*(N.ndim(total)-count.ndim))
+        return total/count
+
+    def domain_sums(self):
+        """
+        Domain total of each permutation at each time. NaN where
+        not yet computed.
+
+        :returns:       (perm,time) array
+        """
+        if self.values.ndim == 2:
+            return N.array(self.values,dtype=N.float64)
+        out = N.empty((self.nperm,self.ntimes))
+        for sl in self.blocks():
+            out[sl] = N.array(self.values[sl],dtype=N.float64).sum(axis=(2,3))
+        return out
+
+    def perms_with(self,member):
+        """
+        Permutations that involve a member, and the other file of each.
+
+        :param member:  substring of the member's file path (e.g. the
+                        directory name of a parameterisation)
+        :type member:   str
+        :returns:       list of (permutation index, other file)
+        """
+        out = []
+        for n, (i,j) in enumerate(self.perms):
+            if member in self.files[i]:
+                out.append((n,self.files[j]))
+            elif member in self.files[j]:
+                out.append((n,self.files[i]))
+        return out
+
+    def to_dict(self):
+        """
+        The dictionary of permutations returned by older versions
+        of compute_diff_energy. Values are memory-mapped views.
+        """
+        DATA = {}
+        for n, (i,j) in enumerate(self.perms):
+            DATA[str(n)] = {'times':self.times,'file1':self.files[i],
+                            'file2':self.files[j],
+                            'values':[[self.values[n,t]] for t in range(self.ntimes)]}
+        return DATA
+
+def check_units(stores):
+    """
+    Raise an exception unless all stores hold values in the same
+    units, so old and new difference energy are never compared.
+
+    :returns:   the common units
+    """
+    units = set(S.units for S in stores)
+    if len(units) > 1:
+        print("Difference energy stores have different units: {0}. "
+                "Recompute the older data with compute_diff_energy.".format(
+                ', '.join(sorted(units))))
+        raise Exception
+    return units.pop()
+
+def write_json(fpath,obj):
+    """
+    Write obj as JSON through a temporary file and a rename.
+    """
+    dirname = os.path.dirname(fpath)
+    fd, tmp = tempfile.mkstemp(dir=dirname,suffix='.tmp')
+    with os.fdopen(fd,'w') as f:
+        json.dump(obj,f)
+    os.rename(tmp,fpath)
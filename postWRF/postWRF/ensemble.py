@@ -0,0 +1,206 @@
+"""One array holding a variable for every member of an ensemble.
+
+EnsembleCube finds the member files, allocates a single float32 array
+(member, time, level, lat, lon) -- optionally as a memory-mapped file on
+local scratch disk -- and fills it member by member, in parallel if
+asked. Statistics that need every member at once -- stats.std along
+time or space, stats.std_ttest and Profile.composite_profile -- work on
+slices of that array rather than building their own stacks. Statistics
+across members stream one member at a time instead (stats.EnsembleStats,
+stats.neighbourhood_probability).
+"""
+
+import os
+import glob
+import tempfile
+import multiprocessing
+import numpy as N
+
+from wrfout import WRFOut
+from defaults import Defaults
+
+def find_members(rootdir,dom=1,pattern='wrfout_d{0:02d}_*'):
+    """
+    Find one wrfout file per member below rootdir, where each member
+    is a subdirectory (e.g. rootdir/m01/wrfout_d01_...).
+
+    :param rootdir:     directory holding one folder per member
+    :type rootdir:      str
+    :param dom:         WRF domain
+    :type dom:          int
+    :returns:           sorted list of absolute paths
+    """
+    fpaths = glob.glob(os.path.join(rootdir,'*',pattern.format(dom)))
+    if not fpaths:
+        print("No members found in {0}.".format(rootdir))
+        raise Exception
+    return sorted(os.path.abspath(f) for f in fpaths)
+
+def load_member(args):
+    """
+    Read one member's data into float32, masked points as NaN.
+    Module-level, so it can be passed to a process pool.
+
+    If fpath_out is given, the data is written to that member's place
+    in the memory-mapped cube instead of being returned.
+
+    :param args:    (path to wrfout, member index, dictionary of
+                    arguments to WRFOut.get, path to cube or None)
+    :type args:     tuple
+    """
+    fpath, n, kwargs, fpath_out = args
+    W = WRFOut(fpath,lazy=True)
+    data = W.get(**kwargs)
+    data = N.ma.filled(N.ma.asarray(data,dtype=N.float32),N.nan)
+    if fpath_out is None:
+        return data
+    cube = N.lib.format.open_memmap(fpath_out,mode='r+')
+    cube[n,...] = data
+    cube.flush()
+    del cube
+    return None
+
+class EnsembleCube(object):
+    """
+    Float32 (member,time,level,lat,lon) array of one variable.
+    """
+    def __init__(self,paths=False,rootdir=False,dom=1,memmap=False,
+                    scratch=False):
+        """
+        :param paths:       absolute paths to each member's wrfout file.
+        :type paths:        list,tuple
+        :param rootdir:     if no paths are given, find members in the
+                            subdirectories of rootdir (see find_members).
+        :type rootdir:      str
+        :param dom:         WRF domain, used with rootdir
+        :type dom:          int
+        :param memmap:      keep the cube in a memory-mapped .npy file
+                            rather than in memory.
+        :type memmap:       bool
+        :param scratch:     directory for the memory-mapped file.
+                            Defaults().scratch_dir if False.
+        :type scratch:      str
+        """
+        if paths:
+            self.paths = list(paths)
+        elif rootdir:
+            self.paths = find_members(rootdir,dom=dom)
+        else:
+            print("Give paths or rootdir.")
+            raise Exception
+        self.nens = len(self.paths)
+        self.members = [os.path.basename(os.path.dirname(p)) for p in self.paths]
+        self.memmap = memmap
+        self.scratch = scratch or Defaults().scratch_dir
+        self.fpath = None
+        self.data = None
+        self.W = WRFOut(self.paths[0],lazy=True)
+
+    def load(self,vrbl,utc=False,level=False,lats=False,lons=False,
+                other=False,bounds=False,ncpus=1):
+        """
+        Fill the cube with vrbl from every member.
+
+        Arguments are as for WRFOut.get. bounds is a dictionary of
+        Nlim, Elim, Slim, Wlim to read only that region.
+
+        :param ncpus:   number of processes reading members. 1 reads
+                        them in turn.
+        :type ncpus:    int
+        :returns:       the cube, (member,time,level,lat,lon)
+        """
+        if bounds:
+            lats, lons = self.W.get_subdomain_idx(bounds['Nlim'],bounds['Elim'],
+                                                    bounds['Slim'],bounds['Wlim'])
+        self.vrbl = vrbl
+        self.lats = lats
+        self.lons = lons
+        kwargs = dict(vrbl=vrbl,utc=utc,level=level,lats=lats,lons=lons,other=other)
+
+        # The first member gives the shape
+        first = load_member((self.paths[0],0,kwargs,None))
+        self.allocate((self.nens,) + first.shape)
+        self.data[0,...] = first
+        del first
+
+        fpath_out = self.fpath if self.memmap else None
+        args = [(p,n,kwargs,fpath_out) for n,p in enumerate(self.paths) if n > 0]
+        if (ncpus > 1) and args:
+            if self.memmap:
+                self.data.flush()
+            pool = multiprocessing.Pool(min(ncpus,len(args)))
+            try:
+                results = pool.map(load_member,args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(load_member,args)
+        for (p,n,k,f), data in zip(args,results):
+            if data is not None:
+                self.data[n,...] = data
+        return self.data
+
+    def allocate(self,shape):
+        """
+        Create the empty cube, in memory or as a memory-mapped file.
+        """
+        self.close()
+        if self.memmap:
+            fd, self.fpath = tempfile.mkstemp(suffix='.npy',prefix='enscube_',
+                                                dir=self.scratch)
+            os.close(fd)
+            self.data = N.lib.format.open_memmap(self.fpath,mode='w+',
+                                                    dtype=N.float32,shape=shape)
+        else:
+            self.data = N.empty(shape,dtype=N.float32)
+
+    def close(self):
+        """
+        Release the cube, and delete its memory-mapped file.
+        """
+        self.data = None
+        if self.fpath is not None:
+            if os.path.exists(self.fpath):
+                os.remove(self.fpath)
+            self.fpath = None
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self,idx):
+        return self.data[idx]
+
+    def sel(self,member=slice(None),time=slice(None),level=slice(None),
+                lats=slice(None),lons=slice(None)):
+        """
+        Slice the cube by member, time, level and region.
+        Each argument is an index, slice or list of indices into
+        the loaded cube. Members can also be given by name.
+        """
+        if isinstance(member,basestring):
+            member = self.members.index(member)
+        elif isinstance(member,(list,tuple)):
+            member = [self.members.index(m) if isinstance(m,basestring) else m
+                        for m in member]
+        idx = [member,time,level,lats,lons]
+        # Fancy-index one axis at a time, so lists don't broadcast together
+        data = self.data
+        for ax in range(4,-1,-1):
+            sl = [slice(None),]*5
+            sl[ax] = idx[ax]
+            if isinstance(idx[ax],int):
+                sl[ax] = slice(idx[ax],idx[ax]+1)
+            data = data[tuple(sl)]
+        return data
+
+    def region(self,Nlim,Elim,Slim,Wlim):
+        """
+        Lat and lon slices of the loaded cube covering a bounding box,
+        for use in sel(). Only valid if the whole domain was loaded.
+        """
+        return self.W.get_subdomain_idx(Nlim,Elim,Slim,Wlim)
@@ -5,16 +5,117 @@ All matplotlib figures are subclasses of Figure.
 
 # Imports
 import numpy as N
+from lazyimport import select_backend
+select_backend()
 import matplotlib as M
 import matplotlib.pyplot as plt
 from mpl_toolkits.basemap import Basemap
 import pdb
 import os
+import copy
+import hashlib
+import tempfile
+import cPickle as pickle
 
 # Custom imports
 import WEM.utils as utils
 from defaults import Defaults
 
+# Basemaps made in this process, keyed by their settings. Creating one
+# (mostly reading the coastlines) is slow, so it is done once per map
+# and each figure gets a shallow copy drawing on its own axis. If
+# Defaults().basemap_cache_dir is set, they are also pickled there so
+# new processes can load them.
+BASEMAPS = {}
+# Projected x/y grids, keyed by Basemap key and the lat/lon arrays.
+BASEMAP_XY = {}
+
+def cache_name(*args):
+    """
+    File-safe name from a Basemap key and/or arrays.
+    """
+    h = hashlib.md5()
+    for a in args:
+        if isinstance(a,N.ndarray):
+            h.update(str(a.shape))
+            h.update(N.ascontiguousarray(a).tostring())
+        else:
+            h.update(repr(a))
+    return h.hexdigest()
+
+def load_cached(cache_dir,fname):
+    """
+    Unpickle fname from cache_dir; None if missing or unreadable.
+    Unpickling runs code, so nothing is loaded from a directory that
+    other users can write to (see utils.private_dir).
+    """
+    if not cache_dir or not utils.private_dir(cache_dir):
+        return None
+    fpath = os.path.join(cache_dir,fname)
+    if not os.path.exists(fpath):
+        return None
+    try:
+        with open(fpath,'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        print("Could not read cached {0}.".format(fpath))
+        return None
+
+def save_cached(cache_dir,fname,obj):
+    """
+    Pickle obj to cache_dir. Written to a temporary file and renamed,
+    so processes sharing the cache never read a partial file.
+    """
+    if not cache_dir or not utils.private_dir(cache_dir):
+        return
+    fd, tmp = tempfile.mkstemp(dir=cache_dir,suffix='.tmp')
+    with os.fdopen(fd,'wb') as f:
+        pickle.dump(obj,f,pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp,os.path.join(cache_dir,fname))
+
+def get_basemap(settings,ax,cache_dir=False):
+    """
+    Return a Basemap with these settings drawing on ax, reusing one
+    from this process or the disk cache if possible.
+
+    The shared instance is never changed; each call gets a shallow
+    copy, so earlier figures keep drawing on their own axes.
+
+    :param settings:    keyword arguments for Basemap (without ax)
+    :type settings:     dict
+    :param ax:          axis to draw on
+    :param cache_dir:   directory of pickled Basemaps. False to only
+                        keep them in this process.
+    :returns:           Basemap, and its key
+    """
+    key = tuple(sorted((k,float(v) if isinstance(v,(N.floating,N.integer)) else v)
+                        for k,v in settings.items()))
+    if key not in BASEMAPS:
+        fname = 'basemap_{0}.pickle'.format(cache_name(key))
+        m = load_cached(cache_dir,fname)
+        if m is None:
+            m = Basemap(**settings)
+            save_cached(cache_dir,fname,m)
+        BASEMAPS[key] = m
+    m = copy.copy(BASEMAPS[key])
+    m.ax = ax
+    return m, key
+
+def get_basemap_xy(m,key,lons,lats,cache_dir=False):
+    """
+    Projected x/y of 2D lon/lat arrays, cached like get_basemap.
+    """
+    xykey = (key,cache_name(lons,lats))
+    if xykey not in BASEMAP_XY:
+        fname = 'basemap_xy_{0}.pickle'.format(cache_name(*xykey))
+        xy = load_cached(cache_dir,fname)
+        if xy is None:
+            xy = m(lons,lats)
+            save_cached(cache_dir,fname,xy)
+        BASEMAP_XY[xykey] = xy
+    x, y = BASEMAP_XY[xykey]
+    return x.copy(), y.copy()
+
 class Figure(object):
     def __init__(self,nc=False,ax=0,fig=0,plotn=(1,1),layout='normal'):
         """
@@ -116,12 +217,10 @@ class Figure(object):
         if proj=='lcc':
             width_m = self.W.dx*(self.W.x_dim-1)
             height_m = self.W.dy*(self.W.y_dim-1)
-
-            m = Basemap(
+            settings = dict(
                 projection=proj,width=width_m,height=height_m,
                 lon_0=self.W.cen_lon,lat_0=self.W.cen_lat,lat_1=self.W.truelat1,
-                lat_2=self.W.truelat2,resolution=basemap_res,area_thresh=500,
-                ax=self.ax)
+                lat_2=self.W.truelat2,resolution=basemap_res,area_thresh=500)
         elif proj=='merc':
             if self.W and not Nlim and not isinstance(lats,N.ndarray):
                 Nlim,Elim,Slim,Wlim = self.W.get_limits()
@@ -131,14 +230,16 @@ class Figure(object):
                 Elim = lons.max()
                 Wlim = lons.min()
             
-            m = Basemap(projection=proj,
+            settings = dict(projection=proj,
                         llcrnrlat=Slim,
                         llcrnrlon=Wlim,
                         urcrnrlat=Nlim,
                         urcrnrlon=Elim,
                         lat_ts=(Nlim-Slim)/2.0,
-                        resolution='l',
-                        ax=self.ax)
+                        resolution='l')
+
+        cache_dir = self.D.basemap_cache_dir
+        m, key = get_basemap(settings,self.ax,cache_dir=cache_dir)
 
         m.drawcoastlines()
         m.drawstates()
@@ -149,8 +250,8 @@ class Figure(object):
 
         # s = slice(None,None,smooth)
         if self.W and not isinstance(lats,N.ndarray):
-            x,y = m(self.W.lons,self.W.lats)
+            x,y = get_basemap_xy(m,key,self.W.lons,self.W.lats,cache_dir)
         else:
-            x,y = m(*N.meshgrid(lons,lats))
+            x,y = get_basemap_xy(m,key,*N.meshgrid(lons,lats),cache_dir=cache_dir)
         # pdb.set_trace()
         return m, x, y
@@ -0,0 +1,226 @@
+"""Horizontal grid information shared between wrfout files.
+
+Members of an ensemble (or successive wrfout files from one run) sit
+on the same grid, so the 2D latitude/longitude arrays are identical.
+Rather than each WRFOut instance holding its own copy, one Grid is
+kept per grid signature in a module-level registry and shared.
+
+The signature is built from the projection attributes and dimension
+sizes in the netCDF header only, so it is cheap to compute.
+
+Grid also converts latitude/longitude to grid indices. For Lambert
+conformal, polar stereographic and Mercator grids this uses the WRF
+map projection equations, so it is exact anywhere in the domain.
+Other grids fall back to a nearest-neighbour search (KD-tree) on
+XLAT/XLONG.
+"""
+
+import numpy as N
+
+# Global attributes that define the projection and placement of a grid.
+PROJ_ATTRS = ('MAP_PROJ','DX','DY','CEN_LAT','CEN_LON','TRUELAT1',
+                'TRUELAT2','STAND_LON','MOAD_CEN_LAT','POLE_LAT','POLE_LON',
+                'I_PARENT_START','J_PARENT_START','PARENT_GRID_RATIO')
+
+# Earth radius used by WRF (m)
+EARTH_RADIUS = 6370000.0
+
+# Registry of grids that have been loaded in this process.
+REGISTRY = {}
+
+def grid_signature(nc):
+    """
+    Create a hashable signature for the grid of an open netCDF file.
+
+    :param nc:      open wrfout Dataset
+    :type nc:       netCDF4.Dataset
+    :returns:       tuple of (attribute, value) pairs and dimension sizes
+    """
+    attrs = nc.ncattrs()
+    sig = []
+    for attr in PROJ_ATTRS:
+        if attr in attrs:
+            val = getattr(nc,attr)
+            # Round floats so trivially different headers still match
+            if isinstance(val,(float,N.floating)):
+                val = round(float(val),6)
+            elif isinstance(val,(N.integer,N.ndarray)):
+                val = N.asarray(val).ravel()[0].item()
+            sig.append((attr,val))
+    for dim in ('south_north','west_east'):
+        sig.append((dim,len(nc.dimensions[dim])))
+    return tuple(sig)
+
+def get_grid(nc):
+    """
+    Return the shared Grid for an open netCDF file, creating it
+    (and loading XLAT/XLONG) only if this grid has not been seen.
+    """
+    sig = grid_signature(nc)
+    if sig not in REGISTRY:
+        REGISTRY[sig] = Grid(nc,sig)
+    return REGISTRY[sig]
+
+def clear_registry():
+    """Forget all grids loaded so far."""
+    REGISTRY.clear()
+
+class Grid(object):
+    """
+    Latitude/longitude arrays and projection information for one grid.
+    """
+    def __init__(self,nc,sig=None):
+        """
+        :param nc:      open wrfout Dataset to read the grid from
+        :type nc:       netCDF4.Dataset
+        :param sig:     grid signature (computed if not given)
+        :type sig:      tuple
+        """
+        if sig is None:
+            sig = grid_signature(nc)
+        self.signature = sig
+        self.attrs = dict((k,v) for k,v in sig)
+
+        # Might fail if only one time?
+        self.lats = nc.variables['XLAT'][0,...]
+        self.lons = nc.variables['XLONG'][0,...]
+
+        self.lats1D = self.lats[:,len(self.lats)/2]
+        self.lons1D = self.lons[len(self.lons)/2,:]
+
+        self.y_dim, self.x_dim = self.lats.shape
+        self.kdtree = None
+
+    def project(self,lats,lons):
+        """
+        Forward map projection to grid-point units.
+
+        Only differences between points are meaningful; see latlon_to_ij.
+
+        :param lats,lons:   latitudes and longitudes (degrees)
+        :type lats,lons:    float,N.ndarray
+        :returns:           x, y (in grid points), or None if the
+                            projection is not supported.
+        """
+        proj = self.attrs.get('MAP_PROJ',None)
+        lats = N.asarray(lats,dtype=float)
+        lons = N.asarray(lons,dtype=float)
+        rebydx = EARTH_RADIUS/self.attrs['DX']
+        rad = N.pi/180.0
+        truelat1 = self.attrs.get('TRUELAT1',None)
+        hemi = 1.0 if truelat1 >= 0.0 else -1.0
+        stdlon = self.attrs.get('STAND_LON',self.attrs.get('CEN_LON'))
+
+        if proj == 1:
+            # Lambert conformal
+            truelat2 = self.attrs['TRUELAT2']
+            t1 = truelat1*rad
+            if abs(truelat1-truelat2) > 0.1:
+                cone = ((N.log10(N.cos(t1)) - N.log10(N.cos(truelat2*rad)))/
+                        (N.log10(N.tan((45.0-abs(truelat1)/2.0)*rad)) -
+                        N.log10(N.tan((45.0-abs(truelat2)/2.0)*rad))))
+            else:
+                cone = N.sin(abs(t1))
+            deltalon = (lons - stdlon + 180.0) % 360.0 - 180.0
+            rm = (rebydx*N.cos(t1)/cone*
+                    (N.tan((90.0*hemi-lats)*rad/2.0)/
+                    N.tan((90.0*hemi-truelat1)*rad/2.0))**cone)
+            arg = cone*deltalon*rad
+            x = rm*N.sin(arg)
+            y = -hemi*rm*N.cos(arg)
+        elif proj == 2:
+            # Polar stereographic
+            scale_top = 1.0 + hemi*N.sin(truelat1*rad)
+            rm = (rebydx*N.cos(lats*rad)*scale_top/
+                    (1.0 + hemi*N.sin(lats*rad)))
+            alo = (lons - (stdlon + 90.0))*rad
+            x = rm*N.cos(alo)
+            y = hemi*rm*N.sin(alo)
+        elif proj == 3:
+            # Mercator
+            clain = N.cos(truelat1*rad)
+            deltalon = (lons - stdlon + 180.0) % 360.0 - 180.0
+            x = rebydx*clain*deltalon*rad
+            y = rebydx*clain*N.log(N.tan((45.0+lats/2.0)*rad))
+        else:
+            return None
+        return x, y
+
+    def latlon_to_ij(self,lats,lons):
+        """
+        Fractional grid indices of many points at once.
+
+        The projection is anchored at the first grid point
+        (XLAT[0,0], XLONG[0,0]). Grids with other projections use
+        the nearest grid point, so the indices are whole numbers.
+
+        :param lats,lons:   latitudes and longitudes (degrees)
+        :type lats,lons:    float,list,N.ndarray
+        :returns:           i (x, west_east) and j (y, south_north)
+                            as float arrays shaped like lats.
+        """
+        lats = N.asarray(lats,dtype=float)
+        lons = N.asarray(lons,dtype=float)
+        xy = self.project(lats,lons)
+        if xy is None:
+            j, i = self.nearest_kdtree(lats,lons)
+            return i.astype(float), j.astype(float)
+        x0, y0 = self.project(self.lats[0,0],self.lons[0,0])
+        return xy[0]-x0, xy[1]-y0
+
+    def get_kdtree(self):
+        """
+        KD-tree of grid points on the unit sphere, built on first use.
+        Indices into it are for the flattened (y,x) grid.
+        """
+        if self.kdtree is None:
+            from scipy.spatial import cKDTree
+            self.kdtree = cKDTree(latlon_to_xyz(self.lats,self.lons).reshape(-1,3))
+        return self.kdtree
+
+    def nearest_kdtree(self,lats,lons):
+        """
+        Nearest grid point by KD-tree search on XLAT/XLONG,
+        using 3D positions on the unit sphere.
+
+        :returns:   y and x indices, shaped like lats.
+        """
+        lats = N.asarray(lats,dtype=float)
+        dist, idx = self.get_kdtree().query(latlon_to_xyz(lats,lons).reshape(-1,3))
+        y, x = N.unravel_index(idx,self.lats.shape)
+        return y.reshape(lats.shape), x.reshape(lats.shape)
+
+    def get_idx(self,lats,lons,clip=True):
+        """
+        Nearest grid point (y,x) to each of many points.
+
+        :param lats,lons:   latitudes and longitudes (degrees)
+        :type lats,lons:    float,list,N.ndarray
+        :param clip:        move points outside the domain to the
+                            nearest edge. If False, they are given
+                            index -1.
+        :type clip:         bool
+        :returns:           y, x -- int arrays shaped like lats
+                            (ints for a single point).
+        """
+        i, j = self.latlon_to_ij(lats,lons)
+        x = N.round(i).astype(int)
+        y = N.round(j).astype(int)
+        outside = (x < 0) | (x >= self.x_dim) | (y < 0) | (y >= self.y_dim)
+        if clip:
+            x = N.clip(x,0,self.x_dim-1)
+            y = N.clip(y,0,self.y_dim-1)
+        else:
+            x = N.where(outside,-1,x)
+            y = N.where(outside,-1,y)
+        if x.ndim == 0:
+            return int(y), int(x)
+        return y, x
+
+def latlon_to_xyz(lats,lons):
+    """
+    Positions on the unit sphere, stacked on the last axis.
+    """
+    la = N.radians(N.asarray(lats,dtype=float))
+    lo = N.radians(N.asarray(lons,dtype=float))
+    return N.stack((N.cos(la)*N.cos(lo),N.cos(la)*N.sin(lo),N.sin(la)),axis=-1)
@@ -0,0 +1,205 @@
+"""Vectorised interpolation of columns to new vertical levels.
+
+The bracketing indices and weights depend only on the vertical
+coordinate (e.g. pressure) and the target levels. They are computed
+once by VerticalInterpolator, which can then be applied to any number
+of variables on the same grid.
+"""
+
+import numpy as N
+
+class VerticalInterpolator(object):
+    """
+    Linear interpolation along one axis of a 3D or 4D array.
+    """
+    def __init__(self,coord,targets,axis=0,log=False,outside='mask'):
+        """
+        :param coord:       vertical coordinate, e.g. pressure (Pa) or
+                            height (m). Must be monotonic along axis, in
+                            the same direction for every column.
+        :type coord:        numpy.ndarray
+        :param targets:     target levels, in the units of coord. Either a
+                            scalar/1D sequence (same for every column) or
+                            an array shaped like coord with the number of
+                            targets on axis (a different level per column).
+        :type targets:      float,list,numpy.ndarray
+        :param axis:        vertical axis of coord (and of the data)
+        :type axis:         int
+        :param log:         interpolate linearly in log(coord), e.g. for
+                            pressure.
+        :type log:          bool
+        :param outside:     'mask' masks targets outside the column (e.g.
+                            below ground); 'clamp' uses the nearest end value.
+        :type outside:      str
+        """
+        coord = N.asarray(coord,dtype=float)
+        self.axis = axis % coord.ndim
+        self.shape = coord.shape
+        nz = coord.shape[self.axis]
+
+        c = N.moveaxis(coord,self.axis,0).reshape(nz,-1)
+        self.ncol = c.shape[1]
+
+        # Work with a coordinate increasing along the axis
+        self.flip = c[0].mean() > c[-1].mean()
+        if self.flip:
+            c = c[::-1]
+
+        if N.ndim(targets) <= 1:
+            t = N.atleast_1d(N.asarray(targets,dtype=float))[:,N.newaxis]
+            self.percolumn = False
+        else:
+            t = N.moveaxis(N.asarray(targets,dtype=float),self.axis,0)
+            t = t.reshape(t.shape[0],-1)
+            self.percolumn = True
+        self.nlv = t.shape[0]
+
+        if log:
+            c = N.log(c)
+            t = N.log(t)
+
+        cols = N.arange(self.ncol)
+        self.lower = N.zeros((self.nlv,self.ncol),dtype=int)
+        self.weight = N.zeros((self.nlv,self.ncol))
+        self.mask = N.zeros((self.nlv,self.ncol),dtype=bool)
+        for l in range(self.nlv):
+            tl = t[l]
+            # Index of first level at or above the target
+            k = (c < tl).sum(axis=0)
+            k = N.clip(k,1,nz-1)
+            c0 = c[k-1,cols]
+            c1 = c[k,cols]
+            w = (tl-c0)/(c1-c0)
+            below = tl < c[0]
+            above = tl > c[-1]
+            if outside == 'clamp':
+                w = N.clip(w,0.0,1.0)
+            self.lower[l] = k-1
+            self.weight[l] = w
+            self.mask[l] = below | above
+
+        self.outside = outside
+        self.cols = cols
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the indices and weights, for cache budgets.
+        """
+        return (self.lower.nbytes + self.weight.nbytes + self.mask.nbytes +
+                self.cols.nbytes)
+
+    def __call__(self,data):
+        """
+        Interpolate data, shaped like coord, to the target levels.
+
+        :returns:       array with the vertical axis replaced by the
+                        target levels. Masked array if outside='mask'.
+        """
+        data = N.asarray(data)
+        if data.shape != self.shape:
+            print("Data shape {0} does not match coordinate {1}.".format(
+                    data.shape,self.shape))
+            raise Exception
+        nz = data.shape[self.axis]
+        d = N.moveaxis(data,self.axis,0).reshape(nz,-1)
+        if self.flip:
+            d = d[::-1]
+
+        d0 = d[self.lower,self.cols]
+        d1 = d[self.lower+1,self.cols]
+        out = d0 + self.weight*(d1-d0)
+
+        outshape = list(N.moveaxis(data,self.axis,0).shape)
+        outshape[0] = self.nlv
+        out = N.moveaxis(out.reshape(outshape),0,self.axis)
+
+        if self.outside == 'mask':
+            mask = N.moveaxis(self.mask.reshape(outshape),0,self.axis)
+            out = N.ma.masked_array(out,mask=mask)
+        return out
+
+def interp_to_levels(coord,data,targets,axis=0,log=False,outside='mask'):
+    """
+    One-off interpolation of data to target levels of coord.
+    See VerticalInterpolator.
+    """
+    VI = VerticalInterpolator(coord,targets,axis=axis,log=log,outside=outside)
+    return VI(data)
+
+def layer_winds(u,v,coord,layers,scale=1.0,log=False):
+    """
+    Bulk shear and layer-mean wind for several layers, for all columns.
+
+    Wind at the layer bounds is interpolated linearly in coord
+    (log(coord) if log). A bound beyond the ends of a column uses the
+    end value. The mean wind is the coord-weighted average of the
+    piecewise-linear profile between the bounds, e.g. height-weighted
+    for heights or pressure-weighted for pressure.
+
+    :param u,v:     (time,level,...) wind components
+    :param coord:   vertical coordinate shaped like u, monotonic along
+                    the level axis (increasing or decreasing)
+    :param layers:  list of (bottom,top) in units of coord/scale. A bound
+                    may be an array with one value per column.
+    :type layers:   list,tuple
+    :param scale:   factor from layer units to coord units (e.g. 1000
+                    for km to m, 100 for hPa to Pa)
+    :type scale:    float
+    :returns:       list (one per layer) of dictionaries of ushear,
+                    vshear, shear, umean, vmean and meanwind. Each
+                    is 4D with one level.
+    """
+    u = N.asarray(u,dtype=float)
+    v = N.asarray(v,dtype=float)
+    coord = N.asarray(coord,dtype=float)
+
+    # Bounds of all layers as one set of per-column targets:
+    # (time,2*nlayers,lat,lon) ordered bottom, top, bottom, top...
+    colshape = (coord.shape[0],)+coord.shape[2:]
+    bounds = []
+    for layer in layers:
+        for b in layer:
+            b = N.ones(colshape)*N.asarray(b,dtype=float)*scale
+            bounds.append(b[:,N.newaxis,...])
+    bounds = N.concatenate(bounds,axis=1)
+
+    VI = VerticalInterpolator(coord,bounds,axis=1,log=log,outside='clamp')
+    ub = VI(u)
+    vb = VI(v)
+
+    # The integration below needs coord increasing along the level
+    # axis (pressure decreases with model level)
+    down = coord[:,-1:,...] < coord[:,:1,...]
+    if down.any():
+        coord = N.where(down,coord[:,::-1,...],coord)
+        u = N.where(down,u[:,::-1,...],u)
+        v = N.where(down,v[:,::-1,...],v)
+
+    winds = []
+    for n in range(len(layers)):
+        bot = slice(2*n,2*n+1)
+        top = slice(2*n+1,2*n+2)
+        LW = {}
+        LW['ushear'] = ub[:,top,...] - ub[:,bot,...]
+        LW['vshear'] = vb[:,top,...] - vb[:,bot,...]
+        LW['shear'] = N.sqrt(LW['ushear']**2 + LW['vshear']**2)
+
+        # Profile clipped to the layer, with the bounds at each end
+        cbot = bounds[:,bot,...]
+        ctop = bounds[:,top,...]
+        upward = cbot <= ctop
+        lo = N.where(upward,cbot,ctop)
+        hi = N.where(upward,ctop,cbot)
+        for comp, data, dbound in (('umean',u,ub),('vmean',v,vb)):
+            dlo = N.where(upward,dbound[:,bot,...],dbound[:,top,...])
+            dhi = N.where(upward,dbound[:,top,...],dbound[:,bot,...])
+            dc = N.where(coord<lo,dlo,N.where(coord>hi,dhi,data))
+            cc = N.clip(coord,lo,hi)
+            dc = N.concatenate((dlo,dc,dhi),axis=1)
+            cc = N.concatenate((lo,cc,hi),axis=1)
+            depth = N.where(hi>lo,hi-lo,N.nan)
+            LW[comp] = N.trapz(dc,cc,axis=1)[:,N.newaxis,...]/depth
+        LW['meanwind'] = N.sqrt(LW['umean']**2 + LW['vmean']**2)
+        winds.append(LW)
+    return winds
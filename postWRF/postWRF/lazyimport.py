@@ -0,0 +1,74 @@
+"""Deferred imports of the plotting stack.
+
+matplotlib, pyplot, Basemap and the plotting modules are slow to import
+and are not needed by scripts that only compute (DKE, SAL, statistics).
+main.py refers to them through LazyImport, so they are imported the
+first time a plotting method uses them.
+
+select_backend picks a non-interactive backend (Agg) when there is no
+display, so the same scripts work on cluster nodes.
+"""
+
+import os
+import sys
+import importlib
+
+# Package of the plotting modules, '' if they are imported top-level
+PACKAGE = __name__.rpartition('.')[0]
+
+def select_backend():
+    """
+    Use the Agg backend if there is no display, unless the backend has
+    already been fixed (pyplot imported, or MPLBACKEND set).
+    """
+    if ('matplotlib.pyplot' in sys.modules) or os.environ.get('MPLBACKEND'):
+        return
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+        import matplotlib
+        matplotlib.use('Agg')
+
+class LazyImport(object):
+    """
+    Stand-in for a module, or a name in a module, that is imported on
+    first use (attribute access or call).
+    """
+    def __init__(self,module,name=None):
+        """
+        :param module:  module to import, e.g. 'matplotlib.pyplot'.
+                        A leading '.' is a module of this package,
+                        e.g. '.birdseye'.
+        :type module:   str
+        :param name:    name in that module, e.g. 'BirdsEye'. None
+                        stands in for the module itself.
+        :type name:     str
+        """
+        self.__dict__['_module'] = module
+        self.__dict__['_name'] = name
+        self.__dict__['_obj'] = None
+
+    def _load(self):
+        if self._obj is None:
+            select_backend()
+            module = self._module
+            if module.startswith('.') and not PACKAGE:
+                module = module[1:]
+            obj = importlib.import_module(module,PACKAGE or None)
+            if self._name is not None:
+                obj = getattr(obj,self._name)
+            self.__dict__['_obj'] = obj
+        return self._obj
+
+    def __getattr__(self,attr):
+        return getattr(self._load(),attr)
+
+    def __setattr__(self,attr,value):
+        setattr(self._load(),attr,value)
+
+    def __call__(self,*args,**kwargs):
+        return self._load()(*args,**kwargs)
+
+    def __repr__(self):
+        if self._obj is None:
+            return "<lazy import of {0}>".format(
+                    '.'.join(x for x in (self._module,self._name) if x))
+        return repr(self._obj)
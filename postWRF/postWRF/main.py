@@ -28,30 +28,88 @@ import numpy as N
 import os
 import pdb
 import time
-import matplotlib as M
-M.use('gtkagg')
-import matplotlib.pyplot as plt
+import traceback
+import multiprocessing
 
 from wrfout import WRFOut
-from figure import Figure
-from birdseye import BirdsEye
-from ruc import RUC
-from skewt import SkewT
-from skewt import Profile
 #import scales
 from defaults import Defaults
 import WEM.utils as utils
-from xsection import CrossSection
-from clicker import Clicker
-import maps
 import stats
-from scales import Scales
-from obs import Obs
-from obs import Radar
-from ts import TimeSeries
+from energystore import open_diff_energy, check_units
+from coldpool import ColdPool, make_transects
+
+# The plotting stack is imported when a plotting method first needs it,
+# so compute-only scripts start quickly and work without a display.
+from lazyimport import LazyImport
+M = LazyImport('matplotlib')
+plt = LazyImport('matplotlib.pyplot')
+Figure = LazyImport('.figure','Figure')
+BirdsEye = LazyImport('.birdseye','BirdsEye')
+RUC = LazyImport('.ruc','RUC')
+SkewT = LazyImport('.skewt','SkewT')
+Profile = LazyImport('.skewt','Profile')
+CrossSection = LazyImport('.xsection','CrossSection')
+Clicker = LazyImport('.clicker','Clicker')
+maps = LazyImport('.maps')
+Scales = LazyImport('.scales','Scales')
+Obs = LazyImport('.obs','Obs')
+Radar = LazyImport('.obs','Radar')
+TimeSeries = LazyImport('.ts','TimeSeries')
+radar_composite = LazyImport('.composite','radar_composite')
 
 # TODO: Make this awesome
 
+# WRFEnviron kept by each plot2D_batch worker process
+_batch_env = None
+
+def plot2D_worker(job):
+    """
+    Render one plot2D_batch item and time it.
+    Module-level, so it can be passed to a process pool. Each process
+    keeps one WRFEnviron, so open files and Basemaps stay warm between
+    items.
+
+    :param job:     dictionary of plot2D arguments
+    :type job:      dict
+    :returns:       manifest entry (dict)
+    """
+    global _batch_env
+    if _batch_env is None:
+        _batch_env = WRFEnviron()
+        _batch_env.netcdfs = collections.OrderedDict()
+    entry = dict((k,job[k]) for k in ('vrbl','utc','level','ncdir','outdir'))
+    level = job['level']
+    if level:
+        level = _batch_env.get_level_string(level)
+    fname = _batch_env.create_fname(job['vrbl'],job['utc'],level,
+                        other=job.get('other',False),f_prefix=job.get('f_prefix',False),
+                        f_suffix=job.get('f_suffix',False))
+    entry['fpath'] = os.path.join(job['outdir'],fname)
+    entry['pid'] = os.getpid()
+    t0 = time.time()
+    try:
+        _batch_env.plot2D(**job)
+        entry['ok'] = True
+        entry['error'] = None
+    except Exception:
+        entry['ok'] = False
+        entry['error'] = traceback.format_exc()
+        print("Failed: {0}".format(entry['fpath']))
+    entry['seconds'] = time.time() - t0
+    plt.close('all')
+    return entry
+
+def close_netcdf(W):
+    """
+    Close a data instance's netCDF file and empty its field cache.
+    """
+    if hasattr(W,'cache'):
+        W.cache.clear()
+    nc = getattr(W,'nc',None)
+    if nc is not None:
+        nc.close()
+
 class WRFEnviron(object):
     """Main environment API.
     """
@@ -60,6 +118,10 @@ class WRFEnviron(object):
         """
         # Set defaults
         self.D = Defaults()
+        # Open netCDF files, keyed by path, least recently used first.
+        # None reopens them for every plot; plot2D_batch workers keep
+        # the last few (Defaults().open_netcdfs).
+        self.netcdfs = None
 
         #self.font_prop = getattr(self.C,'font_prop',self.D.font_prop)
         #self.usetex = getattr(self.C,'usetex',self.D.usetex)
@@ -179,25 +241,29 @@ class WRFEnviron(object):
             
         # Data
         self.W = self.get_netcdf(ncdir,ncf=ncf,nct=nct,dom=dom)
-        # lats, lons = self.W.get_limited_domain(bounding)
+        # Only read the part of the domain that is plotted
+        if Nlim:
+            lat_sl, lon_sl = self.W.get_subdomain_idx(Nlim,Elim,Slim,Wlim)
+            lats = self.W.lats1D[lat_sl]
+            lons = self.W.lons1D[lon_sl]
+        else:
+            lat_sl, lon_sl = False, False
+            lats = False
+            lons = False
+
         # import pdb; pdb.set_trace()
         if vrbl == 'accum_precip':
             if not accum_hr:
                 raise Exception("Set accumulation period")
             data = self.W.compute_accum_rain(utc,accum_hr)[0,0,:,:]
+            if Nlim:
+                data = data[lat_sl,lon_sl]
         else:
-            data = self.W.get(vrbl,utc=utc,level=level,lons=False,lats=False,other=other)[0,0,:,:]
+            data = self.W.get(vrbl,utc=utc,level=level,lons=lon_sl,lats=lat_sl,other=other)[0,0,:,:]
         # Needs to be shape [1,1,nlats,nlons].
         if smooth>1:
             data = stats.gauss_smooth(data,smooth)
 
-        if Nlim:
-            data,lats,lons = utils.return_subdomain(data,self.W.lats1D,self.W.lons1D,
-                                Nlim,Elim,Slim,Wlim,fmt='latlon')
-        else:
-            lats = False
-            lons = False
-
         # Scales
         cmap, clvs = self.get_cmap_clvs(vrbl,level,cmap=cmap,clvs=clvs)
 
@@ -212,6 +278,73 @@ class WRFEnviron(object):
                     extend=extend,save=save,cblabel=cblabel)
         return cb
 
+    def plot2D_batch(self,vrbls,utcs,levels=(False,),ncdirs=False,outdirs=False,
+                        ncpus=1,**kwargs):
+        """
+        Make plot2D figures for every combination of variable, level,
+        time and netCDF directory (e.g. ensemble member), in a pool
+        of worker processes.
+
+        Jobs are grouped by file, so a worker reuses its open WRFOut
+        and Basemap for consecutive items. A failed item is recorded
+        in the manifest and does not stop the batch.
+
+        :param vrbls:       variables
+        :type vrbls:        list,tuple
+        :param utcs:        times, in any format accepted by plot2D
+        :type utcs:         list,tuple
+        :param levels:      levels, in any format accepted by plot2D
+        :type levels:       list,tuple
+        :param ncdirs:      directories of netCDF data, one per member
+        :type ncdirs:       str,list,tuple
+        :param outdirs:     output directory for each of ncdirs, or one
+                            directory for all.
+        :type outdirs:      str,list,tuple
+        :param ncpus:       number of worker processes. 1 plots in
+                            this process.
+        :type ncpus:        int
+        :param kwargs:      other arguments passed to plot2D for
+                            every item (ncf, dom, clvs, Nlim...).
+        :returns:           list of dictionaries (one per item) with
+                            vrbl, utc, level, ncdir, outdir, fpath,
+                            ok, error (traceback), seconds and pid.
+        """
+        ncdirs = utils.get_sequence(ncdirs)
+        if isinstance(outdirs,(list,tuple)):
+            if len(outdirs) != len(ncdirs):
+                raise Exception("Give one outdir per ncdir.")
+        else:
+            outdirs = [outdirs,]*len(ncdirs)
+        if not isinstance(levels,(list,tuple)):
+            levels = [levels,]
+        utcs = utils.get_sequence(utcs,sos=1)
+
+        jobs = []
+        for ncdir, outdir in zip(ncdirs,outdirs):
+            for vrbl, level, utc in itertools.product(vrbls,levels,utcs):
+                job = dict(kwargs)
+                job.update(vrbl=vrbl,utc=utc,level=level,ncdir=ncdir,
+                            outdir=outdir or os.path.expanduser("~"))
+                jobs.append(job)
+
+        print("Plotting {0} figures with {1} process(es).".format(len(jobs),ncpus))
+        t0 = time.time()
+        if ncpus > 1:
+            # Contiguous chunks keep each file on one worker
+            chunksize = max(1,len(jobs)//(ncpus*4))
+            pool = multiprocessing.Pool(ncpus)
+            try:
+                manifest = pool.map(plot2D_worker,jobs,chunksize)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            manifest = map(plot2D_worker,jobs)
+        nfail = len([m for m in manifest if not m['ok']])
+        print("Batch took {0:.1f} seconds; {1} of {2} failed.".format(
+                time.time()-t0,nfail,len(jobs)))
+        return manifest
+
     def get_cmap_clvs(self,vrbl,level,clvs=False,cmap=False):
        
         if clvs is False and cmap is False:
@@ -277,7 +410,8 @@ class WRFEnviron(object):
 
         return fname
 
-    def get_netcdf(self,ncdir,ncf=False,nct=False,dom=1,path_only=False):
+    def get_netcdf(self,ncdir,ncf=False,nct=False,dom=1,path_only=False,
+                    reuse=True):
         """
         Returns the WRFOut, ECMWF, or RUC instance.
 
@@ -299,6 +433,11 @@ class WRFEnviron(object):
                             This is useful to loop over ensemble members and
                             generate a list of files.
         :type path_only:    bool
+        :param reuse:       return the already-open instance if this
+                            environment keeps files open (self.netcdfs).
+                            Beyond self.D.open_netcdfs files, the least
+                            recently used is closed and its cache emptied.
+        :type reuse:        bool
         """
         if ncf:
             fpath = os.path.join(ncdir,ncf)
@@ -309,6 +448,18 @@ class WRFEnviron(object):
 
         if path_only:
             return fpath
+        elif reuse and (getattr(self,'netcdfs',None) is not None):
+            if fpath in self.netcdfs:
+                # Move to most-recently-used end
+                W = self.netcdfs.pop(fpath)
+            else:
+                W = self.get_netcdf(ncdir,ncf=ncf,nct=nct,dom=dom,
+                                        path_only=False,reuse=False)
+            self.netcdfs[fpath] = W
+            while len(self.netcdfs) > max(self.D.open_netcdfs,1):
+                oldpath, old = self.netcdfs.popitem(last=False)
+                close_netcdf(old)
+            return W
         else:
             # Check for WRF or RUC
             # nc = Dataset(wrfpath)
@@ -357,7 +508,8 @@ class WRFEnviron(object):
         :type datadir:  str
         :param outdir:  root directory for plots
         :type outdir:   str
-        :param dataf:   file name of data file, if ambiguous
+        :param dataf:   name of the store (or older pickle file) in
+                        datadir. If False, datadir is the store.
         :type dataf:    str
         :param f_prefix: custom filename prefix for output. Ignore if False.
         :type f_prefix: bool,str
@@ -376,43 +528,29 @@ class WRFEnviron(object):
         :type ax:           bool,matplotlib.axis
 
         """
-        DATA = utils.load_data(datadir,dataf,format='pickle')
+        S = open_diff_energy(datadir,dataf)
 
         if isinstance(utc,(list,tuple)):
             utc = calendar.timegm(utc)
 
+        f1 = S.files[S.perms[0][0]]
+        try:
+            W1 = WRFOut(f1)
+        except:
+            # From a bug that added an erroneous dir
+            # for STCH members in 2013, maybe fixed?
+            ff = f1.split('/')
+            del ff[-2]
+            W1 = WRFOut('/'.join(ff))
+
         if utc==False:
-            for perm in DATA:
-                looptimes = DATA[perm]['times']
-                f1 = DATA[perm]['file1']
-                try:
-                    W1 = WRFOut(f1)
-                except:
-                    # From a bug that added an erroneous dir
-                    # for STCH members in 2013, maybe fixed?
-                    ff = f1.split('/')
-                    del ff[-2]
-                    W1 = WRFOut('/'.join(ff))
-                break
+            looptimes = S.times
         else:
             looptimes = (utc,)
 
         for t in looptimes:
-            for pn,perm in enumerate(DATA):
-                # f2 = DATA[perm]['file2']
-                # Get times and info about nc files
-                # First time to save power
-                
-                permtimes = DATA[perm]['times']
-
-                # Find array for required time
-                x = N.where(N.array(permtimes)==t)[0][0]
-                data = DATA[perm]['values'][x][0]
-                if not pn:
-                    stack = data
-                else:
-                    stack = N.dstack((data,stack))
-                    stack_average = N.average(stack,axis=2)
+            # Average over all permutations, read in blocks
+            stack_average = S.perm_mean(S.time_index(t))
 
             #birdseye plot with basemap of DKE/DTE
             F = BirdsEye(W1,ax=ax,fig=fig)
@@ -530,12 +668,13 @@ class WRFEnviron(object):
         varying by a sensitivity - e.g. error growth involving
         all members that use a certain parameterisation.
 
-        Requires data file in pickle format already produced by
-        [method here].
+        Requires data already produced by
+        :func:`WEM.postWRF.postWRF.stats.compute_diff_energy`
+        (a store, or an older pickle file).
 
-        :param datadir:     folder with pickle data
+        :param datadir:     folder with the data
         :type datadir:      str
-        :param dataf:       data (pickle) filename if ambiguous
+        :param dataf:       name of the store (or pickle file) in datadir
         :type dataf:        str
         :param ensnames:    names of each ensemble member, e.g. the
                             parameterisation scheme, the initial
@@ -552,11 +691,10 @@ class WRFEnviron(object):
         TODO: is sensitivity/ensnames variable OK to be optional?
         """
         ofname = '2D'
-        DATA = utils.load_data(datadir,dataf,format='pickle')
-
-        for perm in DATA:
-            times = DATA[perm]['times']
-            break
+        S = open_diff_energy(datadir,dataf)
+        times = S.times
+        # Domain total of each permutation at each time
+        sums = S.domain_sums()
 
         times_tup = [time.gmtime(t) for t in times]
         time_str = ["{2:02d}/{3:02d}".format(*t) for t in times_tup]
@@ -570,40 +708,23 @@ class WRFEnviron(object):
             AVE = {}
 
             for sens in sensitivity:
-                ave_stack = 0
                 n_sens = len(sensitivity)-1
                 colourlist = utils.generate_colours(M,n_sens)
                 M.rcParams['axes.color_cycle'] = colourlist
                 fig = plt.figure()
                 labels = []
                 #SENS['sens'] = {}
-                for perm in DATA:
-                    f1 = DATA[perm]['file1']
-                    f2 = DATA[perm]['file2']
-
-                    if sens in f1:
-                        f = f2
-                    elif sens in f2:
-                        f = f1
-                    else:
-                        f = 0
-
-                    if f:
-                        subdirs = f.split('/')
-                        labels.append(subdirs[-2])
-                        data = self.make_1D(DATA[perm]['values'])
-
-                        plt.plot(times,data)
-                        # pdb.set_trace()
-                        ave_stack = utils.vstack_loop(N.asarray(data),ave_stack)
-                    else:
-                        pass
-
-                # pdb.set_trace()
+                perms = []
+                for perm, f in S.perms_with(sens):
+                    subdirs = f.split('/')
+                    labels.append(subdirs[-2])
+                    plt.plot(times,sums[perm])
+                    perms.append(perm)
+
                 n_sens += 1
                 colourlist = utils.generate_colours(M,n_sens)
                 M.rcParams['axes.color_cycle'] = colourlist
-                AVE[sens] = N.average(ave_stack,axis=0)
+                AVE[sens] = N.average(sums[perms],axis=0)
                 labels.append('Average')
                 plt.plot(times,AVE[sens],'k')
 
@@ -612,6 +733,7 @@ class WRFEnviron(object):
                     plt.ylim(ylim)
                 plt.gca().set_xticks(times[::2])
                 plt.gca().set_xticklabels(time_str[::2])
+                plt.gca().set_ylabel("Difference energy ({0})".format(S.units))
 
                 vrbl_long = '{0}_{1}'.format(ofname,sens)
                 fname = self.create_fname(vrbl_long,f_prefix=f_prefix,f_suffix=f_suffix)
@@ -640,6 +762,7 @@ class WRFEnviron(object):
                 plt.ylim(ylim)
             plt.gca().set_xticks(times[::2])
             plt.gca().set_xticklabels(time_str[::2])
+            plt.gca().set_ylabel("Difference energy ({0})".format(S.units))
             vrbl_long = '{0}_Averages'.format(ofname,)
             fname = self.create_fname(vrbl_long,f_prefix=f_prefix,f_suffix=f_suffix)
             fpath = os.path.join(outdir,fname)
@@ -653,19 +776,17 @@ class WRFEnviron(object):
 
         else:
             fig = plt.figure()
-            ave_stack = 0
-            for perm in DATA:
-                data = self.make_1D(DATA[perm]['values'])
+            for data in sums:
                 plt.plot(times,data,'blue')
-                ave_stack = utils.vstack_loop(N.asarray(data),ave_stack)
 
-            total_ave = N.average(ave_stack,axis=0)
+            total_ave = N.average(sums,axis=0)
             plt.plot(times,total_ave,'black')
 
             if ylim:
                 plt.ylim(ylim)
             plt.gca().set_xticks(times[::2])
             plt.gca().set_xticklabels(time_str[::2])
+            plt.gca().set_ylabel("Difference energy ({0})".format(S.units))
             allstr = 'allmembers'
             vrbl_long = '{0}_{1}'.format(ofname,allstr)
             fname = self.create_fname(vrbl_long,f_prefix=f_prefix,f_suffix=f_suffix)
@@ -911,24 +1032,23 @@ class WRFEnviron(object):
         level = self.get_level_string(level)
         # Data
         self.W = self.get_netcdf(ncdir,ncf=ncf,nct=nct,dom=dom)
-        # lats, lons = self.W.get_limited_domain(bounding)
-        lons = False
-        lats = False
+        # Only read the part of the domain that is plotted
+        if isinstance(bounding,dict):
+            lat_sl, lon_sl = self.W.get_subdomain_idx(bounding['Nlim'],
+                                bounding['Elim'],bounding['Slim'],bounding['Wlim'])
+            lats = self.W.lats1D[lat_sl]
+            lons = self.W.lons1D[lon_sl]
+        else:
+            lat_sl, lon_sl = False, False
+            lons = False
+            lats = False
 
         if level=='2000hPa':
-            U = self.W.get('U10',utc,level,lons,lats)[0,0,:,:]
-            V = self.W.get('V10',utc,level,lons,lats)[0,0,:,:]
+            U = self.W.get('U10',utc,level,lat_sl,lon_sl)[0,0,:,:]
+            V = self.W.get('V10',utc,level,lat_sl,lon_sl)[0,0,:,:]
         else:
-            U = self.W.get('U',utc,level,lons,lats)[0,0,:,:]
-            V = self.W.get('V',utc,level,lons,lats)[0,0,:,:]
-
-        if isinstance(bounding,dict):
-            U,lats,lons = utils.return_subdomain(U,self.W.lats1D,self.W.lons1D,
-                                bounding['Nlim'],bounding['Elim'],
-                                bounding['Slim'],bounding['Wlim'],fmt='latlon')
-            V,lats,lons = utils.return_subdomain(V,self.W.lats1D,self.W.lons1D,
-                                bounding['Nlim'],bounding['Elim'],
-                                bounding['Slim'],bounding['Wlim'],fmt='latlon')
+            U = self.W.get('U',utc,level,lat_sl,lon_sl)[0,0,:,:]
+            V = self.W.get('V',utc,level,lat_sl,lon_sl)[0,0,:,:]
         # else:
             # lats = False
             # lons = False
@@ -1021,56 +1141,26 @@ class WRFEnviron(object):
         """
         Create threshold contour plots.
         """
-        enssize = len(ensemble)
         self.ensemble = ensemble # Dictionary
-        nens = 0
-        for ens in self.ensemble:
-            print("Computing for ensemble member {0}.".format(ens))
-            # pdb.set_trace()
-            if self.ensemble[ens]['control']:
-                continue
-
-            nens += 1.0
-
-            self.ensemble[ens]['data'] = WRFOut(self.ensemble[ens]['path'])
-            if nens==1:
-                examplewrf = self.ensemble[ens]['data']
-            tidx = self.ensemble[ens]['data'].return_tidx_range(itime,ftime)
-            ens_data = self.ensemble[ens]['data'].get(vrbl,utc=tidx,level=level,
-                                                lons=False,lats=False)
-            for n in range(ens_data.shape[0]):
-                if isinstance(smooth,str):
-                    if smooth == 'maxfilter':
-                        ens_data[n,0,:,:] = stats.max_filter(ens_data[n,0,:,:],size=11)
-            if nens == 1:
-                w,x,y,z = ens_data.shape
-                all_ens_data = N.zeros((enssize,w,x,y,z))
-                del w,x,y,z
-            all_ens_data[nens-1,...] = ens_data
-
-        if overunder == 'over':
-            # True/False if member meets condition
-            bool_arr = N.where(all_ens_data > threshold,1,0)
-            # Find maximum for all times
-            max_arr = N.amax(bool_arr,axis=1)
-            # Count members that exceed the threshold
-            # And convert to percentage
-            count_arr = N.sum(max_arr,axis=0)
-            percent_arr = 100*(count_arr/nens)
-
-        elif overunder == 'under':
-            # True/False if member meets condition
-            bool_arr = N.where(all_ens_data < threshold,1,0)
-            # Find maximum for all times
-            max_arr = N.amin(bool_arr,axis=1)
-            # Count members that exceed the threshold
-            # And convert to percentage
-            count_arr = N.sum(max_arr,axis=0)
-            percent_arr = 100*(count_arr/nens)
-
+        paths = [self.ensemble[ens]['path'] for ens in sorted(self.ensemble)
+                    if not self.ensemble[ens]['control']]
+        examplewrf = WRFOut(paths[0],lazy=True)
+        tidx = examplewrf.return_tidx_range(itime,ftime)
+
+        # stats.max_filter(size=11): a circle of radius 5 grid points,
+        # taking the maximum for both 'over' and 'under'
+        if smooth == 'maxfilter':
+            radius = 5
         else:
+            radius = 0
+        if overunder not in ('over','under'):
             raise Exception("Pick over or under for threshold comparison.")
-            
+        nbhd = 'any' if overunder == 'over' else 'all'
+        probs = stats.neighbourhood_probability(paths,vrbl,threshold,radii=radius,
+                                    utc=tidx,level=level,overunder=overunder,
+                                    footprint='circle',neighbourhood=nbhd)
+        percent_arr = 100*probs['prob'][0,0]
+
         output = percent_arr[0,:,:] 
       
         # fname = self.create_fname(vrbl,utc,level,f_suffix=f_suffix, f_prefix=f_prefix,other=other)
@@ -1217,7 +1307,8 @@ class WRFEnviron(object):
     def cold_pool_strength(self,utc,ncdir=False,outdir=False,ncf=False,nct=False,
                             f_prefix=False,f_suffix=False,
                             swath_width=100,bounding=False,dom=1,
-                            twoplot=False,fig=0,axes=0,dz=0):
+                            twoplot=False,fig=0,axes=0,dz=0,
+                            centroid=False,heading=False,length=False,env=False):
         """
         Pick A, B points on sim ref overlay
         This sets the angle between north and line AB
@@ -1253,10 +1344,25 @@ class WRFEnviron(object):
                             If tuple/list of length two, this is the
                             first and second axis, if twoplot is True.
         :type ax:           bool,matplotlib.axis
+        :param centroid:    (lat,lon) of the middle of the swath. If given,
+                            transects are placed from this, heading and
+                            length instead of being drawn with the mouse
+                            (see coldpool.make_transects).
+        :type centroid:     tuple
+        :param heading:     direction from the rear of the system to the
+                            environment ahead (degrees from north).
+        :type heading:      float
+        :param length:      length of each transect (km).
+        :type length:       float
+        :param env:         (lat,lon) to sample the environment at, with
+                            centroid. If False, the environment of each
+                            transect is ahead of its gust front.
+        :type env:          bool,tuple
 
         """
         # Initialise
         self.W = self.get_netcdf(ncdir,ncf=ncf,nct=nct,dom=dom)
+        return_ax = 0
 
         # keyword arguments for plots
         line_kwargs = {}
@@ -1282,36 +1388,46 @@ class WRFEnviron(object):
 
             return_ax = 1
 
-        # Plot sim ref, send basemap axis to clicker function
-        # F = BirdsEye(self.W)
+        if centroid:
+            # No display needed: transects from the centroid and heading
+            CP = ColdPool(self.W,utc)
+            ii, jj = make_transects(self.W.grid,centroid[0],centroid[1],heading,
+                                    length,nswath=swath_width)
+            result = CP.swath(ii,jj,env=env)
+            cps = CP.on_grid(result,'depth' if dz else 'C')
+            line_cf = None
+        else:
+            # Plot sim ref, send basemap axis to clicker function
+            # F = BirdsEye(self.W)
+
+            cref_data = self.W.get('cref',utc=utc,level=False,lons=False,lats=False)[0,0,:,:]
+            # self.data = F.plot2D('cref',utc,2000,dom,outpath,save=False,return_data=1)
+            cmap, clvs = self.get_cmap_clvs('cref',level=False)
+            # import pdb; pdb.set_trace()
+            C = Clicker(self.W,data=cref_data,cmap=cmap,clvs=clvs,**line_kwargs)
+            # C.fig.tight_layout()
 
-        cref_data = self.W.get('cref',utc=utc,level=False,lons=False,lats=False)[0,0,:,:]
-        # self.data = F.plot2D('cref',utc,2000,dom,outpath,save=False,return_data=1)
-        cmap, clvs = self.get_cmap_clvs('cref',level=False)
-        # import pdb; pdb.set_trace()
-        C = Clicker(self.W,data=cref_data,cmap=cmap,clvs=clvs,**line_kwargs)
-        # C.fig.tight_layout()
-
-        # Line from front to back of system
-        C.draw_line()
-        # C.draw_box()
-        lon0, lat0 = C.bmap(C.x0,C.y0,inverse=True)
-        lon1, lat1 = C.bmap(C.x1,C.y1,inverse=True)
-
-        # Pick location for environmental dpt
-        # C.click_x_y()
-        # Here, it is the end of the cross-section
-        lon_env, lat_env = C.bmap(C.x1, C.y1, inverse=True)
-        y_env,x_env,exactlat,exactlon = utils.getXY(self.W.lats1D,self.W.lons1D,lat_env,lon_env)
-        # Create the cross-section object
-        X = CrossSection(self.W,lat0,lon0,lat1,lon1)
-
-        # Ask user the line-normal box width (self.km)
-        #C.set_box_width(X)
-
-        # Compute the grid (DX x DY)
-        cps = self.W.cold_pool_strength(X,utc,swath_width=swath_width,env=(x_env,y_env),dz=dz)
-        # import pdb; pdb.set_trace()
+            # Line from front to back of system
+            C.draw_line()
+            # C.draw_box()
+            lon0, lat0 = C.bmap(C.x0,C.y0,inverse=True)
+            lon1, lat1 = C.bmap(C.x1,C.y1,inverse=True)
+
+            # Pick location for environmental dpt
+            # C.click_x_y()
+            # Here, it is the end of the cross-section
+            lon_env, lat_env = C.bmap(C.x1, C.y1, inverse=True)
+            y_env,x_env = self.W.get_XY(lat_env,lon_env)
+            # Create the cross-section object
+            X = CrossSection(self.W,lat0,lon0,lat1,lon1)
+
+            # Ask user the line-normal box width (self.km)
+            #C.set_box_width(X)
+
+            # Compute the grid (DX x DY)
+            cps = self.W.cold_pool_strength(X,utc,swath_width=swath_width,env=(x_env,y_env),dz=dz)
+            # import pdb; pdb.set_trace()
+            line_cf = C.cf
 
         # Plot this array
         CPfig = BirdsEye(self.W,**cps_kwargs)
@@ -1348,7 +1464,7 @@ class WRFEnviron(object):
             P2.save(outdir,fname+"_twopanel")
 
         if return_ax:
-            return C.cf, cf2
+            return line_cf, cf2
 
     def spaghetti(self,vrbl,utc,level,contour,ncdirs,outdir,
                     bounding=False,dom=1):
@@ -1704,13 +1820,19 @@ class WRFEnviron(object):
     def plot_radar(self,utc,datadir,outdir=False,Nlim=False,Elim=False,
                     Slim=False,Wlim=False,ncdir=False,nct=False,
                     ncf=False,dom=1,composite=False,locations=False,
-                    fig=False,ax=False,cb=True,compthresh=False):
+                    fig=False,ax=False,cb=True,compthresh=False,ncpus=1,
+                    comp_fpath=False):
         """
         Plot verification radar.
 
         composite allows plotting max reflectivity for a number of times
         over a given domain.
         This can show the evolution of a system.
+        The mosaics are folded into the composite one at a time (see
+        composite.py), decoded in ncpus processes.
+
+        :param comp_fpath:  if given, also save the composite (max,
+                            time of max, mean, counts) to this .npz file.
         
         Need to rewrite so plotting is done in birdseye.
         """
@@ -1721,23 +1843,16 @@ class WRFEnviron(object):
             Nlim, Elim, Slim, Wlim = self.W.get_limits()
 
         if composite:
-            radars = {}
-            for n,t in enumerate(utc):
-                radars[n] = Radar(t,datadir)
-                if compthresh:
-                    dBZ = radars[n].get_dBZ(radars[n].data)
-                    radars[n].data[dBZ<compthresh] = 0
-                if n == 0:
-                    stack = radars[0].data
-                else:
-                    stack = N.dstack((stack,radars[n].data))
-                # import pdb; pdb.set_trace()
-
-            max_pixel = N.max(stack,axis=2)
+            bounds = (Nlim,Elim,Slim,Wlim) if Nlim else False
+            comps, lats, lons = radar_composite(utc,datadir,bounds=bounds,
+                                    ncpus=ncpus,fpath=comp_fpath)
+            dBZ = comps[0].max
             # Create new instance for the methods
             # Overwrite the data to become composite
-            R = Radar(utc[-1],datadir)
-            R.data = max_pixel
+            R = Radar(utc[-1],datadir,bounds=bounds)
+            if compthresh:
+                dBZ[dBZ<compthresh] = R.get_dBZ(0)
+            R.data = R.get_pixel(dBZ)
 
         else:  
             R = Radar(utc,datadir)
@@ -1777,19 +1892,14 @@ class WRFEnviron(object):
         M.rcParams['axes.color_cycle'] = cols
         labels = []
 
+        stores = dict((ex,open_diff_energy(infodict[ex]['datadir'],
+                        infodict[ex]['dataf'])) for ex in infodict)
+        units = check_units(stores.values())
         for ex in infodict:
-            times = False
-            data = utils.load_data(infodict[ex]['datadir'],infodict[ex]['dataf'],
-                                    format='pickle')
+            S = stores[ex]
+            times = S.times
             labels.append(ex)
-            ave_stack = False
-            for perm in data:
-                if not times:
-                    times = data[perm]['times']
-                permdata = self.make_1D(data[perm]['values'])
-                ave_stack = utils.vstack_loop(N.asarray(permdata),ave_stack)
-
-            total_ave = N.average(ave_stack,axis=0)
+            total_ave = N.average(S.domain_sums(),axis=0)
 
             try:
                 ls = infodict[ex]['ls']
@@ -1809,7 +1919,6 @@ class WRFEnviron(object):
         time_str = ["{2:02d}/{3:02d}".format(*t) for t in times_tup]
         plt.gca().set_xticks(times[::1])
         plt.gca().set_xticklabels(time_str[::1])
-        units = r'$m^{2}s^{-2}$'
         plt.gca().set_ylabel("Difference {0} Energy ({1})".format(
                             energy.title(),units))
         fname = self.create_fname('allensembles',f_prefix=f_prefix,f_suffix=f_suffix)
@@ -1850,22 +1959,24 @@ class WRFEnviron(object):
         # Data
         self.W1 = self.get_netcdf(ncdir1,ncf=ncf1,nct=nct,dom=dom)
         self.W2 = self.get_netcdf(ncdir2,ncf=ncf2,nct=nct,dom=dom)
-        # lats, lons = self.W.get_limited_domain(bounding)
-        data1 = self.W1.get(vrbl,utc=utc,level=level,lons=False,lats=False,other=other)[0,0,:,:]
-        data2 = self.W2.get(vrbl,utc=utc,level=level,lons=False,lats=False,other=other)[0,0,:,:]
+        # Only read the part of the domain that is plotted
+        if Nlim:
+            lat_sl, lon_sl = self.W1.get_subdomain_idx(Nlim,Elim,Slim,Wlim)
+            lats = self.W1.lats1D[lat_sl]
+            lons = self.W1.lons1D[lon_sl]
+        else:
+            lat_sl, lon_sl = False, False
+            lats = False
+            lons = False
+
+        data1 = self.W1.get(vrbl,utc=utc,level=level,lons=lon_sl,lats=lat_sl,other=other)[0,0,:,:]
+        data2 = self.W2.get(vrbl,utc=utc,level=level,lons=lon_sl,lats=lat_sl,other=other)[0,0,:,:]
         data = data1-data2
         # import pdb; pdb.set_trace()
         # Needs to be shape [1,1,nlats,nlons].
         if smooth>1:
             data = stats.gauss_smooth(data,smooth)
 
-        if Nlim:
-            data,lats,lons = utils.return_subdomain(data,self.W1.lats1D,self.W1.lons1D,
-                                Nlim,Elim,Slim,Wlim,fmt='latlon')
-        else:
-            lats = False
-            lons = False
-
         # Scales
         if clvs is False and cmap is False:
             S = Scales(vrbl,level)
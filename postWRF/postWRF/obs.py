@@ -5,10 +5,13 @@ radar reflectivity, severe weather reports.
 
 
 import scipy.ndimage
+import scipy.sparse
 import pdb
 from mpl_toolkits.basemap import Basemap
 import numpy as N
 import os
+import hashlib
+import tempfile
 import WEM.utils as utils
 import matplotlib.pyplot as plt
 import calendar
@@ -16,6 +19,88 @@ import glob
 import datetime
 
 from birdseye import BirdsEye
+from defaults import Defaults
+from store import get_store, file_identity
+from stations import bilinear_weights, weight_matrix
+
+# Mosaic-to-grid regridding weights built or loaded in this process,
+# keyed by (mosaic signature, grid signature).
+REGRID = {}
+
+def decode_png(png):
+    """
+    Decode a radar mosaic to its 2D array of pixel values.
+    """
+    return scipy.ndimage.imread(png)
+
+def png_shape(png):
+    """
+    (rows, columns) of a PNG, read from its header only.
+    """
+    from PIL import Image
+    ncol, nrow = Image.open(png).size
+    return nrow, ncol
+
+def read_wld(wld):
+    """
+    World file of a mosaic: x pixel size, y rotation, x rotation,
+    y pixel size, and x and y of the centre of the upper left pixel.
+    """
+    with open(wld,'r') as f:
+        return [float(l) for l in f.readlines()[:6]]
+
+def regrid_weights(src_lats,src_lons,lats,lons):
+    """
+    Sparse bilinear weights from a regular lat/lon grid to points.
+
+    :param src_lats:    1D latitudes of the source rows (decreasing
+                        or increasing, evenly spaced)
+    :param src_lons:    1D longitudes of the source columns
+    :param lats,lons:   2D latitudes and longitudes of the points
+    :returns:           csr matrix, (number of points, source size).
+                        Points outside the source use its edge.
+    """
+    nrow, ncol = len(src_lats), len(src_lons)
+    # Fractional row and column of each point
+    j = (lats.ravel()-src_lats[0])/(src_lats[-1]-src_lats[0])*(nrow-1)
+    i = (lons.ravel()-src_lons[0])/(src_lons[-1]-src_lons[0])*(ncol-1)
+    cols, wts = bilinear_weights(i,j,(nrow,ncol))
+    return weight_matrix(cols,wts,nrow*ncol)
+
+def get_regrid_weights(src_sig,src_lats,src_lons,grid,cache_dir=False):
+    """
+    Shared regridding weights from a mosaic to a WRF grid, from this
+    process, the disk cache, or built and saved.
+
+    :param src_sig:     signature of the (cropped) mosaic grid
+    :type src_sig:      tuple
+    :param grid:        WRF grid
+    :type grid:         grid.Grid
+    :param cache_dir:   directory of saved weights. False to only keep
+                        them in this process. Not used unless only
+                        this user can write to it (utils.private_dir).
+    """
+    key = (src_sig,grid.signature)
+    if key in REGRID:
+        return REGRID[key]
+    fpath = None
+    if cache_dir and utils.private_dir(cache_dir):
+        h = hashlib.md5(repr(key)).hexdigest()
+        fpath = os.path.join(cache_dir,'regrid_{0}.npz'.format(h))
+        if os.path.exists(fpath):
+            try:
+                REGRID[key] = scipy.sparse.load_npz(fpath).tocsr()
+                return REGRID[key]
+            except Exception:
+                print("Could not read cached weights {0}.".format(fpath))
+    matrix = regrid_weights(src_lats,src_lons,grid.lats,grid.lons)
+    if fpath is not None:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir,suffix='.npz')
+        os.close(fd)
+        scipy.sparse.save_npz(tmp,matrix)
+        os.rename(tmp,fpath)
+    REGRID[key] = matrix
+    return matrix
 
 class Obs(object):
     """
@@ -25,16 +110,28 @@ class Obs(object):
         self.fpath = fpath
 
 class Radar(Obs):
-    def __init__(self,utc,datapath):
+    def __init__(self,utc,datapath,bounds=False,cache_dir=None):
         """
         Composite radar archive data from mesonet.agron.iastate.edu.
 
+        If bounds are given, only that part of the mosaic is kept, and
+        it is saved to the cache so the PNG is decoded only once for
+        each bounding box.
+
         :param datapath:        Absolute path to folder or .png file
         :type datapath:         str
         :param wldpath:         Absolute path to .wld file
         :type wldpath:          str
         :param fmt:             format of data - N0Q or N0R
         :type fmt:              str
+        :param bounds:          (Nlim, Elim, Slim, Wlim) to crop to
+        :type bounds:           tuple,bool
+        :param cache_dir:       directory of cropped mosaics and
+                                regridding weights. None uses
+                                Defaults().radar_cache_dir; False
+                                disables the disk cache. It is only
+                                used if no other user can write to it.
+        :type cache_dir:        str,bool
         """
         self.utc = utc
         fname_root = self.get_radar_fname() 
@@ -54,31 +151,30 @@ class Radar(Obs):
         png = fpath+'.png'
         wld = fpath+'.wld'
 
-        self.data = scipy.ndimage.imread(png) 
-
-        self.xlen, self.ylen = self.data.shape
+        D = Defaults()
+        if cache_dir is None:
+            cache_dir = D.radar_cache_dir
+        if cache_dir and not utils.private_dir(cache_dir):
+            cache_dir = False
+        self.cache_dir = cache_dir
+
+        if bounds:
+            # Only the header is needed until the crop is known
+            self.xlen, self.ylen = png_shape(png)
+            self.data = None
+        else:
+            self.data = decode_png(png)
+            self.xlen, self.ylen = self.data.shape
 
         # Metadata
-        f = open(wld,'r').readlines()
-
         # pixel size in the x-direction in map units/pixel
-        self.xpixel = float(f[0])
-
         # rotation about y-axis
-        self.roty = float(f[1])
-
         # rotation about x-axis
-        self.rotx = float(f[2])
-
         # pixel size in the y-direction in map units,
-        self.ypixel = float(f[3])
-
-        # x-coordinate of the center of the upper left pixel
-        self.ulx = float(f[4])
+        # x- and y-coordinate of the center of the upper left pixel
+        (self.xpixel, self.roty, self.rotx, self.ypixel,
+                self.ulx, self.uly) = read_wld(wld)
 
-        # y-coordinate of the center of the upper left pixel
-        self.uly = float(f[5])
-       
         # lower right corner
         self.lrx = self.ulx + self.ylen*self.xpixel
         self.lry = self.uly + self.xlen*self.ypixel
@@ -92,6 +188,62 @@ class Radar(Obs):
         self.lats = N.linspace(self.lry,self.uly,self.xlen)[::-1]
         self.lons = N.linspace(self.ulx,self.lrx,self.ylen)
 
+        # Rows and columns of the full mosaic that are kept
+        self.crop = (slice(0,self.xlen),slice(0,self.ylen))
+        if bounds:
+            self.crop_to(png,bounds,D.radar_cache_bytes)
+
+    def crop_to(self,png,bounds,max_bytes,margin=2):
+        """
+        Keep only the part of the mosaic inside bounds (plus a margin
+        of pixels), reading it from the cache if it was decoded before.
+        """
+        Nlim, Elim, Slim, Wlim = bounds
+        rows = sorted((utils.closest(self.lats,Nlim),utils.closest(self.lats,Slim)))
+        cols = sorted((utils.closest(self.lons,Wlim),utils.closest(self.lons,Elim)))
+        rsl = slice(max(rows[0]-margin,0),min(rows[1]+margin+1,self.xlen))
+        csl = slice(max(cols[0]-margin,0),min(cols[1]+margin+1,self.ylen))
+        self.crop = (rsl,csl)
+
+        key = ('radar_crop',rsl.start,rsl.stop,csl.start,csl.stop)
+        store = ident = None
+        if self.cache_dir:
+            store = get_store(self.cache_dir,max_bytes)
+            ident = file_identity(png)
+            self.data = store.get(ident,key)
+        if self.data is None:
+            # Pixel values are kept (one byte each), not dBZ
+            self.data = N.ascontiguousarray(decode_png(png)[rsl,csl])
+            if store is not None:
+                store.put(ident,key,self.data)
+        self.lats = self.lats[rsl]
+        self.lons = self.lons[csl]
+
+    def signature(self):
+        """
+        Hashable description of the (cropped) mosaic grid.
+        """
+        return ('mosaic',self.fmt,len(self.lats),len(self.lons),
+                repr(float(self.lats[0])),repr(float(self.lats[-1])),
+                repr(float(self.lons[0])),repr(float(self.lons[-1])))
+
+    def regrid(self,grid,data=False):
+        """
+        Interpolate reflectivity to a WRF grid with one sparse
+        matrix product. The weights are built once per pair of grids.
+
+        :param grid:    WRF grid, e.g. WRFOut.grid
+        :type grid:     grid.Grid
+        :param data:    pixel values on this mosaic (default self.data)
+        :returns:       dBZ, (south_north,west_east)
+        """
+        if data is False:
+            data = self.data
+        matrix = get_regrid_weights(self.signature(),self.lats,self.lons,
+                                    grid,self.cache_dir)
+        dBZ = self.get_dBZ(N.asarray(data,dtype=N.float32))
+        return matrix.dot(dBZ.ravel()).reshape(grid.y_dim,grid.x_dim)
+
     def get_radar_fname(self):
         tt = utils.ensure_timetuple(self.utc)
        
@@ -158,6 +310,16 @@ class Radar(Obs):
             dBZ = (data*5.0)-30 
         return dBZ
 
+    def get_pixel(self,dBZ):
+        """
+        Inverse of get_dBZ: pixel values from dBZ.
+        """
+        if self.fmt == 'n0q':
+            data = (dBZ+32)/0.5
+        elif self.fmt == 'n0r':
+            data = (dBZ+30)/5.0
+        return data
+
     def plot_radar(self,outdir,fig=False,ax=False,fname=False,Nlim=False,
                     Elim=False, Slim=False,Wlim=False,cb=True):
         """
@@ -16,6 +16,9 @@ import WEM.utils as utils
 from figure import Figure
 from defaults import Defaults
 from wrfout import WRFOut
+from cache import FieldCache
+from interp import VerticalInterpolator
+from timeaxis import TimeAxis
 
 """
 RUC/RAP data will probably need to be cut down to fit the WRF domain
@@ -39,9 +42,13 @@ class RUC(WRFOut):
         # import pdb; pdb.set_trace()
         self.nc = Dataset(self.fpath)
         self.fields = [v for v in self.nc.variables]
+        self.cache = FieldCache(Defaults().cache_bytes)
+        self.scope = None
+        self.store = None
 
         raw_time = self.nc.variables[self.fields[0]].initial_time
         self.utc = self.get_utc_time(raw_time)
+        self.timeaxis = TimeAxis([self.utc])
         self.version = self.get_version()
 
         # self.fname = self.get_fname()
@@ -477,32 +484,27 @@ class RUC(WRFOut):
         return N.sqrt(u**2 + v**2)
 
     def get_p(self,vrbl,tidx,level,lonidx,latidx):
-        if isinstance(level,basestring) and level.endswith('hPa'):
-            hPa = 100.0*int(level.split('h')[0])
-            nlv = 1
-        elif isinstance(level,(float,int)):
-            hPa = level*100.0
-            nlv = 1
-        elif isinstance(level,(tuple,list)):
-            hPa = [l*100.0 for l in level]
-            nlv = len(hPa)
-        else:
-            print("Use XXXhPa, an integer, or list of integers for level.")
-            raise Exception
+        """
+        Interpolate to pressure level(s), linear in log(p).
+        Data are already on pressure levels, so the same weights
+        apply to every column.
+        """
+        plevs = self.get_plevels(level)
+        nlv = len(plevs)
 
         # If this breaks, user is requesting non-4D data
         # Duck-typing for the win
 
         if vrbl=='pressure':
             dshape = self.get('U',utc=tidx,lons=lonidx,lats=latidx)[0,:,:,:].shape
-            dataout = N.ones([nlv,dshape[-2],dshape[-1]])*hPa
+            dataout = N.ones([nlv,dshape[-2],dshape[-1]])*N.array(plevs)[:,N.newaxis,N.newaxis]
         else:
             levels = 100*self.levels.flatten()
             datain = self.get(vrbl,utc=tidx,lons=lonidx,lats=latidx)[0,:,:,:]
-            dataout = N.zeros([nlv,datain.shape[-2],datain.shape[-1]])
-            for (i,j), p in N.ndenumerate(dataout[0,:,:]):
-                # dataout[:,i,j] = N.interp(hPa,levels,datain[:,i,j])
-                dataout[:,i,j] = N.interp(hPa,levels,datain[:,i,j][::-1])
+            # Levels are stored in the opposite order to the data
+            P = N.ones(datain.shape)*levels[::-1][:,N.newaxis,N.newaxis]
+            VI = VerticalInterpolator(P,plevs,axis=0,log=True,outside='mask')
+            dataout = VI(datain)
         # pdb.set_trace()
         # data = N.expand_dims(dataout,axis=0)
         # import pdb; pdb.set_trace()
@@ -1,5 +1,9 @@
 import numpy as N
+import os
 import pdb
+import traceback
+import collections
+import multiprocessing
 import scipy.ndimage as ndimage
 import scipy.ndimage.filters as filters
 import matplotlib.pyplot as plt
@@ -7,6 +11,289 @@ import matplotlib.pyplot as plt
 from wrfout import WRFOut
 from obs import Radar
 
+# Fraction of the field maximum used as the object threshold for
+# variables other than reflectivity (Wernli et al 2008)
+F_RSTAR = 1/15.0
+
+def label_objects(data,thresh):
+    """
+    Label contiguous regions where data >= thresh.
+
+    :returns:   labelled array, and the number of points with each
+                label (index 0 is the background).
+    """
+    labeled, num_objects = ndimage.label(data >= thresh)
+    sizes = N.bincount(labeled.ravel(),minlength=num_objects+1)
+    return labeled, sizes
+
+def object_properties(data,labeled,sizes,footprint):
+    """
+    Mass, maximum and centre of mass of every object of at least
+    footprint points, with one vectorised reduction each.
+
+    Smaller objects join the background (label 0), whose centre of
+    mass is the field's reference point x_CoM, as in
+    SAL.object_operators.
+
+    :param data:        2D field
+    :param labeled:     labels from label_objects
+    :param sizes:       sizes from label_objects
+    :param footprint:   smallest object kept, in grid points
+    :type footprint:    int
+    :returns:           dictionary of x_CoM (x,y), per-object arrays
+                        CoM (n,2 of x,y), Rn, RnMax and Vn, R_tot,
+                        nobj, and the objects numbered 1..nobj
+                        (labels).
+    """
+    keep = N.where(sizes >= footprint)[0]
+    keep = keep[keep > 0]
+    nobj = len(keep)
+    # Renumber the objects kept as 1..nobj
+    lookup = N.zeros(len(sizes),dtype=int)
+    lookup[keep] = N.arange(1,nobj+1)
+    objects = lookup[labeled]
+
+    if N.any(objects == 0):
+        cy, cx = ndimage.center_of_mass(data,objects,0)
+    else:
+        # Objects cover the whole field
+        cy, cx = ndimage.center_of_mass(data)
+    props = {'x_CoM':(cx,cy),'nobj':nobj,'labels':objects}
+    if nobj:
+        idx = N.arange(1,nobj+1)
+        props['Rn'] = N.asarray(ndimage.sum(data,objects,idx),dtype=float)
+        props['RnMax'] = N.asarray(ndimage.maximum(data,objects,idx),dtype=float)
+        com = N.asarray(ndimage.center_of_mass(data,objects,idx),dtype=float)
+        props['CoM'] = com.reshape(nobj,2)[:,::-1]
+    else:
+        props['Rn'] = N.zeros(0)
+        props['RnMax'] = N.zeros(0)
+        props['CoM'] = N.zeros((0,2))
+    props['Vn'] = props['Rn']/props['RnMax']
+    props['R_tot'] = props['Rn'].sum()
+    return props
+
+def sal_components(Mdata,Cdata,Mprops,Cprops,dx,d):
+    """
+    Structure, amplitude and location components from the fields and
+    their object properties (see object_properties).
+
+    :param dx:      grid spacing
+    :param d:       largest distance across the domain (SAL.compute_d)
+    :returns:       dictionary of S, A, L, L1 and L2
+    """
+    Mmean = N.mean(Mdata)
+    Cmean = N.mean(Cdata)
+    A = (Mmean - Cmean)/(0.5*(Mmean + Cmean))
+
+    def dist(v1,v2):
+        dv = N.subtract(v1,v2)
+        return dx * N.sqrt(dv[...,0]**2 + dv[...,1]**2)
+
+    def r_V(props):
+        if props['R_tot'] == 0:
+            return 0.0, 0.0
+        Rn = props['Rn']
+        r = N.sum(Rn * dist(props['x_CoM'],props['CoM']))/props['R_tot']
+        V = N.sum(Rn * props['Vn'])/props['R_tot']
+        return r, V
+
+    L1 = dist(Mprops['x_CoM'],Cprops['x_CoM'])/d
+    rM, VM = r_V(Mprops)
+    rC, VC = r_V(Cprops)
+    L2 = 2*(N.abs(rC-rM)/d)
+    if (VM + VC) == 0:
+        S = 0.0
+    else:
+        S = (VM - VC)/(0.5*(VM + VC))
+    return {'S':S,'A':A,'L':L1+L2,'L1':L1,'L2':L2}
+
+def radar_verif(W,utc,datapath):
+    """
+    Composite reflectivity from radar, interpolated to the grid of W.
+
+    Only the part of the mosaic over the domain is decoded (and
+    cached), and it is regridded with cached sparse weights.
+    """
+    # The whole domain, including the corners of projected grids
+    bounds = (float(W.lats.max()),float(W.lons.max()),
+                float(W.lats.min()),float(W.lons.min()))
+    RADAR = Radar(utc,datapath,bounds=bounds)
+    return RADAR.regrid(W.grid)
+
+def is_reflectivity(vrbl):
+    return (vrbl == 'REFL_comp') or (vrbl == 'cref')
+
+def load_sal_field(W,vrbl,utc,lv=False,accum_hr=False):
+    """
+    2D field used by SAL, negative values set to 0.
+    """
+    if vrbl == 'accum_precip':
+        if not accum_hr:
+            raise Exception("Need to set accumulation hours.")
+        data = W.compute_accum_rain(utc,accum_hr)[0,0,:,:]
+    else:
+        data = W.get(vrbl,level=lv,utc=utc)[0,0,:,:]
+    data = N.array(data)
+    data[data<0] = 0
+    return data
+
+class SALField(object):
+    """
+    One field in a SAL sweep. Objects are labelled once per
+    threshold and reused for every footprint.
+    """
+    def __init__(self,data,vrbl):
+        self.data = data
+        self.vrbl = vrbl
+        self.labels = {}
+
+    def rstar(self,thresh):
+        if is_reflectivity(self.vrbl):
+            return float(thresh)
+        # Independent of the sweep threshold: labelled only once
+        return F_RSTAR * N.max(self.data)
+
+    def objects(self,thresh,footprint):
+        Rstar = self.rstar(thresh)
+        if Rstar not in self.labels:
+            self.labels[Rstar] = label_objects(self.data,Rstar)
+        labeled, sizes = self.labels[Rstar]
+        return object_properties(self.data,labeled,sizes,footprint)
+
+def sal_group(args):
+    """
+    SAL for several model fields verified against the same
+    observations (control run or radar) at one time.
+    Module-level, so it can be passed to a process pool.
+
+    The observed field is loaded once per grid and labelled once
+    per threshold; each model field is loaded once.
+
+    :param args:    (list of cases, thresholds, footprints);
+                    see sal_sweep.
+    :returns:       list of rows (dictionaries)
+    """
+    cases, thresholds, footprints = args
+    obs = {}
+    rows = []
+    for case in cases:
+        vrbl = case['vrbl']
+        utc = case['utc']
+        lv = case.get('level',False)
+        accum_hr = case.get('accum_hr',False)
+        ctrl = case.get('ctrl',False)
+        info = dict((k,v) for k,v in case.items() if k not in
+                    ('mod','ctrl','vrbl','utc','level','accum_hr','radar_datadir'))
+        try:
+            W = WRFOut(case['mod'])
+            mod = SALField(load_sal_field(W,vrbl,utc,lv,accum_hr),vrbl)
+            use_radar_obs = (ctrl is False) and is_reflectivity(vrbl)
+            # Radar is interpolated to each grid
+            okey = W.grid.signature if use_radar_obs else None
+            if okey not in obs:
+                if use_radar_obs:
+                    data = radar_verif(W,utc,case['radar_datadir'])
+                    data[data<0] = 0
+                else:
+                    data = load_sal_field(WRFOut(ctrl),vrbl,utc,lv,accum_hr)
+                obs[okey] = SALField(data,vrbl)
+            ctl = obs[okey]
+            dx = W.dx
+            side = W.dx * W.x_dim
+            d = N.sqrt(side**2 + side**2)
+        except Exception:
+            print("Failed: {0}".format(case['mod']))
+            traceback.print_exc()
+            for thresh in thresholds:
+                for footprint in footprints:
+                    row = dict(info,thresh=thresh,footprint=footprint,ok=False,
+                                nobj_mod=0,nobj_ctrl=0)
+                    row.update(dict((k,N.nan) for k in ('S','A','L','L1','L2')))
+                    rows.append(row)
+            continue
+        for thresh in thresholds:
+            for footprint in footprints:
+                Mprops = mod.objects(thresh,footprint)
+                Cprops = ctl.objects(thresh,footprint)
+                row = dict(info,thresh=thresh,footprint=footprint,ok=True,
+                            nobj_mod=Mprops['nobj'],nobj_ctrl=Cprops['nobj'])
+                row.update(sal_components(mod.data,ctl.data,Mprops,Cprops,dx,d))
+                rows.append(row)
+    return rows
+
+def sal_sweep(cases,thresholds=(False,),footprints=(500,),ncpus=1):
+    """
+    SAL for many cases, thresholds and footprints.
+
+    Cases verified against the same observations (same control file
+    or radar directory, variable, time and level) are done together,
+    so the observations are read and labelled once. Groups run in a
+    process pool if ncpus > 1.
+
+    :param cases:       dictionaries, one per model field, with keys
+
+                        * mod: path to the model's wrfout file
+                        * ctrl: path to the control wrfout file, or
+                          False to verify reflectivity against radar
+                        * vrbl, utc: as for SAL
+                        * level, accum_hr, radar_datadir: optional,
+                          as for SAL
+                        * anything else (e.g. case, nest, member) is
+                          copied to the rows of the table.
+    :type cases:        list
+    :param thresholds:  object thresholds (dBZ) for reflectivity.
+                        Other variables use a fraction of the maximum.
+    :type thresholds:   list,tuple
+    :param footprints:  smallest object kept, in grid points
+    :type footprints:   list,tuple
+    :param ncpus:       number of processes
+    :type ncpus:        int
+    :returns:           record array with one row per case, threshold
+                        and footprint. Columns are the extra case keys,
+                        thresh, footprint, S, A, L, L1, L2, nobj_mod,
+                        nobj_ctrl and ok.
+    """
+    groups = collections.OrderedDict()
+    for case in cases:
+        key = (case.get('ctrl',False),case['vrbl'],repr(case['utc']),
+                repr(case.get('level',False)),case.get('accum_hr',False),
+                case.get('radar_datadir',False))
+        groups.setdefault(key,[]).append(case)
+    jobs = [(g,list(thresholds),list(footprints)) for g in groups.values()]
+
+    if (ncpus > 1) and (len(jobs) > 1):
+        pool = multiprocessing.Pool(min(ncpus,len(jobs)))
+        try:
+            results = pool.map(sal_group,jobs,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(sal_group,jobs)
+    rows = [row for result in results for row in result]
+    return sal_table(rows)
+
+def sal_table(rows):
+    """
+    Record array from a list of row dictionaries.
+    """
+    fixed = ['thresh','footprint','S','A','L','L1','L2','nobj_mod','nobj_ctrl','ok']
+    extra = sorted(set(k for row in rows for k in row) - set(fixed))
+    names = extra + fixed
+    arrays = []
+    for name in names:
+        col = [row.get(name,None) for row in rows]
+        try:
+            arr = N.array(col)
+        except Exception:
+            arr = N.array(col,dtype=object)
+        if arr.ndim != 1:
+            arr = N.empty(len(col),dtype=object)
+            arr[:] = col
+        arrays.append(arr)
+    return N.rec.fromarrays(arrays,names=names)
+
 class SAL(object):
     def __init__(self,Wctrl_fpath,Wmod_fpath,vrbl,utc,lv=False,
                     accum_hr=False,radar_datadir=False,thresh=False,
@@ -65,23 +352,7 @@ class SAL(object):
         print("S = {0}    A = {1}     L = {2}".format(self.S,self.A,self.L))
 
     def get_radar_verif(self,utc,datapath):
-        RADAR = Radar(utc,datapath)
-        Nlim, Elim, Slim, Wlim = self.M['WRFOut'].get_limits() 
-        wlats = self.M['WRFOut'].lats1D
-        wlons = self.M['WRFOut'].lons1D
-        data, lats, lons = RADAR.get_subdomain(Nlim,Elim,Slim,Wlim)
-        dBZ = RADAR.get_dBZ(data)
-        dBZ_flip = N.flipud(dBZ)
-        from scipy.interpolate import RectBivariateSpline as RBS
-        rbs = RBS(lats[::-1],lons,dBZ_flip) 
-        dBZ_interp = rbs(wlats,wlons,)#grid=True)
-        # import pdb; pdb.set_trace()
-        # fig, ax = plt.subplots(1)
-        # ax.imshow(dBZ_interp)
-        # ax.invert_yaxis()
-        # fig.tight_layout()
-        # fig.savefig('/home/jrlawson/public_html/bowecho/hires/SAL/dBZ_output.png')
-        return dBZ_interp
+        return radar_verif(self.M['WRFOut'],utc,datapath)
 
     def compute_d(self,W):
         side = W.dx * W.x_dim
@@ -89,7 +360,7 @@ class SAL(object):
         return
 
     def identify_objects(self,):
-        self.f = 1/15.0 # Used in Wernli et al 2008
+        self.f = F_RSTAR # Used in Wernli et al 2008
         self.C['Rmax'] = N.max(self.C['data'])
         self.M['Rmax'] = N.max(self.M['data'])
         if (self.vrbl == 'REFL_comp') or (self.vrbl=='cref'):
@@ -149,40 +420,21 @@ class SAL(object):
         thresh = dic['Rstar']
         data = dic['data']
 
-        mask = N.copy(data)
-        mask[data<thresh] = False
-        mask[data>=thresh] = True
-
-        labeled, num_objects = ndimage.label(mask)
-
-        sizes = ndimage.sum(mask, labeled, range(num_objects+1))
-
-        masksize = sizes < nsize
-        remove_pixel = masksize[labeled]
-        labeled[remove_pixel] = 0
-
-        labels = N.unique(labeled)
-        label_im = N.searchsorted(labels, labeled)
+        mask = data >= thresh
+        labeled, sizes = label_objects(data,thresh)
+        props = object_properties(data,labeled,sizes,nsize)
+        label_im = props['labels']
+        labels = N.arange(props['nobj']+1)
 
+        dic['x_CoM'] = props['x_CoM']
         dic['objects'] = {}
-
+        for l in range(props['nobj']):
+            dic['objects'][l+1] = {'CoM':tuple(props['CoM'][l]),
+                                    'Rn':props['Rn'][l],
+                                    'RnMax':props['RnMax'][l],
+                                    'Vn':props['Vn'][l]}
         # Total R for objects
-        R_objs_count = 0
-
-        for ln,l in enumerate(labels):
-            cy, cx = ndimage.measurements.center_of_mass(data,labeled,l)
-            # First record is for whole field
-            if ln == 0:
-                dic['x_CoM'] = (cx,cy)
-            else:
-                dic['objects'][l] = {}
-                dic['objects'][l]['CoM'] = (cx,cy)
-                dic['objects'][l]['Rn'] = ndimage.sum(data,labeled,l)
-                dic['objects'][l]['RnMax'] = ndimage.maximum(data,labeled,l)
-                dic['objects'][l]['Vn'] = dic['objects'][l]['Rn']/dic['objects'][l]['RnMax']
-                R_objs_count += dic['objects'][l]['Rn']
-
-        dic['R_tot'] = R_objs_count
+        dic['R_tot'] = props['R_tot'] if props['nobj'] else 0
 
         """
         if 'WRFOut' in dic.keys():
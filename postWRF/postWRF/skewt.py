@@ -3,8 +3,9 @@
 ### IMPORTS
 import numpy as N
 import math
+from lazyimport import select_backend
+select_backend()
 import matplotlib as M
-M.use('Agg')
 import matplotlib.pyplot as plt
 import pdb
 import cPickle as pickle
@@ -18,6 +19,7 @@ import os
 
 from figure import Figure
 from wrfout import WRFOut
+from ensemble import EnsembleCube
 import WEM.utils as utils
 import metconstants as mc
 
@@ -65,44 +67,26 @@ class Profile(Figure):
 
         # plevs = N.arange(P_bot,P_top,dp)
 
-        # Get wrfout prototype for information
-        W = WRFOut(wrfouts[0])
+        # All members' profiles at this point, (member,time,level,lat,lon)
+        cube = EnsembleCube(wrfouts)
+        W = cube.W
 
         lat, lon = plot_latlon
         datestr = utils.string_from_time('output',plot_time)
         t_idx = W.get_time_idx(plot_time,)
-        y, x, exact_lat, exact_lon = utils.getXY(W.lats1D,W.lons1D,lat,lon)
-        slices = {'t': t_idx, 'la': y, 'lo': x}
-        #var_slices = {'t': t_idx, 'lv':0, 'la':y, 'lo':x}
-
-        # Initialise array
-        # Number of levels and ensembles:
-        nPlevs = W.z_dim
-        data = W.get(va,slices)
-        nvarlevs = data.shape[1]
-        nens = len(wrfouts)
+        y, x = W.get_XY(lat,lon)
+        nens = cube.nens
 
         # 2D: (profile,member)
-        profile_arr = N.zeros((nvarlevs,nens))
-        composite_P = N.zeros((nPlevs,nens))
+        profile_arr = cube.load(va,utc=t_idx,lats=y,lons=x)[:,0,:,0,0].T.copy()
+        composite_P = cube.load('pressure',utc=t_idx,lats=y,lons=x)[:,0,:,0,0].T.copy()
 
         # Set up legend
         labels = []
         colourlist = utils.generate_colours(M,nens)
         # M.rcParams['axes.color_cycle'] = colourlist
 
-        # Collect profiles
         for n,wrfout in enumerate(wrfouts):
-            W = WRFOut(wrfout)
-
-            # Get pressure levels
-            composite_P[:,n] = W.get('pressure',slices)[0,:,0,0]
-            #elev = self.W.get('HGT',H_slices)
-
-            #pdb.set_trace()
-            # Grab variable
-            profile_arr[:,n] = W.get(va,slices)[0,:,0,0]
-
             # Plot variable on graph
             self.ax.plot(profile_arr[:,n],composite_P[:,n],color=colourlist[n])
            
@@ -194,7 +178,7 @@ class SkewT(Figure):
         prof_lat, prof_lon = plot_latlon
         datestr = utils.string_from_time('output',plot_time)
         t_idx = self.W.get_time_idx(plot_time)
-        y,x, exact_lat, exact_lon = utils.getXY(self.W.lats1D,self.W.lons1D,prof_lat,prof_lon)
+        y, x = self.W.get_XY(prof_lat,prof_lon)
 
 
         # Create figure
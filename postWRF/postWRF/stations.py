@@ -0,0 +1,170 @@
+"""Interpolation of gridded fields to a list of stations (points).
+
+The weights for each station depend only on the grid and the station
+locations. StationWeights builds them once as a sparse matrix, so any
+field, stack of times or stack of ensemble members is interpolated with
+a single sparse matrix product.
+
+Weights are kept in a module-level registry keyed by grid signature,
+method and station list, so every WRFOut on the same grid reuses them.
+"""
+
+import numpy as N
+import scipy.sparse
+
+from grid import EARTH_RADIUS, latlon_to_xyz
+
+# Registry of weights built in this process.
+WEIGHTS = {}
+
+def get_station_weights(grid,lats,lons,method='bilinear',**kwargs):
+    """
+    Return the shared StationWeights for these stations on this grid,
+    building them only if they have not been seen.
+
+    :param grid:        grid to interpolate from
+    :type grid:         grid.Grid
+    :param lats,lons:   station latitudes and longitudes (degrees)
+    :type lats,lons:    float,list,N.ndarray
+    :param method:      'bilinear' or 'idw' (inverse distance)
+    :type method:       str
+    """
+    lats = N.atleast_1d(N.asarray(lats,dtype=float))
+    lons = N.atleast_1d(N.asarray(lons,dtype=float))
+    key = (grid.signature,method,tuple(lats.tolist()),tuple(lons.tolist()),
+            tuple(sorted(kwargs.items())))
+    if key not in WEIGHTS:
+        WEIGHTS[key] = StationWeights(grid,lats,lons,method=method,**kwargs)
+    return WEIGHTS[key]
+
+def clear_weights():
+    """Forget all weights built so far."""
+    WEIGHTS.clear()
+
+def bilinear_weights(i,j,shape):
+    """
+    Columns and weights of the four grid points around each point.
+    Points outside the grid use the nearest edge.
+
+    :param i,j:     fractional column and row of each point
+    :type i,j:      N.ndarray
+    :param shape:   (rows, columns) of the grid
+    :type shape:    tuple
+    :returns:       flattened grid indices and weights, (points, 4) each
+    """
+    ny, nx = shape
+    i = N.clip(i,0,nx-1)
+    j = N.clip(j,0,ny-1)
+    i0 = N.clip(N.floor(i).astype(int),0,max(nx-2,0))
+    j0 = N.clip(N.floor(j).astype(int),0,max(ny-2,0))
+    fi = i - i0
+    fj = j - j0
+    i1 = N.minimum(i0+1,nx-1)
+    j1 = N.minimum(j0+1,ny-1)
+    cols = N.column_stack((j0*nx+i0,j0*nx+i1,j1*nx+i0,j1*nx+i1))
+    wts = N.column_stack(((1-fi)*(1-fj),fi*(1-fj),(1-fi)*fj,fi*fj))
+    return cols, wts
+
+def weight_matrix(cols,wts,size):
+    """
+    Sparse (point, grid point) matrix from the columns and weights
+    of each point.
+
+    :param size:    number of grid points
+    :type size:     int
+    :returns:       csr matrix
+    """
+    npts, k = cols.shape
+    rows = N.repeat(N.arange(npts),k)
+    matrix = scipy.sparse.csr_matrix((wts.ravel(),(rows,cols.ravel())),
+                                        shape=(npts,size))
+    # Zero weights would still spread NaNs
+    matrix.eliminate_zeros()
+    return matrix
+
+class StationWeights(object):
+    """
+    Sparse (station, grid point) interpolation weights.
+    """
+    def __init__(self,grid,lats,lons,method='bilinear',npts=4,power=2.0):
+        """
+        :param grid:        grid to interpolate from
+        :type grid:         grid.Grid
+        :param lats,lons:   station latitudes and longitudes (degrees)
+        :type lats,lons:    float,list,N.ndarray
+        :param method:      'bilinear' uses the four surrounding points.
+                            'idw' uses the npts nearest points, weighted
+                            by inverse distance to the power 'power'.
+        :type method:       str
+        :param npts:        number of points for 'idw'
+        :type npts:         int
+        :param power:       power of distance for 'idw'
+        :type power:        float
+        """
+        self.lats = N.atleast_1d(N.asarray(lats,dtype=float))
+        self.lons = N.atleast_1d(N.asarray(lons,dtype=float))
+        self.nst = len(self.lats)
+        self.shape = (grid.y_dim,grid.x_dim)
+        ny, nx = self.shape
+
+        i, j = grid.latlon_to_ij(self.lats,self.lons)
+        self.outside = (i < 0) | (i > nx-1) | (j < 0) | (j > ny-1)
+
+        if method == 'bilinear':
+            cols, wts = bilinear_weights(i,j,self.shape)
+        elif method == 'idw':
+            cols, wts = self.idw(grid,npts,power)
+        else:
+            print("Method must be 'bilinear' or 'idw'.")
+            raise Exception
+
+        self.matrix = weight_matrix(cols,wts,ny*nx)
+
+        # Smallest box of grid points that the weights use
+        y, x = N.divmod(cols.ravel(),nx)
+        self.lat_sl = slice(y.min(),y.max()+1)
+        self.lon_sl = slice(x.min(),x.max()+1)
+        by, bx = N.mgrid[self.lat_sl,self.lon_sl]
+        self.box_shape = by.shape
+        self.box_matrix = self.matrix[:,(by*nx+bx).ravel()]
+
+    def idw(self,grid,npts,power):
+        """
+        Columns and inverse-distance weights of the nearest grid points.
+        """
+        dist, cols = grid.get_kdtree().query(
+                        latlon_to_xyz(self.lats,self.lons),k=npts)
+        cols = cols.reshape(self.nst,-1)
+        dist = dist.reshape(self.nst,-1)*EARTH_RADIUS
+        # A station on a grid point takes its value
+        wts = 1.0/N.maximum(dist,1e-6)**power
+        wts /= wts.sum(axis=1)[:,N.newaxis]
+        return cols, wts
+
+    def __call__(self,data):
+        """
+        Interpolate data to the stations.
+
+        :param data:    array whose last two axes are (y,x), either the
+                        whole grid or the box (self.lat_sl,self.lon_sl).
+                        Any leading axes (time, level, member...) are
+                        done at once.
+        :type data:     N.ndarray
+        :returns:       array shaped like data with the last two axes
+                        replaced by station. NaN for stations outside
+                        the grid or on masked data.
+        """
+        data = N.ma.filled(N.ma.asarray(data,dtype=float),N.nan)
+        if data.shape[-2:] == self.shape:
+            matrix = self.matrix
+        elif data.shape[-2:] == self.box_shape:
+            matrix = self.box_matrix
+        else:
+            print("Data shape {0} does not match the grid {1} or box {2}.".format(
+                    data.shape,self.shape,self.box_shape))
+            raise Exception
+        lead = data.shape[:-2]
+        flat = data.reshape(-1,data.shape[-2]*data.shape[-1])
+        out = matrix.dot(flat.T).T
+        out[:,self.outside] = N.nan
+        return out.reshape(lead + (self.nst,))
@@ -6,34 +6,172 @@ import numpy as N
 import pdb
 import scipy
 import scipy.signal
+import scipy.ndimage
 import itertools
 import time
 import os
+import shutil
+import tempfile
+import multiprocessing
+from netCDF4 import Dataset
 
 import WEM.utils as utils
+import metconstants as mc
 
 from wrfout import WRFOut
+from timeaxis import align_axes
+from ensemble import EnsembleCube
+from energystore import DiffEnergyStore
 
 def std(ncfiles,vrbl,utc=False,level=False,other=False,axis=0):
     """
     Find standard deviation in along axis of ensemble
     members. Returns matrix x-y for plotting
+
+    Across members (axis=0), one member is held in memory at a time;
+    see EnsembleStats. Other axes need every member, so they are read
+    into an EnsembleCube.
     """
+    if axis != 0:
+        all_members = EnsembleCube(ncfiles).load(vrbl,utc=utc,level=level,other=other)
+        if vrbl=='cref':
+            all_members[all_members<0] = 0
+        return N.std(all_members,axis=axis,dtype=N.float64)
+
+    S = EnsembleStats()
     for n, nc in enumerate(ncfiles):
-        # print("Ensemble member {0} loaded.".format(n))
-        W = WRFOut(nc)
+        W = WRFOut(nc,lazy=True)
         vrbl_array = W.get(vrbl,utc=utc,level=level,other=other)
         if vrbl=='cref':
-            vrbl_array[vrbl_array<0] = 0
+            vrbl_array = N.maximum(vrbl_array,0)
+        S.update(vrbl,vrbl_array)
+    return S.std(vrbl)
 
-        if n==0:
-            dims = [len(ncfiles),] + list(vrbl_array.shape)
-            all_members = N.zeros(dims)
-        all_members[n,...] = vrbl_array[...]
-        # import pdb; pdb.set_trace()
+def ensemble_stats(ncfiles,vrbls,utc=False,levels=(False,),thresholds=None,
+                    other=False):
+    """
+    Mean, variance, min, max and exceedance counts of many variables
+    and levels, visiting each member once.
+
+    Variables at the same level are read together (see WRFOut.evaluate),
+    so shared inputs are read once per member.
+
+    :param ncfiles:     paths to each member's wrfout file
+    :type ncfiles:      list
+    :param vrbls:       variables
+    :type vrbls:        list,tuple
+    :param utc:         time(s), as for WRFOut.get
+    :param levels:      levels, as for WRFOut.get
+    :type levels:       list,tuple
+    :param thresholds:  thresholds to count exceedances of. A list for
+                        all variables, or a dictionary of lists keyed
+                        by variable.
+    :type thresholds:   list,dict
+    :returns:           EnsembleStats, keyed by (vrbl,level)
+    """
+    vrbls = list(vrbls)
+    S = EnsembleStats()
+    for nc in ncfiles:
+        W = WRFOut(nc,lazy=True)
+        for level in levels:
+            data = W.get(vrbls,utc=utc,level=level,other=other)
+            for vrbl in vrbls:
+                if isinstance(thresholds,dict):
+                    thresh = thresholds.get(vrbl,())
+                else:
+                    thresh = thresholds or ()
+                S.update((vrbl,level),data[vrbl],thresh)
+        del W
+    return S
+
+class EnsembleStats(object):
+    """
+    One-pass statistics over ensemble members.
 
-    std = N.std(all_members,axis=axis)
-    return std
+    Each call to update() adds one member. The mean and variance are
+    updated with Welford's algorithm, so memory depends only on the
+    size of one member's field, not the number of members. Points that
+    are masked or NaN in a member are left out of that point's count.
+    """
+    def __init__(self):
+        self.fields = {}
+
+    def update(self,key,data,thresholds=()):
+        """
+        Add one member's data.
+
+        :param key:         name for this field, e.g. variable or
+                            (variable,level)
+        :param data:        member's data; same shape for every member
+        :type data:         N.ndarray
+        :param thresholds:  count members above each threshold
+        :type thresholds:   list,tuple
+        """
+        x = N.ma.filled(N.ma.asarray(data,dtype=N.float64),N.nan)
+        valid = N.isfinite(x)
+        if key not in self.fields:
+            self.fields[key] = {'n':N.zeros(x.shape,dtype=N.int32),
+                                'mean':N.zeros(x.shape),
+                                'M2':N.zeros(x.shape),
+                                'min':N.ones(x.shape)*N.nan,
+                                'max':N.ones(x.shape)*N.nan,
+                                'exceed':{}}
+        f = self.fields[key]
+        if x.shape != f['mean'].shape:
+            print("Member shape {0} does not match {1}.".format(
+                    x.shape,f['mean'].shape))
+            raise Exception
+
+        f['n'] += valid
+        delta = N.where(valid,x-f['mean'],0.0)
+        f['mean'] += delta/N.maximum(f['n'],1)
+        f['M2'] += N.where(valid,delta*(x-f['mean']),0.0)
+        N.fmin(f['min'],x,out=f['min'])
+        N.fmax(f['max'],x,out=f['max'])
+        for th in thresholds:
+            if th not in f['exceed']:
+                f['exceed'][th] = N.zeros(x.shape,dtype=N.int32)
+            with N.errstate(invalid='ignore'):
+                f['exceed'][th] += x > th
+
+    def keys(self):
+        return self.fields.keys()
+
+    def count(self,key):
+        """Number of members with valid data at each point."""
+        return self.fields[key]['n'].copy()
+
+    def mean(self,key):
+        f = self.fields[key]
+        return N.where(f['n'] > 0,f['mean'],N.nan)
+
+    def var(self,key,ddof=0):
+        """
+        Variance across members. ddof=0 matches N.var.
+        """
+        f = self.fields[key]
+        with N.errstate(invalid='ignore',divide='ignore'):
+            return N.where(f['n'] > ddof,f['M2']/(f['n']-ddof),N.nan)
+
+    def std(self,key,ddof=0):
+        return N.sqrt(self.var(key,ddof=ddof))
+
+    def min(self,key):
+        return self.fields[key]['min'].copy()
+
+    def max(self,key):
+        return self.fields[key]['max'].copy()
+
+    def exceedance(self,key,threshold):
+        """Number of members above threshold at each point."""
+        return self.fields[key]['exceed'][threshold].copy()
+
+    def probability(self,key,threshold):
+        """Fraction of members (with valid data) above threshold."""
+        f = self.fields[key]
+        with N.errstate(invalid='ignore',divide='ignore'):
+            return N.where(f['n'] > 0,
+                    f['exceed'][threshold]/N.maximum(f['n'],1).astype(float),N.nan)
 
 def std_ttest(ncfiles1,ncfiles2,vrbl,utc=False,level=False,other=False):
     """
@@ -44,23 +182,13 @@ def std_ttest(ncfiles1,ncfiles2,vrbl,utc=False,level=False,other=False):
     std_ave = []
 
     for ncfiles in (ncfiles1, ncfiles2):
-        for n, nc in enumerate(ncfiles):
-            # print("Ensemble member {0} loaded.".format(n))
-            W = WRFOut(nc)
-            vrbl_array = W.get(vrbl,utc=utc,level=level,other=other)
-            if vrbl=='cref':
-                vrbl_array[vrbl_array<0] = 0
-
-            if n==0:
-                dims = [len(ncfiles),] + list(vrbl_array.shape)
-                all_members = N.zeros(dims)
-            all_members[n,...] = vrbl_array[...]
-            # sample[n,...] = vrbl_array[
-            # import pdb; pdb.set_trace()
+        all_members = EnsembleCube(ncfiles).load(vrbl,utc=utc,level=level,other=other)
+        if vrbl=='cref':
+            all_members[all_members<0] = 0
 
         sample=all_members
-        std.append(N.std(sample,axis=0)[0,0,:,:])
-        std_ave.append(N.std(all_members, axis=None))
+        std.append(N.std(sample,axis=0,dtype=N.float64)[0,0,:,:])
+        std_ave.append(N.std(all_members,axis=None,dtype=N.float64))
         
     # N.random.shuffle(std[0])
     # N.random.shuffle(std[1])
@@ -135,29 +263,157 @@ def max_filter(data,size=11,shape='circle'):
     output = scipy.ndimage.filters.maximum_filter(data,footprint=footprint)
     return output
 
+def circle_footprint(radius):
+    """
+    Grid points within radius+0.5 of the centre of a (2*radius+1)
+    square, as for max_filter's 'circle'.
+    """
+    x, y = N.meshgrid(N.arange(-radius,radius+1),N.arange(-radius,radius+1))
+    return N.sqrt(x**2 + y**2) < radius + 0.5
+
+def neighbourhood_probability(ncfiles,vrbl,thresholds,radii=(0,),utc=False,
+                                level=False,overunder='over',units='gridpoints',
+                                other=False,footprint='square',neighbourhood='any'):
+    """
+    Point and neighbourhood probabilities of exceeding several thresholds,
+    for several neighbourhood sizes, in one pass over the members.
+
+    A member counts at a point if, somewhere within the neighbourhood
+    (or everywhere, if neighbourhood is 'all'), the variable is above
+    the threshold at any of the times ('over'), or below it at all of
+    the times ('under'). Both only depend on the maximum over time.
+    The neighbourhood's maximum or minimum is found once per member and
+    radius, then compared to every threshold. Radius 0 gives the point
+    probability.
+
+    stats.max_filter(size=11) before thresholding, as used by
+    WRFEnviron.probability_threshold, is radius 5 with the 'circle'
+    footprint: 'any' for 'over', 'all' for 'under'.
+
+    :param ncfiles:     paths to each member's wrfout file
+    :type ncfiles:      list
+    :param vrbl:        variable, as for WRFOut.get
+    :type vrbl:         str
+    :param thresholds:  thresholds
+    :type thresholds:   float,list
+    :param radii:       neighbourhood half-widths
+    :type radii:        int,list
+    :param utc:         time(s); member exceedance is at any of them
+    :param level:       level, as for WRFOut.get
+    :param overunder:   'over' or 'under' the thresholds
+    :type overunder:    str
+    :param units:       radii in 'gridpoints' or 'km'
+    :type units:        str
+    :param footprint:   'square' of half-width radius (separable 1D
+                        filters, fastest), or 'circle' of points
+                        within radius (see circle_footprint)
+    :type footprint:    str
+    :param neighbourhood:   'any' or 'all' points in the neighbourhood
+                            must meet the condition
+    :type neighbourhood:    str
+    :returns:           dictionary with 'prob' (threshold,radius,level,
+                        lat,lon) as a fraction of members, and the
+                        'thresholds', 'radii' (grid points), 'nens' and
+                        'overunder' used.
+    """
+    thresholds = N.atleast_1d(N.asarray(thresholds,dtype=float))
+    radii = N.atleast_1d(radii)
+    if overunder not in ('over','under'):
+        print("Pick over or under for threshold comparison.")
+        raise Exception
+    if neighbourhood not in ('any','all'):
+        print("Neighbourhood must be 'any' or 'all'.")
+        raise Exception
+    if footprint not in ('square','circle'):
+        print("Footprint must be 'square' or 'circle'.")
+        raise Exception
+    # Masked points never meet the condition
+    fill = -N.inf if overunder == 'over' else N.inf
+    if (overunder == 'over') == (neighbourhood == 'any'):
+        nfilter1d, nfilter = scipy.ndimage.maximum_filter1d, scipy.ndimage.maximum_filter
+    else:
+        nfilter1d, nfilter = scipy.ndimage.minimum_filter1d, scipy.ndimage.minimum_filter
+
+    count = None
+    for n, nc in enumerate(ncfiles):
+        W = WRFOut(nc,lazy=True)
+        if n == 0:
+            if units == 'km':
+                radii = N.round(radii*1000.0/W.dx)
+            radii = radii.astype(int)
+        data = W.get(vrbl,utc=utc,level=level,other=other)
+        data = N.ma.filled(N.ma.asarray(data,dtype=float),fill)
+        field = N.amax(data,axis=0)
+        if count is None:
+            count = N.zeros((len(thresholds),len(radii)) + field.shape,dtype=N.int32)
+        for r, radius in enumerate(radii):
+            if radius > 0 and footprint == 'circle':
+                fp = circle_footprint(radius)
+                fp = fp.reshape((1,)*(field.ndim-2) + fp.shape)
+                nfield = nfilter(field,footprint=fp,mode='nearest')
+            elif radius > 0:
+                size = 2*radius + 1
+                nfield = nfilter1d(nfilter1d(field,size,axis=-1,mode='nearest'),
+                                    size,axis=-2,mode='nearest')
+            else:
+                nfield = field
+            for t, th in enumerate(thresholds):
+                if overunder == 'over':
+                    count[t,r] += nfield > th
+                else:
+                    count[t,r] += nfield < th
+        del W
+
+    nens = len(ncfiles)
+    return {'prob':count/float(nens),'thresholds':thresholds,'radii':radii,
+            'nens':nens,'overunder':overunder}
+
 def compute_diff_energy(ptype,energy,files,times,upper=None,lower=None,
-                        d_save=True,d_return=True,d_fname='diff_energy_data'):
+                        d_save=True,d_return=True,d_fname='diff_energy_data',
+                        ncpus=1,resume=True):
     """
     This method computes difference kinetic energy (DKE)
     or different total energy (DTE, including temp)
     between WRFout files for a given depth of the
     atmosphere, at given time intervals
 
-    :param ptype:   '2D' or '3D'.
-                    '2D' integrates vertically between lower and
-                    upper hPa and creates a time series.
-                    '3D' integrates over the 3D space (again between
-                    the upper and lower bounds) and creates 2D arrays.
+    Each member's fields are read once per time (in parallel if
+    ncpus > 1) and every pair is then differenced from memory, rather
+    than re-reading both files for each of the N(N-1)/2 pairs. Fields
+    are held as float32, and pressure only for members that are the
+    first of a pair still to compute (its pressure is used for the
+    pair).
+
+    Results are written to a DiffEnergyStore (see energystore.py) as
+    each time is finished. If the run is interrupted, calling again
+    with the same arguments only computes what is missing.
+
+    :param ptype:   '1D' or '3D'.
+                    '1D' integrates vertically between lower and
+                    upper hPa and creates 2D arrays.
+                    '3D' creates a time series of the domain sum of
+                    those column integrals (J/m2). This is no longer
+                    the unweighted sum over grid points that older
+                    versions computed with DE_xyz; see
+                    energystore.UNITS.
     :param energy:   'DKE' or 'DTE'
     :param upper:   upper limit of vertical integration
     :param lower:   lower limit of vertical integration
     :param files:   abs paths to all wrfout files
     :param times:   times for computations - tuple format
-    :param d_save:   save dictionary to folder (path to folder)
+    :param d_save:   save the store to this folder (path to folder).
+                    If True, the home directory; if False, a
+                    temporary directory that is deleted afterwards.
     :param d_return:   return dictionary (True or False)
-    :param d_fname:   custom filename
+    :param d_fname:   name of the store (a directory in d_save)
+    :param ncpus:   number of processes used to read the members.
+                    1 reads them serially.
+    :param resume:  keep values already in a store with the same
+                    settings.
+    :type resume:   bool
 
-    :returns: N.ndarray -- time series or list of 2D arrays
+    :returns: dictionary of permutations, each with a list of
+                2D arrays or totals (memory-mapped from the store).
 
     """
     if d_save and not isinstance(d_save,basestring):
@@ -169,223 +425,418 @@ def compute_diff_energy(ptype,energy,files,times,upper=None,lower=None,
                 "power")
         raise Exception
 
-    print("Saving pickle file to {0}".format(d_save))
-    # Look up the method to use depending on type of plot
-    PLOTS = {'1D':DE_z, '3D':DE_xyz}
+    # Look up the reduction to use depending on type of plot
+    PLOTS = {'1D':'column', '3D':'sum'}
+    reduction = PLOTS[ptype]
+    energy = check_energy(energy)
 
     print('Get sequence of time')
     # Creates sequence of times
     ts = utils.get_sequence(times)
 
-    # Dictionary of data
-    DATA = {}
+    t_idx = get_member_time_idx(files,ts)
+
+    if d_save:
+        root = os.path.join(d_save,os.path.splitext(d_fname)[0])
+    else:
+        root = tempfile.mkdtemp(prefix='diff_energy_')
+    print("Saving difference energy to {0}".format(root))
+    W = WRFOut(files[0],lazy=True)
+    S = DiffEnergyStore.create(root,energy,ptype,ts,files,
+                                shape2D=(W.y_dim,W.x_dim),upper=upper,
+                                lower=lower,resume=resume)
 
-    print('Get permutations')
-    # Get all permutations of files
-    nperm = len(list(itertools.combinations(files,2)))
     print('Start loop')
-    # pdb.set_trace()
-    for n, perm in enumerate(itertools.combinations(files,2)):
-        print("No. {0} from {1} permutations".format(n,nperm))
-        perm_start = time.time()
-        DATA[str(n)] = {}
-        f1, f2 = perm
-        W1 = WRFOut(f1)
-        W2 = WRFOut(f2)
-        print('WRFOuts loaded.')
-        #pdb.set_trace()
-        # Make sure times are the same in both files
-        if not N.all(N.array(W1.wrf_times) == N.array(W2.wrf_times)):
-            print("Times are not identical between input files.")
-            raise Exception
-        else:
-            print("Passed check for identical timestamps between "
-                  "NetCDF files")
-
-        # Find indices of each time
-        print('Finding time indices')
-        t_idx = []
-        for t in ts:
-            t_idx.append(W1.get_time_idx(t))
-
-        print("Calculating values now...")
-        DATA[str(n)]['times'] = ts
-        DATA[str(n)]['values'] = []
+    for nt, t in enumerate(t_idx):
+        todo = S.todo(nt)
+        if not len(todo):
+            continue
+        t_start = time.time()
+        first = set([S.perms[n][0] for n in todo])
+        fields = load_members(files,t,energy,ncpus=ncpus,
+                                with_P=[i in first for i in range(len(files))])
+        print("Members loaded for time {0} of {1}.".format(nt+1,len(t_idx)))
+        for n in todo:
+            i, j = S.perms[n]
+            U0, V0, T0, P = fields[i]
+            U1, V1, T1, P1 = fields[j]
+            if energy=='DTE':
+                Td = N.asarray(T0,dtype=float) - T1
+            else:
+                Td = None
+            # Here we assume pressure columns are
+            # roughly the same between the two...
+            DE2D, DE_sum = diff_energy_column(N.asarray(U0,dtype=float)-U1,
+                                                N.asarray(V0,dtype=float)-V1,
+                                                P,energy,Td,lower,upper)
+            if reduction == 'column':
+                S.write(n,nt,DE2D)
+            else:
+                S.write(n,nt,DE_sum)
+        S.mark_done(todo,nt)
+        print("{0} permutations at this time took {1:2.1f} seconds.".format(
+                len(todo),time.time()-t_start))
+
+    if not d_return:
+        return
+    DATA = S.to_dict()
+    if not d_save:
+        # Read everything before the temporary store is removed
+        for perm in DATA:
+            DATA[perm]['values'] = [[N.array(v[0])] for v in DATA[perm]['values']]
+        del S
+        shutil.rmtree(root)
+    return DATA
+
+def ensemble_diff_energy(files,times,energy,upper=None,lower=None,ncpus=1):
+    """
+    Mean difference energy over all pairs of ensemble members,
+    without forming the pairs.
+
+    For N members, the sum over pairs of (xi-xj)**2 equals
+    N times the sum of (xi-xmean)**2, so the pair mean is
+    2/(N-1) * sum((xi-xmean)**2), i.e. twice the ensemble variance.
+    Only running sums of x and x**2 are kept. Members are read one at
+    a time, or ncpus at a time in a process pool, and added to the sums
+    as they arrive, so memory does not grow with the ensemble size.
+
+    The layer thicknesses come from the ensemble-mean pressure, so this
+    matches the mean of compute_diff_energy's '1D' maps when the members'
+    pressure columns are close (the same assumption made there).
+
+    :param files:   abs paths to all wrfout files
+    :type files:    list
+    :param times:   times for computations - tuple format
+    :param energy:  'DKE' or 'DTE'
+    :type energy:   str
+    :param upper:   upper limit of vertical integration (hPa)
+    :param lower:   lower limit of vertical integration (hPa)
+    :param ncpus:   number of processes used to read the members
+    :type ncpus:    int
+    :returns:       dictionary with 'times', and 'values' holding
+                    a 2D array for each time.
+    """
+    energy = check_energy(energy)
+    ts = utils.get_sequence(times)
+    t_idx = get_member_time_idx(files,ts)
+    nens = len(files)
+    if nens < 2:
+        print("Need at least two members.")
+        raise Exception
+
+    DATA = {'times':ts, 'values':[], 'files':files}
+    nproc = min(ncpus,nens)
+    pool = multiprocessing.Pool(nproc) if nproc > 1 else None
+    try:
         for t in t_idx:
-            DATA[str(n)]['values'].append(PLOTS[ptype](W1.nc,W2.nc,t,
-                                            energy,lower,upper))
-        DATA[str(n)]['file1'] = f1
-        DATA[str(n)]['file2'] = f2
-        # import pdb; pdb.set_trace()
-        print "Calculation #{0} took {1:2.1f} seconds.".format(n,time.time()-perm_start)
-
-    if d_return and not d_save:
-        return DATA
-    elif d_save and not d_return:
-        #self.save_data(DATA,d_save,d_fname)
-        utils.save_data(DATA,d_save,d_fname)
-        #self.json_data(DATA,d_save,d_fname)
+            # Running sums of U, V, T (and P) and of their squares
+            S1 = [0.0,0.0,0.0,0.0]
+            S2 = [0.0,0.0,0.0]
+            for member in iter_members(files,t,energy,pool,nproc):
+                for n, x in enumerate(member):
+                    if x is None:
+                        continue
+                    # Sums of squares in double precision
+                    x = N.asarray(x,dtype=float)
+                    S1[n] = S1[n] + x
+                    if n < 3:
+                        S2[n] = S2[n] + x**2
+                del member, x
+
+            # Sum over members of squared deviations from the mean
+            ssqU = S2[0] - S1[0]**2/nens
+            ssqV = S2[1] - S1[1]**2/nens
+            e = 0.5*(ssqU + ssqV)
+            if energy=='DTE':
+                ssqT = S2[2] - S1[2]**2/nens
+                e += 0.5*(mc.cp/270.0)*ssqT
+            e *= 2.0/(nens-1)
+            P = S1[3]/nens
+            DATA['values'].append(integrate_column(e,P,lower,upper)[0])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return DATA
+
+def iter_members(files,t,energy,pool=None,batch=1):
+    """
+    Yield the fields needed for difference energy from each file at
+    time index t, in order, reading no more than batch files ahead.
+    See load_energy_fields.
+
+    :param pool:    process pool to read with; None reads here.
+    :param batch:   number of files read at once with the pool
+    :type batch:    int
+    """
+    args = [(f,t,energy,True) for f in files]
+    if pool is None:
+        for a in args:
+            yield load_energy_fields(a)
         return
-    elif d_return and d_save:
-        #self.save_data(DATA,d_save,d_fname)
-        utils.save_data(DATA,d_save,d_fname)
-        #self.json_data(DATA,d_save,d_fname)
-        return DATA
+    for n in range(0,len(args),batch):
+        for fields in pool.map(load_energy_fields,args[n:n+batch]):
+            yield fields
 
-def DE_xyz(nc0,nc1,t_idx,energy,*args):
+def get_member_time_idx(files,ts):
+    """
+    Check the times are identical in all files, and return the
+    index of each time in ts.
+    """
+    Ws = [WRFOut(f,lazy=True) for f in files]
+    common, idx = align_axes([W.timeaxis for W in Ws])
+    # Make sure times are the same in all files
+    if not all(len(W.timeaxis)==len(common) for W in Ws):
+        print("Times are not identical between input files.")
+        raise Exception
+    print("Passed check for identical timestamps between "
+            "NetCDF files")
+    return Ws[0].timeaxis.index(ts).tolist()
+
+def load_members(files,t,energy,ncpus=1,with_P=True):
+    """
+    Read the fields needed for difference energy from each file
+    at time index t. See load_energy_fields.
+
+    :param ncpus:   if more than 1, read the files in a process pool.
+    :param with_P:  read pressure: True for every file, or one
+                    boolean per file.
+    :type with_P:   bool,list
+    :returns:       list of (U,V,T,P) for each file.
+    """
+    if with_P is True:
+        with_P = [True,]*len(files)
+    args = [(f,t,energy,p) for f,p in zip(files,with_P)]
+    if ncpus > 1:
+        pool = multiprocessing.Pool(min(ncpus,len(files)))
+        try:
+            fields = pool.map(load_energy_fields,args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fields = map(load_energy_fields,args)
+    return fields
+
+def load_energy_fields(args):
+    """
+    Read U, V (destaggered), T (DTE only) and P for one time, as
+    float32. Module-level, so it can be passed to a process pool.
+
+    :param args:    (path to wrfout file, time index, energy, and
+                    whether to read P)
+    :type args:     tuple
+    :returns:       (U,V,T,P); T is None for DKE, P None if not read.
+    """
+    fpath, t, energy, with_P = args
+    nc = Dataset(fpath,'r')
+    try:
+        U, V = destagger_uv(nc.variables['U'][t,...],nc.variables['V'][t,...],
+                            dtype=N.float32)
+        if with_P:
+            P = N.asarray(nc.variables['P'][t,...],dtype=N.float32)
+            P += nc.variables['PB'][t,...]
+        else:
+            P = None
+        if check_energy(energy)=='DTE':
+            T = N.asarray(nc.variables['T'][t,...],dtype=N.float32)
+        else:
+            T = None
+    finally:
+        nc.close()
+    return U, V, T, P
+
+def DE_xyz(nc0,nc1,t_idx,energy,lower=None,upper=None,chunk=None,
+            columns=False):
     """
     Computation for difference kinetic energy (DKE).
     Sums DKE over the 3D space, returns a time series.
 
-    Destaggering is not enabled as it introduces
-    computational cost that is of miniscule value considering
-    the magnitudes of output values.
+    Units changed: the result is the domain sum of pressure-weighted
+    column integrals, sum(e*dp)/g in J/m2, with e = 0.5*(du**2+dv**2)
+    (+ 0.5*(cp/Tr)*dT**2 for DTE). Older versions returned the
+    unweighted sum of 0.5*(du**2+dv**2) (+ kappa*dT**2) over grid
+    points (m2/s2), about three orders of magnitude smaller, so the
+    two must not be compared. See energystore.UNITS.
+
+    Each time is read in large contiguous tiles of rows (the whole time
+    step by default) rather than strip by strip. Each tile is reduced
+    to column-integrated energy in place, so peak memory is one tile
+    of U, V, T and P per member. The vertical integration is
+    diff_energy_column, as for DE_z.
 
     Inputs:
 
     nc0     :   netCDF file
     nc1     :   netCDF file
     t_idx   :   times indices to difference
-    energy  :   kinetic or total
-    *args   :   to catch lower/upper boundary which isn't relevant here
+    energy  :   kinetic (DKE) or total (DTE)
+    lower   :   lowest level, hPa (None for the whole column)
+    upper   :   highest level, hPa (None for the whole column)
+    chunk   :   number of rows (y) to read at once. None reads
+                the whole time step.
+    columns :   if True, also return the column-integrated 2D
+                map for each time.
 
     Outputs:
 
-    data    :   time series.
+    data    :   time series (list). If columns, (time series, list
+                of 2D arrays).
     """
-    # Wind data
-    U0 = nc0.variables['U']
-    V0 = nc0.variables['V']
-    U1 = nc1.variables['U']
-    V1 = nc1.variables['V']
-
-    if energy=='DTE':
-        T0 = nc0.variables['T']
-        T1 = nc1.variables['T']
-        R = 287.0 # Universal gas constant (J / deg K * kg)
-        Cp = 1004.0 # Specific heat of dry air at constant pressure (J / deg K * kg)
-        kappa = (R/Cp)
-
-    xlen = U0.shape[2]
+    energy = check_energy(energy)
+    t_idx = N.atleast_1d(t_idx)
+    ny = len(nc0.dimensions['south_north'])
+    nx = len(nc0.dimensions['west_east'])
+    if not chunk:
+        chunk = ny
 
     DKE = []
+    DKE2D = []
     for n,t in enumerate(t_idx):
-        print("Finding DKE at time {0} of {1}.".format(n,len(t)))
-        DKE_hr = 0   # Sum up all DKE for the 3D space
-        for i in range(xlen):
-            if energy=='kinetic':
-                DKE_hr += N.sum(0.5*((U0[t,:,:,i]-U1[t,:,:,i])**2 +
-                            (V0[t,:,:-1,i]-V1[t,:,:-1,i])**2))
-            elif energy=='total':
-                DKE_hr += N.sum(0.5*((U0[t,:,:,i]-U1[t,:,:,i])**2 +
-                            (V0[t,:,:-1,i]-V1[t,:,:-1,i])**2 +
-                            kappa*(T0[t,:,:,i]-T1[t,:,:,i])**2))
-        print("DTE at this time: {0}".format(DKE_hr))
-        DKE.append(DKE_hr)
+        print("Finding DKE at time {0} of {1}.".format(n+1,len(t_idx)))
+        DE = N.zeros((ny,nx))
+        for j0 in range(0,ny,chunk):
+            j1 = min(j0+chunk,ny)
+            # V needs the extra staggered row
+            U0, V0 = destagger_uv(nc0.variables['U'][t,:,j0:j1,:],
+                                    nc0.variables['V'][t,:,j0:j1+1,:])
+            U1, V1 = destagger_uv(nc1.variables['U'][t,:,j0:j1,:],
+                                    nc1.variables['V'][t,:,j0:j1+1,:])
+            P = nc0.variables['P'][t,:,j0:j1,:] + nc0.variables['PB'][t,:,j0:j1,:]
+            if energy=='DTE':
+                Td = nc0.variables['T'][t,:,j0:j1,:] - nc1.variables['T'][t,:,j0:j1,:]
+            else:
+                Td = None
+            DE[j0:j1,:], tile_sum = diff_energy_column(U0-U1,V0-V1,P,energy,
+                                                        Td,lower,upper)
+        print("DTE at this time: {0}".format(DE.sum()))
+        DKE.append(DE.sum())
+        if columns:
+            DKE2D.append(DE)
+    if columns:
+        return DKE, DKE2D
     return DKE
 
 def DE_z(nc0,nc1,t,energy,lower,upper):
     """
     Computation for difference kinetic energy (DKE).
-    Sums DKE over all levels between lower and upper,
+    Integrates DKE over all levels between lower and upper,
     for each grid point, and returns a 2D array.
 
-    Destaggering is not enabled as it introduces
-    computational cost that is of miniscule value considering
-    the magnitudes of output values.
-
-    Method finds levels nearest lower/upper hPa and sums between
-    them inclusively.
+    See diff_energy_column for the integration.
 
     Inputs:
 
     nc0     :   netCDF file
     nc1     :   netCDF file
     t       :   times index to difference
-    energy  :   kinetic or total
+    energy  :   kinetic (DKE) or total (DTE)
     lower   :   lowest level, hPa
     upper   :   highest level, hPa
 
     Outputs:
 
-    data    :   2D array.
+    data    :   list containing the 2D array.
     """
+    energy = check_energy(energy)
+    print_time = ''.join((nc0.variables['Times'][t]))
+    print("Calculating 3D grid for time {0}...".format(print_time))
 
-    # Speed up script by only referencing data, not
-    # loading it to a variable yet
-
-    # WIND
-    U0 = nc0.variables['U'][t,...]
-    U1 = nc1.variables['U'][t,...]
-    Ud = U0 - U1
-    #del U0, U1
-
-    V0 = nc0.variables['V'][t,...]
-    V1 = nc1.variables['V'][t,...]
-    Vd = V0 - V1
-    #del V0, V1
+    # Here we assume pressure columns are
+    # roughly the same between the two...
+    P = nc0.variables['P'][t,...] + nc0.variables['PB'][t,...]
 
-    # PERT and BASE PRESSURE
-    if lower or upper:
-        P0 = nc0.variables['P'][t,...]
-        PB0 = nc0.variables['PB'][t,...]
-        Pr = P0 + PB0
-        #del P0, PB1
-        # Here we assume pressure columns are
-        # roughly the same between the two...
+    U0, V0 = destagger_uv(nc0.variables['U'][t,...],nc0.variables['V'][t,...])
+    U1, V1 = destagger_uv(nc1.variables['U'][t,...],nc1.variables['V'][t,...])
 
     if energy=='DTE':
-        T0 = nc0.variables['T'][t,...]
-        T1 = nc1.variables['T'][t,...]
-        Td = T0 - T1
-        #del T0, T1
+        Td = nc0.variables['T'][t,...] - nc1.variables['T'][t,...]
+    else:
+        Td = None
 
-        R = 287.0 # Universal gas constant (J / deg K * kg)
-        Cp = 1004.0 # Specific heat of dry air at constant pressure (J / deg K * kg)
-        kappa = R/Cp
+    DKE2D, DKE_sum = diff_energy_column(U0-U1,V0-V1,P,energy,Td,lower,upper)
+    return [DKE2D,]
+
+def check_energy(energy):
+    """
+    Accept 'DKE'/'kinetic' or 'DTE'/'total'; return 'DKE' or 'DTE'.
+    """
+    if energy in ('DKE','kinetic'):
+        return 'DKE'
+    elif energy in ('DTE','total'):
+        return 'DTE'
+    else:
+        print("Energy must be DKE (kinetic) or DTE (total).")
+        raise Exception
 
-    xlen = Ud.shape[1] # 1 less than in V
-    ylen = Vd.shape[2] # 1 less than in U
-    zlen = Ud.shape[0] # identical in U & V
+def destagger_uv(U,V,dtype=float):
+    """
+    Move U and V from their staggered grids to mass points.
+    The last two axes are (y,x).
+    """
+    U = N.asarray(U,dtype=dtype)
+    V = N.asarray(V,dtype=dtype)
+    U = 0.5*(U[...,:-1] + U[...,1:])
+    V = 0.5*(V[...,:-1,:] + V[...,1:,:])
+    return U, V
+
+def diff_energy_column(dU,dV,P,energy='DKE',dT=None,lower=None,upper=None,
+                        Tr=270.0):
+    """
+    Column-integrated difference energy, vectorised over whole arrays.
+
+    Energy density per unit mass is
+        DKE: 0.5*(dU**2 + dV**2)
+        DTE: 0.5*(dU**2 + dV**2 + (cp/Tr)*dT**2)
+    and is integrated in pressure, sum(e*dp)/g, to give J/m2. The layer
+    thickness dp at each level is found from neighbouring levels. Levels
+    outside lower/upper (hPa) are masked out.
+
+    :param dU,dV:   wind differences at mass points, (...,z,y,x)
+    :type dU,dV:    N.ndarray
+    :param P:       pressure (Pa), same shape
+    :type P:        N.ndarray
+    :param energy:  'DKE' or 'DTE'
+    :type energy:   str
+    :param dT:      (potential) temperature difference, for DTE
+    :type dT:       N.ndarray
+    :param lower:   bottom of layer (hPa). None is the lowest level.
+    :type lower:    float
+    :param upper:   top of layer (hPa). None is the model top.
+    :type upper:    float
+    :param Tr:      reference temperature (K) for DTE
+    :type Tr:       float
+    :returns:       2D map (...,y,x), and its domain sum (...)
+    """
+    energy = check_energy(energy)
 
-    # Generator for lat/lon points
-    def latlon(nlats,nlons):
-        for i in range(nlats): # y-axis
-            for j in range(nlons): # x-axis
-                yield i,j
+    e = 0.5*(dU**2 + dV**2)
+    if energy == 'DTE':
+        e += 0.5*(mc.cp/Tr)*N.asarray(dT,dtype=float)**2
+    return integrate_column(e,P,lower,upper)
 
-    DKE = []
-    DKE2D = N.zeros((xlen,ylen))
-    print_time = ''.join((nc0.variables['Times'][t]))
-    print("Calculating 3D grid for time {0}...".format(print_time))
-    gridpts = latlon(xlen,ylen)
-    for gridpt in gridpts:
-        i,j = gridpt
-        # Find closest level to 'lower', 'upper'
-        if lower or upper:
-            P_col = Pr[:,j,i]
-        if lower:
-            low_idx = utils.closest(P_col,lower*100.0)
-        else:
-            low_idx = None
-        if upper:
-            upp_idx = utils.closest(P_col,upper*100.0)+1
-        else:
-            upp_idx = None
+def integrate_column(e,P,lower=None,upper=None):
+    """
+    Integrate an energy density e (J/kg) in pressure, sum(e*dp)/g,
+    between lower and upper (hPa). See diff_energy_column.
 
-        zidx = slice(low_idx,upp_idx)
+    :returns:       2D map (...,y,x), and its domain sum (...)
+    """
+    P = N.asarray(P,dtype=float)
+    zax = P.ndim - 3
 
-        if energy=='DKE':
-            DKE2D[j,i] = N.sum(0.5*((Ud[zidx,j,i])**2 +
-                                (Vd[zidx,j,i])**2))
-        elif energy=='DTE':
-            DKE2D[j,i] = N.sum(0.5*((Ud[zidx,j,i])**2 +
-                                (Vd[zidx,j,i])**2 +
-                                kappa*(Td[zidx,j,i])**2))
+    # Layer thickness (Pa) at each level
+    dp = N.abs(N.gradient(P,axis=zax))
 
-    DKE.append(DKE2D)
+    inlayer = N.ones(P.shape,dtype=bool)
+    if lower:
+        inlayer &= P <= lower*100.0
+    if upper:
+        inlayer &= P >= upper*100.0
 
-    return DKE
+    DE2D = N.sum(N.where(inlayer,e*dp,0.0),axis=zax)/mc.g
+    DE_sum = DE2D.sum(axis=(-2,-1))
+    return DE2D, DE_sum
 
 def DKE_power_spectrum(data,dx):
     """
@@ -0,0 +1,264 @@
+"""On-disk store of derived fields, shared between runs.
+
+Scripts that are re-run against the same archived wrfout files
+recompute the same derived fields (composite reflectivity, PMSL, shear,
+theta-e, pressure-level interpolations...) every time. FieldStore keeps
+each field returned by WRFOut.get as a .npy file whose name is a hash
+of the source file's identity and the request (variable, time, level,
+lat/lon indices, other). A changed or replaced wrfout file has a new
+identity, so stale fields are never read.
+
+Files are written to a temporary name and renamed, so processes sharing
+a store never read a partial file. Once the store is larger than its
+byte budget, the least recently used files are deleted.
+
+The store is either a directory of its own, or 'sidecar': a .wem_store
+directory next to each wrfout file.
+"""
+
+import os
+import glob
+import hashlib
+import tempfile
+import numpy as N
+
+# Bump when the file layout changes, so old files are not read
+STORE_VERSION = 2
+
+SIDECAR = '.wem_store'
+
+# Stores opened in this process, keyed by directory
+STORES = {}
+
+# Content hashes already computed, keyed by (path,size,mtime)
+HASHES = {}
+
+def get_store(root,max_bytes):
+    """
+    Return the shared FieldStore for this directory.
+
+    :param root:        directory of the store
+    :type root:         str
+    :param max_bytes:   size limit in bytes. 0 for no limit.
+    :type max_bytes:    int
+    """
+    root = os.path.abspath(root)
+    if root not in STORES:
+        STORES[root] = FieldStore(root,max_bytes)
+    return STORES[root]
+
+def store_for_file(fpath,location,max_bytes,identity='stat'):
+    """
+    Return the store used for a wrfout file, and that file's identity.
+
+    :param fpath:       path to the wrfout file
+    :type fpath:        str
+    :param location:    'sidecar' for a directory next to the file,
+                        otherwise the directory of the store.
+    :type location:     str
+    :param identity:    see file_identity
+    :type identity:     str
+    """
+    if location == 'sidecar':
+        root = os.path.join(os.path.dirname(os.path.abspath(fpath)),SIDECAR)
+    else:
+        root = location
+    return get_store(root,max_bytes), file_identity(fpath,identity)
+
+def file_identity(fpath,identity='stat'):
+    """
+    String identifying the contents of a file.
+
+    :param identity:    'stat' uses the real path, size and
+                        modification time (cheap). 'md5' hashes the
+                        contents, so copies of a file share fields;
+                        each file is hashed once per process.
+    :type identity:     str
+    """
+    fpath = os.path.realpath(fpath)
+    st = os.stat(fpath)
+    stat = (fpath,st.st_size,st.st_mtime)
+    if identity == 'stat':
+        return repr(stat)
+    elif identity == 'md5':
+        if stat not in HASHES:
+            h = hashlib.md5()
+            with open(fpath,'rb') as f:
+                for chunk in iter(lambda: f.read(2**24),b''):
+                    h.update(chunk)
+            HASHES[stat] = h.hexdigest()
+        return HASHES[stat]
+    else:
+        print("Identity must be 'stat' or 'md5'.")
+        raise Exception
+
+class FieldStore(object):
+    """
+    Directory of .npy files, one per field, with a byte budget.
+    """
+    def __init__(self,root,max_bytes):
+        """
+        :param root:        directory of the store (created if needed)
+        :type root:         str
+        :param max_bytes:   size limit in bytes. 0 for no limit.
+        :type max_bytes:    int
+        """
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.writable = True
+        # Size on disk, found by scanning the first time it is needed
+        self.nbytes = None
+
+    def fname(self,ident,key):
+        """
+        Path of the file holding this field.
+
+        :param ident:   identity of the source file (file_identity)
+        :type ident:    str
+        :param key:     request, as returned by cache.make_key
+        :type key:      tuple
+        """
+        h = hashlib.sha1(repr((STORE_VERSION,ident,key))).hexdigest()
+        return os.path.join(self.root,h[:2],h+'.npy')
+
+    def get(self,ident,key):
+        """
+        Return the stored array, or None if absent or unreadable.
+        Masked arrays come back masked.
+        """
+        fpath = self.fname(ident,key)
+        if not os.path.exists(fpath):
+            self.misses += 1
+            return None
+        try:
+            data = N.load(fpath)
+            mpath = fpath[:-4]+'_mask.npy'
+            if os.path.exists(mpath):
+                data = N.ma.array(data,mask=N.load(mpath))
+        except Exception:
+            print("Could not read stored field {0}.".format(fpath))
+            self.misses += 1
+            return None
+        # Mark as recently used, for eviction
+        try:
+            os.utime(fpath,None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self,ident,key,data):
+        """
+        Write an array to the store, then evict old files if the
+        store is over its budget.
+
+        A masked array's mask is always written, even if nothing is
+        masked, so a stored field comes back as the same type.
+
+        A store that can't be written to (e.g. a read-only archive
+        in sidecar mode) is only read from after the first failure.
+        """
+        if not self.writable:
+            return
+        fpath = self.fname(ident,key)
+        written = 0
+        try:
+            if N.ma.isMaskedArray(data):
+                written += self.write(fpath[:-4]+'_mask.npy',N.ma.getmaskarray(data))
+            written += self.write(fpath,N.ma.getdata(data))
+        except (IOError,OSError):
+            print("Could not write to field store {0}; only reading from it.".format(
+                    self.root))
+            self.writable = False
+            return
+        if self.max_bytes:
+            if self.nbytes is None:
+                self.nbytes = self.scan()[1]
+            else:
+                self.nbytes += written
+            if self.nbytes > self.max_bytes:
+                self.evict()
+
+    def write(self,fpath,arr):
+        """
+        Save arr to fpath through a temporary file and a rename.
+
+        :returns:   bytes written
+        """
+        dirname = os.path.dirname(fpath)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process may have just created it
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname,suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                N.save(f,arr)
+            os.rename(tmp,fpath)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return os.path.getsize(fpath)
+
+    def scan(self):
+        """
+        List the stored files, least recently used first.
+
+        :returns:   list of (time of last use, size, path), and total size
+        """
+        files = []
+        for fpath in glob.glob(os.path.join(self.root,'*','*.npy')):
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                # Removed by another process
+                continue
+            files.append((st.st_mtime,st.st_size,fpath))
+        files.sort()
+        return files, sum(f[1] for f in files)
+
+    def evict(self,target=0.8):
+        """
+        Delete least recently used files until the store is below
+        a fraction 'target' of its budget.
+        """
+        files, nbytes = self.scan()
+        limit = target*self.max_bytes
+        for mtime, size, fpath in files:
+            if nbytes <= limit:
+                break
+            if fpath.endswith('_mask.npy'):
+                # Removed with its field
+                continue
+            for f in (fpath,fpath[:-4]+'_mask.npy'):
+                try:
+                    nbytes -= os.path.getsize(f)
+                    os.remove(f)
+                except OSError:
+                    pass
+        self.nbytes = nbytes
+
+    def clear(self):
+        """
+        Delete every stored field.
+        """
+        for mtime, size, fpath in self.scan()[0]:
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Return a dictionary of hits, misses, number of files and bytes used.
+        """
+        files, nbytes = self.scan()
+        return {'hits':self.hits,'misses':self.misses,'files':len(files),
+                'nbytes':nbytes,'max_bytes':self.max_bytes,'root':self.root}
@@ -0,0 +1,166 @@
+"""Time axis of a wrfout file, with fast time-index lookup.
+
+The Times variable is a (time, 19) character array such as
+'2013-08-15_00:00:00'. TimeAxis decodes it once, as a whole array,
+to integer epoch seconds and numpy datetime64. Exact times are found
+through a dictionary and other times are matched to the nearest
+index with a vectorised binary search.
+"""
+
+import datetime
+import numpy as N
+
+import WEM.utils as utils
+
+def parse_wrf_times(times):
+    """
+    Convert the WRF Times character array to epoch seconds.
+
+    :param times:   Times variable, (time, 19) array of characters
+    :type times:    N.ndarray
+    :returns:       N.ndarray of int64 epoch seconds
+    """
+    chars = N.ascontiguousarray(N.ma.getdata(times)).astype('S1')
+    strs = chars.view('S{0}'.format(chars.shape[-1])).ravel()
+    iso = N.char.replace(strs,b'_',b'T')
+    return iso.astype('datetime64[s]').astype(N.int64)
+
+def to_epoch(utc):
+    """
+    Convert one or more times to a 1D array of epoch seconds.
+
+    Epoch integers/floats, arrays of them, datetime64 and
+    datetime.datetime are converted directly; time tuples go through
+    utils.ensure_datenum.
+
+    :param utc:     time(s)
+    :type utc:      int,float,tuple,list,N.ndarray,datetime.datetime
+    :returns:       N.ndarray of int64 epoch seconds
+    """
+    if isinstance(utc,(int,long,float,N.integer,N.floating)):
+        return N.array([utc],dtype=N.int64)
+    elif isinstance(utc,N.ndarray):
+        if N.issubdtype(utc.dtype,N.datetime64):
+            return utc.astype('datetime64[s]').astype(N.int64).ravel()
+        return utc.astype(N.int64).ravel()
+    elif isinstance(utc,N.datetime64):
+        return N.array([utc.astype('datetime64[s]').astype(N.int64)])
+    elif isinstance(utc,datetime.datetime):
+        return to_epoch(N.datetime64(utc,'s'))
+    dn = utils.ensure_datenum(utc)
+    return N.array(utils.get_sequence(dn),dtype=N.int64)
+
+class TimeAxis(object):
+    """
+    Sorted times of one file, in epoch seconds.
+    """
+    def __init__(self,epoch):
+        """
+        :param epoch:   times in epoch seconds, in increasing order
+        :type epoch:    list,N.ndarray
+        """
+        self.epoch = N.asarray(epoch,dtype=N.int64).ravel()
+        self.datetime64 = self.epoch.astype('datetime64[s]')
+        self.lookup = dict((t,n) for n,t in enumerate(self.epoch.tolist()))
+
+    @classmethod
+    def from_wrf(cls,times):
+        """
+        Create from the Times variable of a wrfout file.
+        """
+        return cls(parse_wrf_times(times))
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def __eq__(self,other):
+        return (isinstance(other,TimeAxis) and
+                N.array_equal(self.epoch,other.epoch))
+
+    def __ne__(self,other):
+        return not self == other
+
+    def index(self,utc,exact=False):
+        """
+        Index of each time in utc.
+
+        Times on the axis are found by dictionary lookup; others
+        are matched to the nearest time, unless exact is True.
+
+        :param utc:     time(s), in any format accepted by to_epoch
+        :param exact:   raise an Exception for times not on the axis
+        :type exact:    bool
+        :returns:       N.ndarray of indices
+        """
+        dns = to_epoch(utc)
+        if len(dns) == 1:
+            idx = self.lookup.get(int(dns[0]),None)
+            if idx is not None:
+                return N.array([idx])
+        idx = self.nearest(dns)
+        if exact and not N.all(self.epoch[idx] == dns):
+            print("Time(s) {0} not found in file.".format(
+                    dns[self.epoch[idx] != dns]))
+            raise Exception
+        return idx
+
+    def nearest(self,dns):
+        """
+        Vectorised nearest-time lookup.
+
+        :param dns:     epoch seconds
+        :type dns:      N.ndarray
+        :returns:       N.ndarray of indices of the closest times
+        """
+        dns = N.asarray(dns,dtype=N.int64)
+        nt = len(self.epoch)
+        hi = N.clip(N.searchsorted(self.epoch,dns),1,max(nt-1,1))
+        lo = hi - 1
+        if nt == 1:
+            return N.zeros(dns.shape,dtype=int)
+        # Ties go to the earlier time, as utils.closest does
+        later = N.abs(self.epoch[hi]-dns) < N.abs(dns-self.epoch[lo])
+        return N.where(later,hi,lo)
+
+    def range(self,utc0,utc1):
+        """
+        Indices of all times from utc0 up to (not including) utc1.
+        """
+        idx0 = self.index(utc0)[0]
+        idx1 = self.index(utc1)[0]
+        return N.arange(idx0,idx1)
+
+    def align(self,other):
+        """
+        Times shared with another TimeAxis.
+
+        :returns:   common epoch times, and their indices in
+                    self and in other.
+        """
+        if self == other:
+            idx = N.arange(len(self))
+            return self.epoch.copy(), idx, idx.copy()
+        common = N.intersect1d(self.epoch,other.epoch)
+        return (common,N.searchsorted(self.epoch,common),
+                    N.searchsorted(other.epoch,common))
+
+def align_axes(axes):
+    """
+    Times shared by all of several TimeAxis objects, e.g. the
+    members of an ensemble.
+
+    When all axes are identical (the usual case) no searching is done.
+
+    :param axes:    TimeAxis objects
+    :type axes:     list
+    :returns:       common epoch times, and a list of index arrays
+                    (one per axis) for those times.
+    """
+    first = axes[0]
+    if all(ax == first for ax in axes[1:]):
+        idx = N.arange(len(first))
+        return first.epoch.copy(), [idx,]*len(axes)
+    common = first.epoch
+    for ax in axes[1:]:
+        common = N.intersect1d(common,ax.epoch)
+    return common, [N.searchsorted(ax.epoch,common) for ax in axes]
@@ -24,7 +24,7 @@ class TimeSeries:
             # W = self.get_netcdf(enspath,ncf=ncf,nct=nct,dom=dom)
             # W = WRFOut(enspath)
             times = W.utc
-            ts = W.get(vrbl,utc=False,lats=self.lat,lons=self.lon)[:,0,0,0]
+            ts = W.get_points(vrbl,self.lat,self.lon)[:,0,0]
             if vrbl == 'T2':
                 ts -= 273.15
             # import pdb; pdb.set_trace()
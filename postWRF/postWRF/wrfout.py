@@ -19,6 +19,15 @@ import datetime
 
 import WEM.utils as utils
 import metconstants as mc
+from grid import get_grid
+from cache import FieldCache, make_key, readonly
+from store import store_for_file
+from interp import VerticalInterpolator, layer_winds
+from timeaxis import TimeAxis
+from stations import get_station_weights
+from coldpool import (cold_pool_C, cold_pool_C2, cold_pool_depth,
+                        along_gradient, find_gust_front)
+from defaults import Defaults
 
 debug_get = 0
 
@@ -28,30 +37,47 @@ class WRFOut(object):
     An instance of WRFOut contains all the methods that are used to
     access and process netCDF data.
     """
-    def __init__(self,fpath):
+    # Attributes that are read from the file the first time they are
+    # accessed, mapped to the method that loads them.
+    lazy_attrs = {'wrf_times':'load_times','utc':'load_times',
+                    'timeaxis':'load_times',
+                    'grid':'load_grid','lats':'load_grid','lons':'load_grid',
+                    'lats1D':'load_grid','lons1D':'load_grid',
+                    'P_top':'load_ptop'}
+
+    def __init__(self,fpath,lazy=False,cache_bytes=None,store=None):
         """
         Initialisation fetches and computes basic user-friendly
         variables that are most oftenly accessed.
 
+        If lazy is True, only the header (global attributes, dimensions
+        and variable names) is read here. Times, lat/lon arrays and
+        P_top are loaded when first accessed. This keeps loops over many
+        ensemble members from reading data they never use.
+
+        Lat/lon arrays are shared between all instances on the same
+        grid (see grid.py).
+
         :param fpath:   absolute path to netCDF4 (wrfout) file
         :type fpath:    str
+        :param lazy:    if True, defer loading anything but the header
+        :type lazy:     bool
+        :param cache_bytes: memory budget for arrays cached by get().
+                            None uses the default setting; 0 disables.
+        :type cache_bytes:  int
+        :param store:       on-disk store of derived fields (store.py):
+                            'sidecar', a directory, or False to disable.
+                            None uses Defaults().field_store.
+        :type store:        str,bool
 
         """
 
         self.path = fpath
         self.nc = Dataset(fpath,'r')
 
-        self.wrf_times = self.nc.variables['Times'][:]
         self.dx = self.nc.DX
         self.dy = self.nc.DY
 
-        #self.lvs =
-        self.lats = self.nc.variables['XLAT'][0,...] # Might fail if only one time?
-        self.lons = self.nc.variables['XLONG'][0,...]
-
-        self.lats1D = self.lats[:,len(self.lats)/2]
-        self.lons1D = self.lons[len(self.lons)/2,:]
-
         self.cen_lat = float(self.nc.CEN_LAT)
         self.cen_lon = float(self.nc.CEN_LON)
         self.truelat1 = float(self.nc.TRUELAT1)
@@ -60,38 +86,72 @@ class WRFOut(object):
         self.y_dim = len(self.nc.dimensions['south_north'])
         self.z_dim = len(self.nc.dimensions['bottom_top'])
 
-        self.P_top = self.nc.variables['P_TOP'][0]
         # Loads variable lists
         self.fields = self.nc.variables.keys()
-        self.computed_fields = self.return_tbl().keys()
+        self.computed_fields = self.derived.keys()
         self.available_vrbls = self.fields + self.computed_fields
 
-        # Get times in nicer format
-        self.utc = self.wrftime_to_datenum()
-        # import pdb; pdb.set_trace()
+        # Arrays returned by get() are cached, so derived variables
+        # don't re-read the same raw fields from disk.
+        if cache_bytes is None:
+            cache_bytes = Defaults().cache_bytes
+        self.cache = FieldCache(cache_bytes)
+        # Arrays held for the duration of one planned request
+        self.scope = None
+
+        # Derived fields kept on disk between runs
+        D = Defaults()
+        if store is None:
+            store = D.field_store
+        if store:
+            self.store, self.identity = store_for_file(fpath,store,
+                                    D.field_store_bytes,D.field_store_identity)
+        else:
+            self.store = None
 
-    def wrftime_to_datenum(self):
-        """
-        Convert wrf's weird Times variable to datenum time.
+        if not lazy:
+            self.load_times()
+            self.load_grid()
+            self.load_ptop()
 
+    def __getattr__(self,attr):
         """
-        times = self.wrf_times
-        wrf_times_epoch = N.zeros([times.shape[0]])
+        Only called when normal lookup fails; loads lazy attributes.
+        """
+        loader = WRFOut.lazy_attrs.get(attr,None)
+        if (loader is None) or ('nc' not in self.__dict__):
+            raise AttributeError(attr)
+        getattr(self,loader)()
+        return self.__dict__[attr]
 
-        for n,t in enumerate(times):
-            tstr = ''.join(t)
+    def load_times(self):
+        """
+        Read the Times variable and convert to datenum.
+        """
+        self.wrf_times = self.nc.variables['Times'][:]
+        self.timeaxis = TimeAxis.from_wrf(self.wrf_times)
+        # Get times in nicer format
+        self.utc = self.wrftime_to_datenum()
 
-            yr = int(tstr[0:4])
-            mth = int(tstr[5:7])
-            day = int(tstr[8:10])
-            hr = int(tstr[11:13])
-            mins = int(tstr[14:16])
-            sec = int(tstr[17:19])
+    def load_grid(self):
+        """
+        Attach the shared lat/lon grid for this file.
+        """
+        self.grid = get_grid(self.nc)
+        self.lats = self.grid.lats
+        self.lons = self.grid.lons
+        self.lats1D = self.grid.lats1D
+        self.lons1D = self.grid.lons1D
 
-            wrf_times_epoch[n] = calendar.timegm([yr,mth,day,hr,mins,sec])
+    def load_ptop(self):
+        self.P_top = self.nc.variables['P_TOP'][0]
 
-        return wrf_times_epoch
+    def wrftime_to_datenum(self):
+        """
+        Convert wrf's weird Times variable to datenum time.
 
+        """
+        return self.timeaxis.epoch.astype(float)
 
     def get_time_idx(self,utc):
 
@@ -101,13 +161,7 @@ class WRFOut(object):
         :returns tidx:  int -- closest index to desired time
 
         """
-        # import pdb; pdb.set_trace()
-        dn = utils.ensure_datenum(utc)
-        dns = utils.get_sequence(dn)
-        tidx = []
-        for t in dns:
-            tidx.append(utils.closest(self.utc,t))
-        return N.array(tidx)
+        return self.timeaxis.index(utc)
 
 
     def check_compute(self,vrbl):
@@ -131,21 +185,21 @@ class WRFOut(object):
         all indices. Useful for self.get() to return an
         array of data with all times between utc0 and utc1.
         """
-        idx0 = self.get_time_idx(utc0)
-        idx1 = self.get_time_idx(utc1)
-        return N.arange(idx0,idx1)
+        return self.timeaxis.range(utc0,utc1)
 
 
     def get(self,vrbl,utc=False,level=False,lats=False,lons=False,
-                smooth=1,other=False):
+                smooth=1,other=False,bounds=False):
         """
         Get data.
 
         Will interpolate onto pressure, height coordinates if needed.
         Will smooth if needed.
 
-        :param vrbl:        WRF or computed variable required
-        :type vrbl:         str
+        :param vrbl:        WRF or computed variable required. If a list,
+                            all are computed together and a dictionary
+                            of arrays is returned.
+        :type vrbl:         str,list
         :param utc:         indices (<500): integer/N.ndarray of integers.
                             time tuple: 6-item tuple or list/tuple of these.
                             datenum: integer >500 or list of them.
@@ -164,6 +218,17 @@ class WRFOut(object):
         Lons:
         * indices: integer or N.ndarray of integers
         * lons: float or N.ndarray of floats
+
+        Lats and lons can also be slices of indices (index bounds).
+        Only that block is read from disk.
+
+        Bounds:
+        * dictionary of Nlim, Elim, Slim, Wlim (lat/lon bounding box).
+          Converted to index bounds; overrides lats/lons.
+
+        The array returned is always the caller's own, writable copy,
+        whether it was read, computed, or found in the cache (which
+        keeps a separate read-only copy). It can be changed in place.
         """
         # import pdb; pdb.set_trace()
         # Time
@@ -197,12 +262,18 @@ class WRFOut(object):
             raise Exception
 
         # Lat/lon
+        if isinstance(bounds,dict):
+            lats, lons = self.get_subdomain_idx(bounds['Nlim'],bounds['Elim'],
+                                    bounds['Slim'],bounds['Wlim'])
         if not type(lats)==type(lons):
             # What about case where all lats with one lon?
             raise Exception
         if lats is False:
             lonidx = False
             latidx = False
+        elif isinstance(lons,slice):
+            lonidx = lons
+            latidx = lats
         elif isinstance(lons,(list,tuple,N.ndarray)):
             if isinstance(lons[0],int):
                 lonidx = lons
@@ -215,15 +286,49 @@ class WRFOut(object):
             lonidx = lons
             latidx = lats
         elif isinstance(lons,float):
-            # Interpolate to lat/lon
-            lonidx = utils.closest(self.lons1D,lons)
-            latidx = utils.closest(self.lats1D,lats)
+            # Nearest grid point to lat/lon
+            latidx, lonidx = self.get_XY(lats,lons)
         else:
             print("Invalid lat/lon selection.")
             raise Exception
         # Check if computing required
         # When data is loaded from nc, it is destaggered
 
+        # Pressure-level requests must be keyed by the level itself
+        lvkey = level if lvidx is 'isobaric' else lvidx
+
+        # Several variables at once: plan them together
+        if isinstance(vrbl,(list,tuple)):
+            halo = max([self.halos.get(v,0) for v in vrbl])
+            if halo:
+                return self.evaluate_with_halo(vrbl,tidx,lvkey,lonidx,latidx,
+                                                other,halo)
+            return self.evaluate(vrbl,tidx,lvkey,lonidx,latidx,other)
+
+        key = make_key(vrbl,tidx,lvkey,lonidx,latidx,other)
+        if (self.scope is not None) and (key in self.scope):
+            return self.scope[key].view()
+        data = self.cache.get(key)
+        if data is not None:
+            if debug_get:
+                print("Variable {0} found in cache.".format(vrbl))
+            if self.scope is not None:
+                self.scope[key] = data
+                return data
+            return data.copy()
+
+        # Derived and pressure-level fields asked for by the user
+        # are kept in the on-disk store
+        stored = ((self.store is not None) and (self.scope is None) and
+                    ((not self.check_compute(vrbl)) or (lvidx is 'isobaric')))
+        if stored:
+            data = self.store.get(self.identity,key)
+            if data is not None:
+                if debug_get:
+                    print("Variable {0} found in store.".format(vrbl))
+                self.cache.put(key,data)
+                return data
+
         if debug_get:
             print("Computing {0} for level {1} of index {2}".format(vrbl,level,lvidx))
 
@@ -240,11 +345,20 @@ class WRFOut(object):
         else:
             if debug_get:
                 print("Variable {0} needs to be computed.".format(vrbl))
-            if lvidx is 'isobaric':
-                # data = self.get_p(vrbl,tidx,level,lonidx, latidx)[N.newaxis,N.newaxis,:,:]
-                data = self.compute(vrbl,tidx,level,lonidx,latidx,other)
-            else:
-                data = self.compute(vrbl,tidx,lvidx,lonidx,latidx,other)
+            if self.scope is None:
+                # Top-level request: resolve dependencies first
+                halo = self.halos.get(vrbl,0)
+                if halo:
+                    data = self.evaluate_with_halo([vrbl,],tidx,lvkey,lonidx,
+                                                latidx,other,halo)[vrbl]
+                    self.cache.put(key,data)
+                else:
+                    data = self.evaluate([vrbl,],tidx,lvkey,lonidx,latidx,other)[vrbl]
+                if stored:
+                    self.store.put(self.identity,key,data)
+                return data
+            # data = self.get_p(vrbl,tidx,level,lonidx, latidx)[N.newaxis,N.newaxis,:,:]
+            data = self.compute(vrbl,tidx,lvkey,lonidx,latidx,other)
 
         # if len(data.shape) == 2:
             # data = data[N.newaxis,N.newaxis,:,:]
@@ -253,10 +367,25 @@ class WRFOut(object):
         # if len(data.shape) == 3:
             # data = N.expand_dims(data,axis=0)
         data = self.make_4D(data,vrbl=vrbl)
+        cached = self.cache.put(key,data)
+        if self.scope is not None:
+            self.scope[key] = cached if cached is not None else readonly(data)
+        if stored:
+            self.store.put(self.identity,key,data)
 
         # import pdb; pdb.set_trace()
         return data
 
+    def cache_info(self):
+        """
+        Return hit/miss counts and memory use of the get() cache,
+        and of the on-disk store if one is used.
+        """
+        stats = self.cache.stats()
+        if self.store is not None:
+            stats['store'] = self.store.stats()
+        return stats
+
     def load(self,vrbl,tidx,lvidx,lonidx,latidx):
         """
         Fetch netCDF data for a given variable, for given time, level,
@@ -269,6 +398,13 @@ class WRFOut(object):
         :param lvidx:       level index. False fetches all
         :type lvidx:        boot, int, numpy.ndarray
 
+        Staggered variables are returned at mass points along every
+        dimension, including the vertical: an index or slice selects
+        mass levels, and the staggered points either side are read and
+        averaged. (Before subdomain reads were added, a single index
+        on a staggered vertical dimension, e.g. Z, PH or W at level 0,
+        returned the staggered level itself.)
+
         TODO: Get rid of integer arguments earlier in the method chain, and
         make them single-element numpy arrays.
         """
@@ -283,55 +419,56 @@ class WRFOut(object):
         sl = self.create_slice(vrbl,tidx,lvidx,lonidx,latidx,dim_names)
         # import pdb; pdb.set_trace()
         # If that dimension has a slice of indices, it doesn't need staggering.
+        step = 1
         if destag_dim and isinstance(sl[destag_dim],N.ndarray):
             destag_dim = None
-
-        data = self.destagger(vrbldata[sl],destag_dim)
+        elif destag_dim:
+            stag = sl[destag_dim]
+            step = stag.step or 1
+            if step < 0:
+                print("Reversed slices of staggered dimensions are not supported.")
+                raise Exception
+            # Read a unit-stride span, with the extra staggered point
+            # that destaggering needs; subsample afterwards
+            stop = None if stag.stop is None else stag.stop+1
+            sl[destag_dim] = slice(stag.start,stop)
+
+        data = self.destagger(vrbldata[tuple(sl)],destag_dim)
+        if step > 1:
+            sub = [slice(None),]*data.ndim
+            sub[destag_dim] = slice(None,None,step)
+            data = data[tuple(sub)]
         return data
 
     def create_slice(self,vrbl,tidx,lvidx,lonidx,latidx,dim_names):
         """
         Create slices from indices of level, time, lat, lon.
         False mean pick all indices.
+
+        Slices are in the same order as the variable's dimensions.
         """
         # See which dimensions are present in netCDF file variable
         sl = []
         # pdb.set_trace()
-        if any('Time' in p for p in dim_names):
-            if tidx is False:
-                sl.append(slice(None,None))
-            elif isinstance(tidx,slice) or isinstance(tidx,N.ndarray):
-                sl.append(tidx)
-            else:
-                sl.append(slice(tidx,tidx+1))
-
-        if any('bottom' in p for p in dim_names):
-            if lvidx is False:
-                sl.append(slice(None,None))
-            elif isinstance(lvidx,int):
-                sl.append(slice(lvidx,lvidx+1))
-            elif isinstance(lvidx,N.ndarray):
-                sl.append(lvidx)
-            else:
-                sl.append(slice(None,None))
-
-        if any('west' in p for p in dim_names):
-            if lonidx is False:
-                sl.append(slice(None,None))
-            elif isinstance(lonidx,slice) or isinstance(lonidx,N.ndarray):
-                sl.append(lonidx)
-            elif isinstance(lonidx,int):
-                sl.append(slice(lonidx,lonidx+1))
+        for dim in dim_names:
+            if 'Time' in dim:
+                idx = tidx
+            elif 'bottom' in dim:
+                idx = lvidx
+            elif 'west' in dim:
+                idx = lonidx
+            elif 'north' in dim:
+                idx = latidx
             else:
                 sl.append(slice(None,None))
+                continue
 
-        if any('north' in p for p in dim_names):
-            if latidx is False:
+            if idx is False:
                 sl.append(slice(None,None))
-            elif isinstance(latidx,slice) or isinstance(latidx,N.ndarray):
-                sl.append(latidx)
-            elif isinstance(latidx,int):
-                sl.append(slice(latidx,latidx+1))
+            elif isinstance(idx,(slice,N.ndarray)):
+                sl.append(idx)
+            elif isinstance(idx,(int,N.integer)):
+                sl.append(slice(idx,idx+1))
             else:
                 sl.append(slice(None,None))
 
@@ -396,49 +533,291 @@ class WRFOut(object):
             data_unstag = 0.5*(data[sl0] + data[sl1])
             return data_unstag
 
+    # Derived variables. Each entry declares the method that computes
+    # it, the raw netCDF variables it reads, and the derived variables
+    # it depends on. A dependency can be (name,other) when the method
+    # asks for it with a particular 'other' argument.
+    # Add new variables with WRFOut.register_derived().
+    derived = {
+        'shear':            ('compute_shear',('U','V','HGT'),('Z',)),
+        'meanwind':         ('compute_meanwind',('U','V','HGT'),('Z',)),
+        'thetae':           ('compute_thetae',('QVAPOR',),('pressure','drybulb')),
+        'cref':             ('compute_comp_ref',(),('REFL_sim',)),
+        'REFL_sim':         ('compute_REFL_sim',('QRAIN','QSNOW','QGRAUP'),
+                                (('drybulb','K'),'pressure')),
+        'echotop':          ('compute_echotop',('HGT',),('REFL_sim','Z')),
+        'REFL_1km':         ('compute_REFL_1km',('HGT',),('REFL_sim','Z')),
+        'wind10':           ('compute_wind10',('U10','V10'),()),
+        'wind':             ('compute_wind',('U','V'),()),
+        'CAPE':             ('compute_CAPE',(),('theta','Z')),
+        'Td':               ('compute_Td',('QVAPOR',),('pressure',)),
+        'pressure':         ('compute_pressure',('P','PB'),()),
+        'drybulb':          ('compute_drybulb',(),('theta','pressure')),
+        'theta':            ('compute_theta',('T',),()),
+        'geopot':           ('compute_geopotential',('PH','PHB'),()),
+        'Z':                ('compute_geopotential_height',('PH','PHB'),()),
+        'dptp':             ('compute_dptp',(),('dpt',)), #density potential temperature pert.
+        'T2p':              ('compute_T2_pertub',('T2',),()),
+        'dpt':              ('compute_dpt',('QVAPOR','QCLOUD','QRAIN','QICE',
+                                'QSNOW','QGRAUP'),('theta',)), #density potential temperature .
+        'buoyancy':         ('compute_buoyancy',('QVAPOR',),('theta',)),
+        'strongestwind':    ('compute_strongest_wind',('WSPD10MAX',),('wind10',)),
+        'PMSL':             ('compute_pmsl',('PSFC','T2','HGT'),()),
+        'RH':               ('compute_RH',(),(('drybulb','C'),'Td')),
+        'dryairmass':       ('compute_dryairmass',('MU','MUB'),()),
+        'QTOTAL':           ('compute_qtotal',('QVAPOR','QCLOUD','QRAIN','QICE',
+                                'QSNOW','QGRAUP'),()),
+        'olr':              ('compute_olr',('OLR',),()),
+        'es':               ('compute_satvappres',(),(('drybulb','C'),)),
+        'e':                ('compute_vappres',(),('RH','es')),
+        'q':                ('compute_spechum',(),('es','pressure')),
+        'fluidtrapping':    ('compute_fluid_trapping_diagnostic',('U10','V10'),()),
+        'lyapunov':         ('compute_instantaneous_local_Lyapunov',('U','V'),()),
+        'REFL_comp':        ('compute_REFL_comp',('REFL_10CM',),()),
+        'temp_advection':   ('compute_temp_advection',('U','V'),('drybulb',)),
+        'omega':            ('compute_omega',('W',),('density',)),
+        'density':          ('compute_density',(),(('drybulb','K'),'pressure')),
+        # 'accum_precip':   ('compute_accum_rain',('RAINNC','RAINC'),()),
+        'PMSL_gradient':    ('compute_PMSL_gradient',(),('PMSL',)),
+        'T2_gradient':      ('compute_T2_gradient',('T2',),()),
+        'Q_pert':           ('compute_Q_pert',('QVAPOR',),()),
+        }
+
+    # Derived variables that need a halo of extra grid points (e.g. for
+    # horizontal gradients) when computed on a cropped block.
+    halos = {
+        'temp_advection':   1,
+        'PMSL_gradient':    1,
+        'T2_gradient':      1,
+        'fluidtrapping':    1,
+        'lyapunov':         1,
+        }
+
+    # Derived variables whose method reads all its inputs over the
+    # whole column (level=False), whatever level is asked for.
+    columns = set(['REFL_sim','cref','echotop','REFL_1km','shear','meanwind'])
+
+    @classmethod
+    def register_derived(cls,vrbl,func,raw=(),deps=(),halo=0,column=False):
+        """
+        Add a user-defined derived variable, available to all instances.
+
+        :param vrbl:    name used in get()
+        :type vrbl:     str
+        :param func:    function called as func(W,tidx,lvidx,lonidx,latidx,other)
+                        where W is the WRFOut instance. It should fetch
+                        its inputs with W.get(), like the compute_* methods.
+        :type func:     function
+        :param raw:     netCDF variables read by func
+        :type raw:      tuple
+        :param deps:    derived variables used by func. Use (name,other)
+                        for a dependency requested with an 'other' argument.
+        :type deps:     tuple
+        :param halo:    number of extra grid points func needs around a
+                        cropped block (e.g. 1 for centred differences)
+        :type halo:     int
+        :param column:  func reads its inputs with level=False (all
+                        levels), whatever level it is asked for.
+        :type column:   bool
+        """
+        cls.derived[vrbl] = (func,tuple(raw),tuple(deps))
+        if halo:
+            cls.halos[vrbl] = halo
+        if column:
+            cls.columns.add(vrbl)
+
     def return_tbl(self):
         """
         Returns a dictionary to look up method for computing a variable
         """
         tbl = {}
-        tbl['shear'] = self.compute_shear
-        tbl['thetae'] = self.compute_thetae
-        tbl['cref'] = self.compute_comp_ref
-        tbl['wind10'] = self.compute_wind10
-        tbl['wind'] = self.compute_wind
-        tbl['CAPE'] = self.compute_CAPE
-        tbl['Td'] = self.compute_Td
-        tbl['pressure'] = self.compute_pressure
-        tbl['drybulb'] = self.compute_drybulb
-        tbl['theta'] = self.compute_theta
-        tbl['geopot'] = self.compute_geopotential
-        tbl['Z'] = self.compute_geopotential_height
-        tbl['dptp'] = self.compute_dptp #density potential temperature pert.
-        tbl['T2p'] = self.compute_T2_pertub
-        tbl['dpt'] = self.compute_dpt #density potential temperature .
-        tbl['buoyancy'] = self.compute_buoyancy
-        tbl['strongestwind'] = self.compute_strongest_wind
-        tbl['PMSL'] = self.compute_pmsl
-        tbl['RH'] = self.compute_RH
-        tbl['dryairmass'] = self.compute_dryairmass
-        tbl['QTOTAL'] = self.compute_qtotal
-        tbl['olr'] = self.compute_olr
-        tbl['es'] = self.compute_satvappres
-        tbl['e'] = self.compute_vappres
-        tbl['q'] = self.compute_spechum
-        tbl['fluidtrapping'] = self.compute_fluid_trapping_diagnostic
-        tbl['lyapunov'] = self.compute_instantaneous_local_Lyapunov
-        tbl['REFL_comp'] = self.compute_REFL_comp
-        tbl['temp_advection'] = self.compute_temp_advection
-        tbl['omega'] = self.compute_omega
-        tbl['density'] = self.compute_density
-        # tbl['accum_precip'] = self.compute_accum_rain
-        tbl['PMSL_gradient'] = self.compute_PMSL_gradient
-        tbl['T2_gradient'] = self.compute_T2_gradient
-        tbl['Q_pert'] = self.compute_Q_pert
-
+        for vrbl in self.derived:
+            tbl[vrbl] = self.get_compute_method(vrbl)
         return tbl
 
+    def get_compute_method(self,vrbl):
+        """
+        Return a callable f(tidx,lvidx,lonidx,latidx,other) for a derived variable.
+        """
+        func = self.derived[vrbl][0]
+        if isinstance(func,basestring):
+            return getattr(self,func)
+        else:
+            return lambda *args: func(self,*args)
+
+    def plan(self,vrbls,lvidx=False):
+        """
+        Resolve the dependency graph of the requested variables.
+
+        :param vrbls:   variables requested
+        :type vrbls:    list,tuple
+        :param lvidx:   level the variables are requested at, as parsed
+                        by get(). Inputs of column variables (see
+                        self.columns) are planned at level=False instead.
+        :returns:       raw -- list of (netCDF variable, level) to read.
+                        order -- list of (derived variable, other, level)
+                        in the order they can be evaluated; dependencies
+                        come first.
+        """
+        raw = []
+        order = []
+        state = {}
+
+        def visit(vrbl,other,lv):
+            if vrbl in self.fields:
+                if (vrbl,lv) not in raw:
+                    raw.append((vrbl,lv))
+                return
+            node = (vrbl,other,lv)
+            if state.get(node) == 'done':
+                return
+            elif state.get(node) == 'visiting':
+                print("Circular dependency for {0}.".format(vrbl))
+                raise Exception
+            # Unknown variables raise KeyError, like a failed compute
+            func, rawlist, deps = self.derived[vrbl]
+            state[node] = 'visiting'
+            deplv = False if vrbl in self.columns else lv
+            for r in rawlist:
+                # Optional inputs (e.g. QSNOW) may be missing from the file
+                if (r in self.fields) and ((r,deplv) not in raw):
+                    raw.append((r,deplv))
+            for dep in deps:
+                if isinstance(dep,(tuple,list)):
+                    visit(dep[0],dep[1],deplv)
+                else:
+                    visit(dep,False,deplv)
+            state[node] = 'done'
+            order.append(node)
+
+        for vrbl in vrbls:
+            visit(vrbl,False,lvidx)
+        return raw, order
+
+    def evaluate(self,vrbls,tidx,lvidx,lonidx,latidx,other=False):
+        """
+        Compute several variables for one hyperslab with the minimum I/O.
+
+        The dependency graph is resolved once. Each raw variable is
+        read once, at the level it is used at, then derived variables
+        are computed in dependency order. Everything is held in
+        self.scope until the request is finished, whatever the cache
+        budget.
+
+        Arguments are indices as parsed by get().
+
+        :returns:       dictionary of 4D arrays, keyed by variable
+        """
+        raw, order = self.plan(vrbls,lvidx)
+        outer = self.scope is not None
+        if not outer:
+            self.scope = {}
+        try:
+            for r, rlv in raw:
+                self.get(r,tidx,rlv,lons=lonidx,lats=latidx)
+            for vrbl, vother, vlv in order:
+                if (vrbl in vrbls) and (vother is False) and (vlv is lvidx):
+                    # Requested variables use the caller's 'other'
+                    continue
+                self.get(vrbl,tidx,vlv,lons=lonidx,lats=latidx,other=vother)
+            data = {}
+            for vrbl in vrbls:
+                data[vrbl] = self.get(vrbl,tidx,lvidx,lons=lonidx,lats=latidx,other=other)
+                if (not outer) and (not data[vrbl].flags.writeable):
+                    # Computed as another's dependency: the caller owns the result
+                    data[vrbl] = data[vrbl].copy()
+        finally:
+            if not outer:
+                self.scope = None
+        return data
+
+    def evaluate_with_halo(self,vrbls,tidx,lvidx,lonidx,latidx,other,halo):
+        """
+        Like evaluate(), but widen slices of lat/lon indices by a
+        halo of grid points so that horizontal derivatives at the
+        edge of a cropped block match the full domain. The halo is
+        trimmed before returning.
+        """
+        latpad, latcrop = self.pad_slice(latidx,halo,self.y_dim)
+        lonpad, loncrop = self.pad_slice(lonidx,halo,self.x_dim)
+        data = self.evaluate(vrbls,tidx,lvidx,lonpad,latpad,other)
+        for vrbl in data:
+            data[vrbl] = data[vrbl][...,latcrop,loncrop]
+        return data
+
+    def pad_slice(self,sl,halo,n):
+        """
+        Widen a slice by halo points (limited by the domain size n).
+
+        :returns:       padded slice, and the slice that recovers
+                        the original block from the padded one.
+        """
+        if not isinstance(sl,slice):
+            return sl, slice(None,None)
+        start, stop, step = sl.indices(n)
+        if step != 1:
+            return sl, slice(None,None)
+        start0 = max(start-halo,0)
+        stop0 = min(stop+halo,n)
+        return slice(start0,stop0), slice(start-start0,stop-start0)
+
+    def get_subdomain_idx(self,Nlim,Elim,Slim,Wlim,npts=50):
+        """
+        Return lat and lon index bounds (slices) for a bounding box.
+
+        Points along the edges of the box are located on the grid, so
+        the slices cover the whole box even where lines of latitude
+        and longitude are curved on the grid (e.g. Lambert conformal).
+
+        :param npts:    number of points located along each edge
+        :type npts:     int
+        """
+        la = N.linspace(Slim,Nlim,npts)
+        lo = N.linspace(Wlim,Elim,npts)
+        edge_lats = N.concatenate((la,la,N.ones(npts)*Slim,N.ones(npts)*Nlim))
+        edge_lons = N.concatenate((N.ones(npts)*Wlim,N.ones(npts)*Elim,lo,lo))
+        y, x = self.get_XY(edge_lats,edge_lons)
+        lat_sl = slice(y.min(),y.max()+1)
+        lon_sl = slice(x.min(),x.max()+1)
+        return lat_sl, lon_sl
+
+    def get_points(self,vrbl,lats,lons,utc=False,level=False,other=False,
+                    method='bilinear'):
+        """
+        Interpolate a variable to many stations at once.
+
+        Only the box of grid points around the stations is read. The
+        weights are built once per grid and station list; see
+        stations.StationWeights.
+
+        :param vrbl:        variable, as for get()
+        :type vrbl:         str
+        :param lats,lons:   station latitudes and longitudes
+        :type lats,lons:    float,list,N.ndarray
+        :param method:      'bilinear' or 'idw'
+        :type method:       str
+        :returns:           array (time,level,station)
+        """
+        weights = get_station_weights(self.grid,lats,lons,method=method)
+        data = self.get(vrbl,utc=utc,level=level,lats=weights.lat_sl,
+                        lons=weights.lon_sl,other=other)
+        return weights(data)
+
+    def get_XY(self,lat,lon):
+        """
+        Return the grid indices of the nearest point(s) to lat/lon.
+        Points outside the domain are moved to the nearest edge.
+
+        See grid.Grid.get_idx, which accepts many points at once.
+
+        :param lat:     latitude(s)
+        :type lat:      float,list,N.ndarray
+        :param lon:     longitude(s)
+        :type lon:      float,list,N.ndarray
+        :returns:       y, x -- ints for one point, else int arrays.
+        """
+        return self.grid.get_idx(lat,lon)
+
     def compute(self,vrbl,tidx,lvidx,lonidx,latidx,other,lookup=0):
         """ Look up method needed to return array of data
         for required variable.
@@ -453,53 +832,53 @@ class WRFOut(object):
         lookup      :   enables a check to see if something can be
                         computed. Returns true or false.
         """
-        tbl = self.return_tbl()
         if lookup:
-            response = lookup in tbl
+            response = vrbl in self.derived
         else:
-            response = tbl[vrbl](tidx,lvidx,lonidx,latidx,other)
+            func = self.get_compute_method(vrbl)
+            response = func(tidx,lvidx,lonidx,latidx,other)
         return response
 
     def compute_RH(self,tidx,lvidx,lonidx,latidx,other):
 
-        T = self.get('drybulb',tidx,lvidx,lonidx,latidx,other='C')
-        Td = self.get('Td',tidx,lvidx,lonidx,latidx)
+        T = self.get('drybulb',tidx,lvidx,lons=lonidx,lats=latidx,other='C')
+        Td = self.get('Td',tidx,lvidx,lons=lonidx,lats=latidx)
         RH = N.exp(0.073*(Td-T))
         # pdb.set_trace()
         return RH*100.0
 
     def compute_temp_advection(self,tidx,lvidx,lonidx,latidx,other):
-        U = self.get('U',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        V = self.get('V',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        T = self.get('drybulb',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        dTdx, dTdy = N.gradient(T,self.DX,self.DY)
+        U = self.get('U',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        V = self.get('V',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        T = self.get('drybulb',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        dTdy, dTdx = N.gradient(T,self.dy,self.dx)
         field = -U*dTdx - V*dTdy
         # pdb.set_trace()
         return field
 
     def compute_PMSL_gradient(self,tidx,lvidx,lonidx,latidx,other):
-        P = self.get('PMSL',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        dPdx, dPdy = N.gradient(P,self.dx,self.dy)
+        P = self.get('PMSL',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        dPdy, dPdx = N.gradient(P,self.dy,self.dx)
         field = N.sqrt(dPdx**2 + dPdy**2)
         # import pdb; pdb.set_trace()
         return field
 
     def compute_T2_gradient(self,tidx,lvidx,lonidx,latidx,other):
-        T2 = self.get('T2',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        dTdx, dTdy = N.gradient(T2,self.dx,self.dy)
+        T2 = self.get('T2',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        dTdy, dTdx = N.gradient(T2,self.dy,self.dx)
         field = N.sqrt(dTdx**2 + dTdy**2)
         # import pdb; pdb.set_trace()
         return field
 
     def compute_dryairmass(self,tidx,lvidx,lonidx,latidx,other):
-        MU = self.get('MU',tidx,lvidx,lonidx,latidx)
-        MUB = self.get('MUB',tidx,lvidx,lonidx,latidx)
+        MU = self.get('MU',tidx,lvidx,lons=lonidx,lats=latidx)
+        MUB = self.get('MUB',tidx,lvidx,lons=lonidx,lats=latidx)
         return MU + MUB
 
     def compute_pmsl(self,tidx,lvidx,lonidx,latidx,other):
-        P = self.get('PSFC',tidx,lvidx,lonidx,latidx)
-        T2 = self.get('T2',tidx,lvidx,lonidx,latidx)
-        HGT = self.get('HGT',tidx,lvidx,lonidx,latidx)
+        P = self.get('PSFC',tidx,lvidx,lons=lonidx,lats=latidx)
+        T2 = self.get('T2',tidx,lvidx,lons=lonidx,lats=latidx)
+        HGT = self.get('HGT',tidx,lvidx,lons=lonidx,lats=latidx)
 
         temp = T2 + (6.5*HGT)/1000.0
         pmsl = P*N.exp(9.81/(287.0*temp)*HGT)
@@ -513,33 +892,33 @@ class WRFOut(object):
         """
         Method from Adams-Selin et al., 2013, WAF
         """
-        theta = self.get('theta',tidx,lvidx,lonidx,latidx)
+        theta = self.get('theta',tidx,lvidx,lons=lonidx,lats=latidx)
         thetabar = N.mean(theta)
-        qv = self.get('QVAPOR',tidx,lvidx,lonidx,latidx)
+        qv = self.get('QVAPOR',tidx,lvidx,lons=lonidx,lats=latidx)
         qvbar = N.mean(qv)
 
         B = cc.g * ((theta-thetabar)/thetabar + 0.61*(qv - qvbar))
         return B
 
     def compute_mixing_ratios(self,tidx,lvidx,lonidx,latidx,other=False):
-        qv = self.get('QVAPOR',tidx,lvidx,lonidx,latidx)
-        qc = self.get('QCLOUD',tidx,lvidx,lonidx,latidx)
-        qr = self.get('QRAIN',tidx,lvidx,lonidx,latidx)
+        qv = self.get('QVAPOR',tidx,lvidx,lons=lonidx,lats=latidx)
+        qc = self.get('QCLOUD',tidx,lvidx,lons=lonidx,lats=latidx)
+        qr = self.get('QRAIN',tidx,lvidx,lons=lonidx,lats=latidx)
 
         try:
-            qi = self.get('QICE',tidx,lvidx,lonidx,latidx)
+            qi = self.get('QICE',tidx,lvidx,lons=lonidx,lats=latidx)
         except KeyError:
             print("MP scheme has no ice data.")
             qi = 0
 
         try:
-            qs = self.get('QSNOW',tidx,lvidx,lonidx,latidx)
+            qs = self.get('QSNOW',tidx,lvidx,lons=lonidx,lats=latidx)
         except KeyError:
             print("MP scheme has no snow data.")
             qs = 0
 
         try:
-            qg = self.get('QGRAUP',tidx,lvidx,lonidx,latidx)
+            qg = self.get('QGRAUP',tidx,lvidx,lons=lonidx,lats=latidx)
         except KeyError:
             print("MP scheme has no graupel data.")
             qg = 0
@@ -554,19 +933,19 @@ class WRFOut(object):
         return qtotal
 
     def compute_dptp(self,tidx,lvidx,lonidx,latidx,other):
-        dpt = self.get('dpt',tidx,lvidx,lonidx,latidx)
+        dpt = self.get('dpt',tidx,lvidx,lons=lonidx,lats=latidx)
         dpt_mean = N.mean(dpt)
         dptp = dpt - dpt_mean
         return dptp
 
     def compute_T2_pertub(self,tidx,lvidx,lonidx,latidx,other):
-        T2 = self.get('T2',tidx,lvidx,lonidx,latidx)
+        T2 = self.get('T2',tidx,lvidx,lons=lonidx,lats=latidx)
         T2_mean = N.mean(T2)
         T2p = T2-T2_mean 
         return T2p
 
     def compute_Q_pert(self,tidx,lvidx,lonidx,latidx,other):
-        Q = self.get('QVAPOR',tidx,lvidx,lonidx,latidx)
+        Q = self.get('QVAPOR',tidx,lvidx,lons=lonidx,lats=latidx)
         Q_mean = N.mean(Q)
         Qp = Q-Q_mean
         return Qp
@@ -579,180 +958,219 @@ class WRFOut(object):
         """
         # if tidx,lvidx,lonidx,latidx['lv'] == 0:
             # tidx,lvidx,lonidx,latidx['lv'] = 0
-        theta = self.get('theta',tidx,lvidx,lonidx,latidx)
+        theta = self.get('theta',tidx,lvidx,lons=lonidx,lats=latidx)
         rh, rv = self.compute_mixing_ratios(tidx,lvidx,lonidx,latidx)
 
         dpt = theta * (1 + 0.61*rv - rh)
         return dpt
 
     def compute_geopotential_height(self,tidx,lvidx,lonidx,latidx,other):
-        geopotential = self.get('PH',tidx,lvidx,lonidx,latidx) + self.get('PHB',tidx,lvidx,lonidx,latidx)
+        geopotential = self.get('PH',tidx,lvidx,lons=lonidx,lats=latidx) + self.get('PHB',tidx,lvidx,lons=lonidx,lats=latidx)
         Z = geopotential/9.81
         return Z
 
     def compute_geopotential(self,tidx,lvidx,lonidx,latidx,other):
-        geopotential = self.get('PH',tidx,lvidx,lonidx,latidx) + self.get('PHB',tidx,lvidx,lonidx,latidx)
+        geopotential = self.get('PH',tidx,lvidx,lons=lonidx,lats=latidx) + self.get('PHB',tidx,lvidx,lons=lonidx,lats=latidx)
         return geopotential
 
     def compute_wind10(self,tidx,lvidx,lonidx,latidx,other):
-        u = self.get('U10',tidx,lvidx,lonidx,latidx)
-        v = self.get('V10',tidx,lvidx,lonidx,latidx)
+        u = self.get('U10',tidx,lvidx,lons=lonidx,lats=latidx)
+        v = self.get('V10',tidx,lvidx,lons=lonidx,lats=latidx)
         data = N.sqrt(u**2 + v**2)
         return data
 
     def compute_pressure(self,tidx,lvidx,lonidx,latidx,other):
-        PP = self.get('P',tidx,lvidx,lonidx,latidx)
-        PB = self.get('PB',tidx,lvidx,lonidx,latidx)
+        PP = self.get('P',tidx,lvidx,lons=lonidx,lats=latidx)
+        PB = self.get('PB',tidx,lvidx,lons=lonidx,lats=latidx)
         pressure = PP + PB
         return pressure
 
     def compute_drybulb(self,tidx,lvidx,lonidx,latidx,other='K'):
-        theta = self.get('theta',tidx,lvidx,lonidx,latidx)
-        P = self.get('pressure',tidx,lvidx,lonidx,latidx)
+        theta = self.get('theta',tidx,lvidx,lons=lonidx,lats=latidx)
+        P = self.get('pressure',tidx,lvidx,lons=lonidx,lats=latidx)
         drybulb = theta*((P/100000.0)**(287.04/1004.0))
-        if other=='K':
+        if other in ('K',False):
             return drybulb
         elif other=='C':
             return drybulb-273.15
 
     def compute_theta(self,tidx,lvidx,lonidx,latidx,other):
-        theta = self.get('T',tidx,lvidx,lonidx,latidx)
+        theta = self.get('T',tidx,lvidx,lons=lonidx,lats=latidx)
         Tbase = 300.0
         theta = Tbase + theta
         return theta
 
     def compute_wind(self,tidx,lvidx,lonidx,latidx,other):
         # pdb.set_trace()
-        u = self.get('U',tidx,lvidx,lonidx,latidx)
-        v = self.get('V',tidx,lvidx,lonidx,latidx)
+        u = self.get('U',tidx,lvidx,lons=lonidx,lats=latidx)
+        v = self.get('V',tidx,lvidx,lons=lonidx,lats=latidx)
         data = N.sqrt(u**2 + v**2)
         return data
 
     def compute_shear(self,tidx,lvidx,lonidx,latidx,other=False):
         """
-        :params other:      dictionary of 'top' and 'bottom' levels, km
+        Bulk wind shear magnitude over a layer.
+
+        :params other:      dictionary of 'top' and 'bottom' of layer.
+                            Heights above ground, km, unless 'vcoord'
+                            is 'hPa'. Bounds may be 2D arrays (e.g. an
+                            effective inflow layer).
         :type other:        dict
+        """
+        layer, vcoord = self.get_layer(other)
+        winds = self.compute_layer_winds(tidx,lonidx,latidx,[layer,],vcoord)
+        return winds[0]['shear']
 
-        Could make this faster with numpy.digitize()?
+    def compute_meanwind(self,tidx,lvidx,lonidx,latidx,other=False):
+        """
+        Layer-mean wind speed. Arguments as for compute_shear.
+        """
+        layer, vcoord = self.get_layer(other)
+        winds = self.compute_layer_winds(tidx,lonidx,latidx,[layer,],vcoord)
+        return winds[0]['meanwind']
+
+    def get_layer(self,other):
+        """
+        Layer (bottom,top) and vertical coordinate from the 'other'
+        argument of compute_shear or compute_meanwind.
         """
         if not other:
             print("No shear heights specified. Using 0-6 km by default.")
-            topm = 6000.0
-            botm = 0.0
-            # print("Choose top and bottom for shear calc.")
-            # raise Exception
+            return (0.0,6.0), 'km'
+        vcoord = other.get('vcoord','km')
+        return (other['bottom'],other['top']), vcoord
+
+    def compute_layer_winds(self,tidx,lonidx,latidx,layers,vcoord='km'):
+        """
+        Bulk shear and layer-mean wind for several layers, for all
+        columns and times, in one pass over U, V and height (or pressure).
+        See interp.layer_winds.
+
+        :param layers:  list of (bottom,top). Heights above ground in km
+                        if vcoord is 'km', e.g. [(0,1),(0,3),(0,6)];
+                        pressure in hPa if vcoord is 'hPa', e.g.
+                        [(850,300),]. A bound may be an array with one
+                        value per column, e.g. for an effective layer.
+        :type layers:   list,tuple
+        :param vcoord:  'km' or 'hPa'
+        :type vcoord:   str
+        :returns:       list (one per layer) of dictionaries of ushear,
+                        vshear, shear, umean, vmean and meanwind. Each
+                        is 4D with one level.
+        """
+        u = N.asarray(self.get('U',tidx,False,lons=lonidx,lats=latidx),dtype=float)
+        v = N.asarray(self.get('V',tidx,False,lons=lonidx,lats=latidx),dtype=float)
+        if vcoord == 'km':
+            Z = self.get('Z',tidx,False,lons=lonidx,lats=latidx)
+            HGT = self.get('HGT',tidx,False,lons=lonidx,lats=latidx)
+            coord = N.asarray(Z-HGT,dtype=float)
+            scale = 1000.0
+            log = False
+        elif vcoord == 'hPa':
+            coord = N.asarray(self.get('pressure',tidx,False,lons=lonidx,
+                                lats=latidx),dtype=float)
+            scale = 100.0
+            log = True
         else:
-            topm = other['top']*1000
-            botm = other['bottom']*1000
-
-        u = self.get('U',tidx,lvidx,lonidx,latidx)
-        v = self.get('V',tidx,lvidx,lonidx,latidx)
-        Z = self.get('Z',tidx,lvidx,lonidx,latidx)
-
-        topidx = N.zeros((self.y_dim,self.x_dim))
-        botidx = N.zeros((self.y_dim,self.x_dim))
-        ushear = N.zeros((self.y_dim,self.x_dim))
-        vshear = N.zeros((self.y_dim,self.x_dim))
-
-        for j in range(self.x_dim):
-            for i in range(self.y_dim):
-                # import pdb; pdb.set_trace()
-                topidx[i,j] = round(N.interp(
-                                topm,Z[0,:,i,j],range(self.z_dim)))
-                botidx[i,j] = round(N.interp(
-                                botm,Z[0,:,i,j],range(self.z_dim)))
-                ushear[i,j] = u[0,topidx[i,j],i,j] - u[0,botidx[i,j],i,j]
-                vshear[i,j] = v[0,topidx[i,j],i,j] - v[0,botidx[i,j],i,j]
-
-        # Find indices of bottom and top levels
-        # topidx = N.where(abs(Z-topm) == abs(Z-topm).min(axis=1))
-        # botidx = N.where(abs(Z-botm) == abs(Z-botm).min(axis=1))
-
-        # ushear = u[0,:,topidx] - u[0,:,botidx]
-        # vshear = v[0,topidx,:,:] - v[0,botidx,:,:]
-
-        shear = N.sqrt(ushear**2 + vshear**2)
-        # pdb.set_trace()
-        return shear
+            print("Vertical coordinate must be 'km' or 'hPa'.")
+            raise Exception
+
+        return layer_winds(u,v,coord,layers,scale=scale,log=log)
 
     def compute_thetae(self,tidx,lvidx,lonidx,latidx,other):
-        P = self.get('pressure',tidx,lvidx,lonidx,latidx) # Computed
-        Drybulb = self.get('temp',tidx,lvidx,lonidx,latidx)
-        Q = self.get('Q',tidx,lvidx,lonidx,latidx)
+        P = self.get('pressure',tidx,lvidx,lons=lonidx,lats=latidx) # Computed
+        Drybulb = self.get('drybulb',tidx,lvidx,lons=lonidx,lats=latidx)
+        Q = self.get('QVAPOR',tidx,lvidx,lons=lonidx,lats=latidx)
 
-        thetae = (Drybulb + (Q * cc.Lv/cc.cp)) * (cc.P0/P) ** cc.kappa
+        thetae = (Drybulb + (Q * cc.Lv/mc.cp)) * (cc.P0/P) ** cc.kappa
         return thetae
 
     def compute_olr(self,tidx,lvidx,lonidx,latidx,other):
-        OLR = self.get('OLR',tidx,lvidx,lonidx,latidx)
+        OLR = self.get('OLR',tidx,lvidx,lons=lonidx,lats=latidx)
         sbc = 0.000000056704
         ir = ((OLR/sbc)**0.25) - 273.15
         return ir
 
     def compute_REFL_comp(self,tidx,lvidx,lonidx,latidx,other):
         lvidx = False
-        refl = self.get('REFL_10CM',tidx,lvidx,lonidx,latidx,other)[0,:,:,:]
+        refl = self.get('REFL_10CM',tidx,lvidx,lons=lonidx,lats=latidx,other=other)[0,:,:,:]
         refl_comp = N.max(refl,axis=0)
         return refl_comp
 
-    def compute_comp_ref(self,tidx,lvidx,lonidx,latidx,other):
-        """Amend this so variables obtain at start fetch only correct date, lats, lons
-        All levels need to be fetched as this is composite reflectivity
+    def compute_REFL_sim(self,tidx,lvidx,lonidx,latidx,other):
         """
-        T2 = self.get('T2',tidx,False,lonidx,latidx)
-        # QR = self.nc.variables['QRAIN'][PS['t'],:,PS['la'],PS['lo']]
-        QR = self.get('QRAIN',tidx,False,lonidx,latidx) # This should get all levels
-        PSFC = self.get('PSFC',tidx,False,lonidx,latidx)
+        3D simulated radar reflectivity (dBZ) from rain, snow and
+        graupel mixing ratios, for all requested times at once.
 
-        try:
-            QS = self.get('QSNOW',tidx,False,lonidx,latidx)
-        except:
-            QS = N.zeros(N.shape(QR))
-        rhor = 1000.0
-        rhos = 100.0
-        rhog = 400.0
-        rhoi = 917.0
-
-        no_rain = 8.0E6
-        # How do I access this time?
-        no_snow = 2.0E6 * N.exp(-0.12*(T2-273.15))
-        no_grau = 4.0E6
-
-        density = N.divide(PSFC,(287.0 * T2))
-        Qra_all = QR[0,...]
-        Qsn_all = QS[0,...]
-
-        for j in range(len(Qra_all[1,:,1])):
-            curcol_r = []
-            curcol_s = []
-            for i in range(len(Qra_all[1,1,:])):
-                    maxrval = N.max(Qra_all[:,j,i])
-                    maxsval = N.max(Qsn_all[:,j,i])
-                    curcol_r.append(maxrval)
-                    curcol_s.append(maxsval)
-            N_curcol_r = N.array(curcol_r)
-            N_curcol_s = N.array(curcol_s)
-            if j == 0:
-                Qra = N_curcol_r
-                Qsn = N_curcol_s
-            else:
-                Qra = N.row_stack((Qra, N_curcol_r))
-                Qsn = N.row_stack((Qsn, N_curcol_s))
+        Each species is assumed to have an exponential size distribution
+        (Marshall-Palmer), so Ze = 720 N0 lambda^-7 with
+        lambda = (pi N0 rho_x / (rho_air q))^0.25. Ice species are scaled
+        by their density and the dielectric factor (0.224). The snow
+        intercept depends on temperature. Species missing from the file
+        are skipped.
 
-        # Calculate slope factor lambda
-        lambr = (N.divide((3.14159 * no_rain * rhor), N.multiply(density, Qra)+N.nextafter(0,1))) ** 0.25
-        lambs = N.exp(-0.0536 * (T2 - 273.15))
+        All levels are always computed.
+        """
+        T = self.get('drybulb',tidx,False,lons=lonidx,lats=latidx,other='K')
+        P = self.get('pressure',tidx,False,lons=lonidx,lats=latidx)
+        T = N.asarray(T,dtype=float)
+        density = N.asarray(P,dtype=float)/(mc.R*T)
 
-        # Calculate equivalent reflectivity factor
-        Zer = (720.0 * no_rain * (lambr ** -7.0)) * 1E18
-        Zes = (0.224 * 720.0 * no_snow * (lambr ** -7.0) * (rhos/rhoi) ** 2) * 1E18
-        Zes_int = N.divide((lambs * Qsn * density), no_snow)
-        Zes = ((0.224 * 720 * 1E18) / (3.14159 * rhor) ** 2) * Zes_int ** 2
+        rhow = 1000.0
+        # Species: (density, intercept, dielectric factor)
+        species = {'QRAIN':(1000.0,8.0E6,1.0),
+                    'QSNOW':(100.0,N.minimum(2.0E6*N.exp(-0.12*N.minimum(
+                                    T-273.15,0.0)),2.0E8),0.224),
+                    'QGRAUP':(400.0,4.0E6,0.224)}
 
-        Ze = N.add(Zer, Zes)
-        dBZ = N.nan_to_num(10*N.log10(Ze))
+        Ze = N.zeros(T.shape)
+        for q, (rhox, n0, dielec) in species.iteritems():
+            if q not in self.fields:
+                continue
+            Q = N.asarray(self.get(q,tidx,False,lons=lonidx,lats=latidx),dtype=float)
+            mass = density*N.maximum(Q,0.0)
+            # Equivalent to 720 N0 lambda^-7 for an exponential distribution
+            Ze += (720.0*1.0E18*dielec*(rhox/rhow)**2 *
+                    n0**-0.75 * (mass/(N.pi*rhox))**1.75)
+
+        # Floor at -30 dBZ where there is no hydrometeor
+        dBZ = 10*N.log10(N.maximum(Ze,1.0E-3))
         return dBZ
 
+    def compute_comp_ref(self,tidx,lvidx,lonidx,latidx,other):
+        """
+        Composite (column maximum) simulated reflectivity, dBZ.
+        """
+        dBZ = self.get('REFL_sim',tidx,False,lons=lonidx,lats=latidx)
+        return N.max(dBZ,axis=1)[:,N.newaxis,...]
+
+    def compute_echotop(self,tidx,lvidx,lonidx,latidx,other):
+        """
+        Echo-top height (m above ground): highest level where simulated
+        reflectivity reaches a threshold (other, dBZ; 18 by default).
+        Zero where no level reaches it.
+        """
+        thresh = 18.0 if other is False else other
+        dBZ = self.get('REFL_sim',tidx,False,lons=lonidx,lats=latidx)
+        Zagl = (self.get('Z',tidx,False,lons=lonidx,lats=latidx) -
+                self.get('HGT',tidx,False,lons=lonidx,lats=latidx))
+        echo = dBZ >= thresh
+        nz = dBZ.shape[1]
+        # Index of the highest level with echo
+        topidx = nz - 1 - N.argmax(echo[:,::-1,...],axis=1)
+        top = N.take_along_axis(N.asarray(Zagl),topidx[:,N.newaxis,...],axis=1)
+        return N.where(echo.any(axis=1)[:,N.newaxis,...],top,0.0)
+
+    def compute_REFL_1km(self,tidx,lvidx,lonidx,latidx,other):
+        """
+        Simulated reflectivity 1 km above ground, dBZ.
+        """
+        dBZ = self.get('REFL_sim',tidx,False,lons=lonidx,lats=latidx)
+        Zagl = (self.get('Z',tidx,False,lons=lonidx,lats=latidx) -
+                self.get('HGT',tidx,False,lons=lonidx,lats=latidx))
+        VI = VerticalInterpolator(Zagl,1000.0,axis=1,outside='mask')
+        return VI(dBZ)
+
     def compute_simref_atlevel(self,level=1):
         pass
         return data
@@ -773,22 +1191,12 @@ class WRFOut(object):
 
         pass
 
-    def compute_thetae(self,tidx,lvidx,lonidx,latidx,other):
-        P = self.get('pressure',tidx,lvidx,lonidx,latidx)
-        T = self.get('drybulb',tidx,lvidx,lonidx,latidx,units='K')
-        Td = self.get('Td',tidx,lvidx,lonidx,latidx)
-        p2, t2 = thermo.drylift(P,T,Td)
-        x = thermo.wetlift(p2,t2,100.0)
-        thetae = thermo.theta(100.0, x, 1000.0)
-        return thetae
-
-
     def compute_Td(self,tidx,lvidx,lonidx,latidx,other):
         """
         Using HootPy equation
         """
-        Q = self.get('QVAPOR',tidx,lvidx,lonidx,latidx)
-        P = self.get('pressure',tidx,lvidx,lonidx,latidx)
+        Q = self.get('QVAPOR',tidx,lvidx,lons=lonidx,lats=latidx)
+        P = self.get('pressure',tidx,lvidx,lons=lonidx,lats=latidx)
         w = N.divide(Q, N.subtract(1,Q))
         e = N.divide(N.multiply(w,P), N.add(0.622,w))/100.0
         a = N.multiply(243.5,N.log(N.divide(e,6.112)))
@@ -819,8 +1227,8 @@ class WRFOut(object):
         totalCAPE = 0
         totalCIN = 0
 
-        theta = self.get('theta',tidx,lvidx,lonidx,latidx)
-        Z = self.get('Z',tidx,lvidx,lonidx,latidx)
+        theta = self.get('theta',tidx,lvidx,lons=lonidx,lats=latidx)
+        Z = self.get('Z',tidx,lvidx,lons=lonidx,lats=latidx)
 
         for lvidx in range(theta.shape[1]-1):
             if lvidx < 20:
@@ -919,16 +1327,16 @@ class WRFOut(object):
         along that axis.
         """
         if 'WSPD10MAX' in self.fields:
-            ww = self.get('WSPD10MAX',tidx,lvidx,lonidx,latidx)
+            ww = self.get('WSPD10MAX',tidx,lvidx,lons=lonidx,lats=latidx)
             if ww.max() > 0.1:
                 print("Using WSPD10MAX data")
                 wind = ww
             else:
                 print("Using wind10 data")
-                wind = self.get('wind10',tidx,lvidx,lonidx,latidx)
+                wind = self.get('wind10',tidx,lvidx,lons=lonidx,lats=latidx)
         else:
             print("Using wind10 data")
-            wind = self.get('wind10',tidx,lvidx,lonidx,latidx)
+            wind = self.get('wind10',tidx,lvidx,lons=lonidx,lats=latidx)
         wind_max = N.amax(wind,axis=0)
         # wind_max_smooth = self.test_smooth(wind_max)
         # return wind_max_smooth
@@ -985,11 +1393,6 @@ class WRFOut(object):
         else:
             return vc1
 
-    def get_XY(self,lat,lon):
-        """Return grid indices for lat/lon pair.
-        """
-        pass
-
     def get_limited_domain(self,da,skip=1,return_array='idx'):
         """
         Return smaller array of lats, lons depending on
@@ -1002,10 +1405,10 @@ class WRFOut(object):
         """
 
         if isinstance(da,dict):
-            N_idx = self.get_lat_idx(da['Nlim'])
-            E_idx = self.get_lon_idx(da['Elim'])
-            S_idx = self.get_lat_idx(da['Slim'])
-            W_idx = self.get_lon_idx(da['Wlim'])
+            lat_sl, lon_sl = self.get_subdomain_idx(da['Nlim'],da['Elim'],
+                                                    da['Slim'],da['Wlim'])
+            S_idx, N_idx = lat_sl.start, lat_sl.stop
+            W_idx, E_idx = lon_sl.start, lon_sl.stop
         else:
             N_idx = self.lats1D.shape[0]
             E_idx = self.lons1D.shape[0]
@@ -1041,50 +1444,67 @@ class WRFOut(object):
     def get_p(self,vrbl,tidx=False,level=False,lonidx=False,latidx=False):
         """
         Return an pressure level isosurface of given variable.
-        Interpolation is linear so watch out.
+        Interpolation is linear in log(p), for all requested times and
+        levels at once. Points below ground (or above the model top) are
+        masked.
 
-        Dimensions returns as (height,lat,lon)
-        Or is it (height,lon, lat!?)
+        Dimensions returns as (time,level,lat,lon)
 
-        TODO: Need to include limited domain functionality
+        The interpolation weights are kept, so other variables at the
+        same times and levels reuse them.
 
         if vrbl=='pressure',create constant grid.
         """
-        if isinstance(level,basestring) and level.endswith('hPa'):
-            hPa = 100.0*int(level.split('h')[0])
-            nlv = 1
-        elif isinstance(level,(float,int)):
-            hPa = level*100.0
-            nlv = 1
-        elif isinstance(level,(tuple,list)):
-            hPa = [l*100.0 for l in level]
-            nlv = len(hPa)
-        else:
-            print("Use XXXhPa, an integer, or list of integers for level.")
-            raise Exception
-
-        # If this breaks, user is requesting non-4D data
-        # Duck-typing for the win
-        
-        P = self.get('pressure',utc=tidx,lons=lonidx,lats=latidx)[0,...]
+        plevs = self.get_plevels(level)
 
+        VI = self.get_p_interpolator(tidx,plevs,lonidx,latidx)
         if vrbl=='pressure':
-            dataout = N.ones([nlv,P.shape[-2],P.shape[-1]])*hPa
+            shp = list(VI.shape)
+            shp[1] = len(plevs)
+            dataout = N.ones(shp)*N.array(plevs)[N.newaxis,:,N.newaxis,N.newaxis]
         else:
-            datain = self.get(vrbl,utc=tidx,lons=lonidx,lats=latidx)[0,...]
-            # import pdb; pdb.set_trace()
-            # What about RUC, pressure coords
-            # dataout = N.zeros([nlv,P.shape[-1],P.shape[-2]])
-            dataout = N.zeros([nlv,P.shape[-2],P.shape[-1]])
-            # pdb.set_trace()
-            for (i,j), p in N.ndenumerate(dataout[0,:,:]):
-                dataout[:,i,j] = N.interp(hPa,P[:,i,j][::-1],datain[:,i,j][::-1])
-            # dataout = scipy.interpolate.griddata(P.flatten(),datain.flatten(),hPa)
-        if nlv == 1:
-            # Return 2D if only one level requested
-            return self.make_4D(dataout[0,:,:])
+            # If this breaks, user is requesting non-4D data
+            # Duck-typing for the win
+            datain = self.get(vrbl,utc=tidx,lons=lonidx,lats=latidx)
+            dataout = VI(datain)
+        return dataout
+
+    def get_plevels(self,level):
+        """
+        Convert a pressure level request to a list of levels in Pa.
+
+        :param level:   'XXXhPa', an integer (hPa), or list/tuple of these
+        :returns:       list of floats (Pa)
+        """
+        if isinstance(level,(tuple,list,N.ndarray)):
+            levels = level
         else:
-            return self.make_4D(dataout)
+            levels = [level,]
+
+        plevs = []
+        for lv in levels:
+            if isinstance(lv,basestring) and lv.endswith('hPa'):
+                plevs.append(100.0*int(lv.split('h')[0]))
+            elif isinstance(lv,(float,int,N.number)):
+                plevs.append(lv*100.0)
+            else:
+                print("Use XXXhPa, an integer, or list of integers for level.")
+                raise Exception
+        return plevs
+
+    def get_p_interpolator(self,tidx,plevs,lonidx,latidx):
+        """
+        Return the VerticalInterpolator from model levels to pressure
+        levels for these times and this subdomain. It is kept in the
+        field cache, within its byte budget.
+        """
+        key = make_key('interpolator',tidx,plevs,lonidx,latidx)
+        VI = self.cache.get(key)
+        if VI is None:
+            P = self.get('pressure',utc=tidx,lons=lonidx,lats=latidx)
+            VI = VerticalInterpolator(P,plevs,axis=1,log=True,outside='mask')
+            self.cache.put(key,VI)
+        return VI
 
     def interp_to_p_fortran(self,config,nc_path,var,lv):
         """ Uses p_interp fortran code to put data onto a pressure
@@ -1170,16 +1590,16 @@ class WRFOut(object):
         latidx = False
 
         # Get wind data
-        wind10 = self.get('wind10',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        T2 = self.get('T2',tidx,lvidx,lonidx,latidx)[0,0,:,:]
+        wind10 = self.get('wind10',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        T2 = self.get('T2',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
 
         # This is the 2D plane for calculation data
         coldpooldata = N.zeros(wind10.shape)
 
         # Compute required C2 fields to save time
-        dpt = self.get('dpt',tidx,lvidx,lonidx,latidx)[0,:,:,:]
-        Z = self.get('Z',tidx,lvidx,lonidx,latidx)[0,:,:,:]
-        HGT = self.get('HGT',tidx,lvidx,lonidx,latidx)[0,0,:,:]
+        dpt = self.get('dpt',tidx,lvidx,lons=lonidx,lats=latidx)[0,:,:,:]
+        Z = self.get('Z',tidx,lvidx,lons=lonidx,lats=latidx)[0,:,:,:]
+        HGT = self.get('HGT',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
         heights = Z-HGT
         # pdb.set_trace()
 
@@ -1220,15 +1640,13 @@ class WRFOut(object):
                 xx_env = xx[gf_pt+1:]
                 yy_env = yy[gf_pt+1:]
                 dpt_env = N.mean(dpt[:,yy_env,xx_env],axis=1)
-            # pdb.set_trace()
 
-            for x,y in zip(xx_cp,yy_cp):
-            #for x,y in zip(xx,yy):
-                if dz:
-                    coldpooldata[y,x] = self.compute_cpdz(x,y,dpt[:,y,x],heights[:,y,x],dpt_env)
-                    # pdb.set_trace()
-                else:
-                    coldpooldata[y,x] = N.sqrt(self.compute_C2(x,y,dpt[:,y,x],heights[:,y,x],dpt_env))
+            # All columns behind the gust front at once
+            C, cpdz = cold_pool_C(dpt[:,yy_cp,xx_cp],heights[:,yy_cp,xx_cp],dpt_env)
+            if dz:
+                coldpooldata[yy_cp,xx_cp] = cpdz
+            else:
+                coldpooldata[yy_cp,xx_cp] = C
 
         return coldpooldata
 
@@ -1244,7 +1662,6 @@ class WRFOut(object):
         """
 
         dz, zidx = self.cold_pool_depth(dpt,heights,dpt_env)
-        # import pdb; pdb.set_trace()
         return dz
 
     def compute_C2(self,x,y,dpt,heights,dpt_env):
@@ -1256,29 +1673,19 @@ class WRFOut(object):
         dpt     :   density potential temperature slice
         heights :   height AGL slice
         dpt_env :   environmental dpt, column
+
+        See coldpool.cold_pool_C2 for many columns at once.
         """
 
-        dz, zidx = self.cold_pool_depth(dpt,heights,dpt_env)
-        C2 = -2*mc.g*((dpt[zidx]-dpt_env[zidx])/dpt_env[zidx])*dz
-        # print("dpt = {0} ... dpt_env = {1} ... C2 = {2}".format(dpt[0],dpt_env[0],C2))
+        C2, dz = cold_pool_C2(dpt,heights,dpt_env)
         return C2
 
     def cold_pool_depth(self,dpt,heights,dpt_env):
-        dz = 0
-        # thresh = -2.0
-        thresh = -1.0
-        for d,z, de in zip(dpt[1:],heights[1:],dpt_env[1:]):
-            dptp = d - de
-            if dptp > thresh:
-                break
-            dz = z
-
-        if isinstance(dz,float):
-            zidx = N.where(heights==dz)[0]
-        else:
-            zidx = 0
-        # import pdb; pdb.set_trace()
-        return dz, zidx
+        """
+        Cold pool depth and the index of its top level; see
+        coldpool.cold_pool_depth, which also takes many columns.
+        """
+        return cold_pool_depth(dpt,heights,dpt_env)
 
     def find_gust_front(self,wind_slice,T2_slice,angle,method=3):
         """
@@ -1292,51 +1699,27 @@ class WRFOut(object):
         """
 
         shp = wind_slice.shape
-
-        # Compute gradient quantities
-        shear = N.zeros(shp)
-        T2grad = N.zeros(shp)
-
-        for n in range(shp[0]):
-            if n == 0 or n == shp[0]-1:
-                shear[n] = 0
-            else:
-                len1 = abs(self.dx / N.sin(angle))
-                len2 = abs(self.dx / N.cos(angle))
-                hyp = min((len1,len2))
-                # In kilometres:
-                shear[n] = ((wind_slice[n+1]-wind_slice[n-1])/(2*hyp))*1000.0
-                T2grad[n] = ((T2_slice[n+1]-T2_slice[n-1])/(2*hyp))*1000.0
-                # N.W.DX
-
-        # pdb.set_trace()
-
-        # Go from B to A
-        # Find first location where T2 drops and shear is ?
+        len1 = abs(self.dx / N.sin(angle))
+        len2 = abs(self.dx / N.cos(angle))
+        hyp = min((len1,len2))
 
         if method==1:
             ### METHOD 1: USING THRESHOLDS
+            # In kilometres:
+            shear = along_gradient(wind_slice,hyp)
+            T2grad = along_gradient(T2_slice,hyp)
+            # Go from B to A
             # By default
-            gfidx = shp/2
-            for n, s, t in zip(range(shp)[::-1],shear[::-1],T2grad[::-1]):
+            gfidx = shp[0]/2
+            for n, s, t in zip(range(shp[0])[::-1],shear[::-1],T2grad[::-1]):
                 if (abs(s)>2.0) and (t<2.0):
                     gfidx = n
                     break
 
         elif method==2 or method==3:
-
-            ### METHOD 2: FINDING MAX GRADIENTS AND AVERAGING
-            shear = abs(shear)
-            T2grad = abs(T2grad)
-
-            xsh_idx = N.where(shear == shear.max())[0][0]
-            xtg_idx = N.where(T2grad == T2grad.max())[0][0]
-            print("Max shear loc: {0} ... max tempgrad loc: {1}".format(xsh_idx,xtg_idx))
-
-            if method==2:
-                gfidx = int((xsh_idx + xtg_idx)/2.0)
-            else:
-                gfidx = max([xsh_idx,xtg_idx])
+            ### METHODS 2, 3: FINDING MAX GRADIENTS
+            # See coldpool.find_gust_front for many slices at once
+            gfidx = int(find_gust_front(wind_slice,T2_slice,hyp,method))
 
         return gfidx
         # maxshearloc[0][0] returns the integer
@@ -1455,8 +1838,8 @@ class WRFOut(object):
 
     def compute_derivatives(self,U,V):
         # import pdb; pdb.set_trace()
-        dudx, dudy = N.gradient(U,self.dx,self.dx)
-        dvdx, dvdy = N.gradient(V,self.dx,self.dx)
+        dudy, dudx = N.gradient(U,self.dy,self.dx)
+        dvdy, dvdx = N.gradient(V,self.dy,self.dx)
         return dudx, dudy, dvdx, dvdy
 
     def compute_stretch_deformation(self,U,V):
@@ -1481,8 +1864,8 @@ class WRFOut(object):
         return zeta
 
     def compute_fluid_trapping_diagnostic(self,tidx,lvidx,lonidx,latidx,other):
-        U = self.get('U10',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        V = self.get('V10',tidx,lvidx,lonidx,latidx)[0,0,:,:]
+        U = self.get('U10',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        V = self.get('V10',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
         E = self.compute_total_deformation(U,V)
         zeta = self.compute_vorticity(U,V)
         omega2 = 0.25*(E**2 - zeta**2)
@@ -1495,8 +1878,8 @@ class WRFOut(object):
 
     def compute_instantaneous_local_Lyapunov(self,tidx,lvidx,lonidx,latidx,other):
         # import pdb; pdb.set_trace()
-        U = self.get('U',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        V = self.get('V',tidx,lvidx,lonidx,latidx)[0,0,:,:]
+        U = self.get('U',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        V = self.get('V',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
         E = self.compute_total_deformation(U,V)
         zeta = self.compute_vorticity(U,V)
         div = self.compute_divergence(U,V)
@@ -1506,8 +1889,8 @@ class WRFOut(object):
 
     def return_axis_of_dilatation_components(self,tidx,lvidx=False,lonidx=False,
                                                 latidx=False,other=False):
-        U = self.get('U10',tidx,lvidx,lonidx,latidx)[0,0,:,:]
-        V = self.get('V10',tidx,lvidx,lonidx,latidx)[0,0,:,:]
+        U = self.get('U10',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
+        V = self.get('V10',tidx,lvidx,lons=lonidx,lats=latidx)[0,0,:,:]
         Esh = self.compute_shear_deformation(U,V)
         Est = self.compute_stretch_deformation(U,V)
         E = self.compute_total_deformation(U,V)
@@ -1522,15 +1905,15 @@ class WRFOut(object):
     def compute_omega(self,tidx,lvidx,lonidx,latidx,other):
         # Rising motion in Pa/s
         # dp/dt of air parcel
-        W = self.get('W',tidx,lvidx,lonidx,latidx)[0,:,:,:]
-        rho = self.get('density',tidx,lvidx,lonidx,latidx)[0,:,:,:]
+        W = self.get('W',tidx,lvidx,lons=lonidx,lats=latidx)[0,:,:,:]
+        rho = self.get('density',tidx,lvidx,lons=lonidx,lats=latidx)[0,:,:,:]
         omega = -rho * -mc.g * W # I think it's meant to be minus g?
         # import pdb; pdb.set_trace()
         return omega
 
     def compute_density(self,tidx,lvidx,lonidx,latidx,other):
-        drybulb = self.get('drybulb',tidx,lvidx,lonidx,latidx,other='K')
-        P = self.get('pressure',tidx,lvidx,lonidx,latidx)
+        drybulb = self.get('drybulb',tidx,lvidx,lons=lonidx,lats=latidx,other='K')
+        P = self.get('pressure',tidx,lvidx,lons=lonidx,lats=latidx)
         rho = P/(mc.R*drybulb)
         # drybulb = 273.15 + (T/((100000.0/(level*100.0))**(mc.R/mc.cp)))
         return rho
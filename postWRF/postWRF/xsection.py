@@ -139,10 +139,8 @@ class CrossSection(Figure):
     def get_xy_from_latlon(self,lat,lon):
         """
         Return x and y coordinates for given lat/lon.
-
-        exactlat, exactlon      :   exact coordinates of closest x/y
         """
-        y,x,exactlat,exactlon = utils.getXY(self.W.lats1D,self.W.lons1D,lat,lon)
+        y,x = self.W.get_XY(lat,lon)
         return x,y
 
     def get_wrfout_slice(self,vrbl,utc=False,level=False,x=False,y=False):
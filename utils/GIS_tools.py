@@ -4,7 +4,6 @@ import calendar
 import collections
 import fnmatch
 import math
-import matplotlib as M
 import numpy as N
 import os
 import pdb
@@ -950,8 +949,11 @@ def ensure_datenum(times,fmt='int'):
     Output:
     dntimes = (123456,) or (123456,234567)
     """
-    if isinstance(times,int):
-        dntimes = [times,] #1
+    # Fast path for datenums, including numpy integers/arrays
+    if isinstance(times,(int,long,N.integer)):
+        dntimes = [int(times),] #1
+    elif isinstance(times,N.ndarray):
+        dntimes = times.astype(int).ravel().tolist() #2,3
     elif isinstance(times,basestring):
         print("Don't give me strings...")
         raise Exception
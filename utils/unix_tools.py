@@ -3,6 +3,7 @@ Utility scripts to help with directory, file, etc issues
 """
 
 import os
+import stat
 import GIS_tools as utils
 try:
     import paramiko
@@ -22,6 +23,34 @@ def dir_from_naming(root,*args):
     path = os.path.join(root,*l)
     return path
 
+def private_dir(path):
+    """
+    Create path (mode 0700) if needed and check that only this user
+    can write to it, so files read back from it can be trusted.
+
+    Returns True if path is a directory owned by this user and not
+    writable by group or others; otherwise prints why and returns False.
+    """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path,0o700)
+        except OSError:
+            # Another process may have just created it
+            if not os.path.isdir(path):
+                print("Could not create {0}.".format(path))
+                return False
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        print("{0} is not a directory.".format(path))
+        return False
+    if st.st_uid != os.getuid():
+        print("{0} is owned by another user; not using it.".format(path))
+        return False
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        print("{0} is writable by other users; not using it.".format(path))
+        return False
+    return True
+
 def ssh_client(ky,domain,username,password):
     key = paramiko.RSAKey(data=base64.decodestring(ky))
     client = paramiko.SSHClient()